@@ -0,0 +1,615 @@
+# This file is part of ldapy.
+#
+# ldapy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ldapy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
+
+# The asyncio counterparts of Connection, Node and Ldapy, for using ldapy
+# from applications running an event loop (needs Python 3.6 or later):
+#
+#    con = AsyncConnection ("ldap://localhost")
+#    await con.bind ("cn=admin,dc=nodomain", "foobar")
+#    ldapy = AsyncLdapy (con)
+#    await ldapy.changeDN ("dc=nodomain")
+#    print (await ldapy.children ())
+#
+# The operations are sent to the server without waiting for the results of
+# the previous ones, and the results are read by the event loop when the
+# socket is readable, so any number of operations (from any number of tasks)
+# can be in flight on one connection.
+
+import asyncio
+import time
+import ldap
+import ldap.modlist
+from . import connection
+from . import exceptions
+from .connection import ConnectionError, Connection, _encode, _decode, _copy, _searchKey, \
+        _readControl, _readEntry
+from .statistics import Statistics, Record, size
+from .node import Node, NodeError, _modification, _applyModification, _cachedCompletions, _completionSearch, _matching, _rdn, _added
+from .ldapy import Ldapy, LdapyError, SetAttributeError, DeleteError, _walk
+
+import logging
+logger = logging.getLogger("ldapy.%s" % __name__)
+
+class _Request:
+    """An operation waiting for its result. The entries returned by a search
+    are put in a queue, followed by None when it's done (or the error if it
+    failed), while the result of other operations sets a future."""
+
+    def __init__ (self, msgid, search):
+        self.msgid = msgid
+        self.search = search
+        if search:
+            self.entries = asyncio.Queue ()
+        else:
+            self.result = asyncio.get_event_loop ().create_future ()
+
+    def receive (self, entries):
+        for entry in entries:
+            if entry[0] is not None:
+                self.entries.put_nowait (entry)
+
+    def complete (self, controls):
+        if self.search:
+            self.entries.put_nowait (None)
+        elif not self.result.done ():
+            self.result.set_result (controls)
+
+    def fail (self, error):
+        if self.search:
+            self.entries.put_nowait (error)
+        elif not self.result.done ():
+            self.result.set_exception (error)
+
+class AsyncConnection:
+    """The counterpart of Connection, where the operations are coroutines.
+
+    Unlike Connection it uses one server: if the connection is lost the
+    pending operations fail, and it's bound again (with the same
+    credentials) before the next operation."""
+
+    def __init__ (self, uri, traces = 0):
+        logger.info ("Connecting to %s" % uri)
+        self.uri = uri
+        self.traces = traces
+        self.connected = False
+        self.statistics = Statistics ()
+        self._credentials = None
+        self._roots = None
+        self._supportedControls = None
+        self._pending = {}
+        self._flights = {}
+        self._reading = None
+        self._lost = False
+        self._rebinding = None
+        self._initialize ()
+
+    def _initialize (self):
+        self._ldap = ldap.initialize (self.uri, trace_level = self.traces)
+
+    def _raise_error (self, msg, exception = None):
+        if exception and "info" in exceptions.details (exception):
+            raise ConnectionError (self, msg, exceptions.details (exception)["info"])
+        else:
+            raise ConnectionError (self, msg)
+
+    def _send (self, operation, search = False):
+        """Sends operation, a function taking the LDAP object and returning
+        the message id, and returns its request"""
+        request = _Request (operation (self._ldap), search)
+        self._pending[request.msgid] = request
+
+        if self._reading is None:
+            self._reading = self._ldap.fileno ()
+            asyncio.get_event_loop ().add_reader (self._reading, self._poll)
+        return request
+
+    def _stopReading (self):
+        if self._reading is not None:
+            asyncio.get_event_loop ().remove_reader (self._reading)
+            self._reading = None
+
+    def _poll (self):
+        """Reads the results which have arrived, called by the event loop when
+        the socket is readable"""
+        while self._pending:
+            try:
+                kind, data, msgid, controls = self._ldap.result3 (ldap.RES_ANY,
+                        all = 0, timeout = 0)
+            except ldap.SERVER_DOWN as e:
+                self._connectionLost (e)
+                return
+            except ldap.LDAPError as e:
+                request = self._pending.pop (exceptions.details (e).get ("msgid"), None)
+                if request is None:
+                    # We can't tell which operation failed
+                    self._connectionLost (e)
+                    return
+                request.fail (e)
+                continue
+
+            if kind is None:
+                # Nothing more has arrived
+                break
+
+            request = self._pending.get (msgid)
+            if request is None:
+                # Eg the rest of an abandoned search
+                continue
+            elif kind == ldap.RES_SEARCH_ENTRY:
+                request.receive (_decode (data))
+            elif kind != ldap.RES_SEARCH_REFERENCE:
+                del self._pending[msgid]
+                request.complete (controls)
+
+        if not self._pending:
+            self._stopReading ()
+
+    def _connectionLost (self, error):
+        logger.warning ("Lost the connection to %s" % self.uri)
+        pending, self._pending = self._pending, {}
+        self._stopReading ()
+        for request in pending.values ():
+            request.fail (error)
+
+        # A fresh LDAP object to connect with before the next operation
+        self._initialize ()
+        self._lost = True
+
+    async def _connected (self):
+        """Binds again if the connection was lost, once even if several tasks
+        are waiting for it"""
+        if not self._lost or not self._credentials:
+            return
+        if self._rebinding is None:
+            self._rebinding = asyncio.ensure_future (self.bind (*self._credentials))
+        try:
+            await asyncio.shield (self._rebinding)
+        finally:
+            if self._rebinding is not None and self._rebinding.done ():
+                self._rebinding = None
+
+    def _start (self, operation, search = False):
+        try:
+            return self._send (operation, search)
+        except ldap.SERVER_DOWN as e:
+            self._connectionLost (e)
+            raise
+
+    async def _wait (self, operation):
+        """Sends operation, once bound, and waits for its result"""
+        await self._connected ()
+        return await self._start (operation).result
+
+    def _record (self, operation, dn, scope, start, entries = 0, bytes = 0):
+        # Recorded directly rather than measured (see Statistics.measure),
+        # since the spans of the tracing are per thread and not per task
+        self.statistics.record (Record (operation, dn, scope, entries, bytes,
+            time.time () - start))
+
+    async def bind (self, who, cred):
+        start = time.time ()
+        try:
+            await self._start (lambda l: l.simple_bind (who, cred)).result
+        except ldap.SERVER_DOWN as e:
+            self._raise_error (Connection._connection_error_msg % self.uri, e)
+        except ldap.INVALID_CREDENTIALS as e:
+            self._raise_error (Connection._bad_auth_error_msg % who, e)
+        except ldap.UNWILLING_TO_PERFORM as e:
+            self._raise_error (Connection._server_unwilling, e)
+        finally:
+            self._record ("bind", who, None, start)
+
+        self._credentials = (who, cred)
+        self._lost = False
+        self.connected = True
+
+    async def roots (self):
+        if not self._roots:
+            results = await self.search ("", connection.scopeBase,
+                    attrlist = ["namingContexts", "supportedControl"])
+            self._roots = results[0][1]["namingContexts"]
+            self._supportedControls = results[0][1].get ("supportedControl", [])
+            logger.debug ("Roots: %s" % self._roots)
+        return self._roots
+
+    async def searchIter (self, dn, scope, filterstr = "(objectClass=*)",
+            attrlist = None, sizelimit = 0):
+        """Searches for the entries matching filterstr, yielding them as they
+        arrive. If the iteration is stopped before the search is done, the
+        rest of it is abandoned."""
+        await self._connected ()
+        start = time.time ()
+        entries = bytes = 0
+        request = None
+        try:
+            request = self._start (lambda l: l.search_ext (dn, scope, filterstr,
+                attrlist = attrlist, sizelimit = sizelimit), search = True)
+            while True:
+                entry = await request.entries.get ()
+                if entry is None:
+                    request = None
+                    return
+                elif isinstance (entry, Exception):
+                    request = None
+                    raise entry
+
+                entries += 1
+                bytes += size (*entry)
+                yield entry
+        except ldap.NO_SUCH_OBJECT as e:
+            raise exceptions.NoSuchObject.convert (dn, e)
+        except ldap.LDAPError as e:
+            raise exceptions.LdapError (e)
+        finally:
+            if request is not None and self._pending.pop (request.msgid, None):
+                logger.debug ("Abandoning search of %s" % dn)
+                self._ldap.abandon (request.msgid)
+            self._record ("search", dn, scope, start, entries, bytes)
+
+    async def search (self, dn, scope, filterstr = "(objectClass=*)", attrlist = None):
+        """Returns the entries matching filterstr. If an identical search is
+        already in flight its result is shared (each caller getting its own
+        copy) instead of sending another one."""
+        key = _searchKey (dn, scope, filterstr, attrlist)
+        waiting = self._flights.get (key)
+        if waiting is not None:
+            waiter = asyncio.get_event_loop ().create_future ()
+            waiting.append (waiter)
+            return await waiter
+
+        waiting = self._flights[key] = []
+        try:
+            results = [entry async for entry in self.searchIter (dn, scope, filterstr, attrlist)]
+        except BaseException as e:
+            for waiter in waiting:
+                if isinstance (e, asyncio.CancelledError):
+                    waiter.cancel ()
+                elif not waiter.done ():
+                    waiter.set_exception (e)
+            raise
+        finally:
+            del self._flights[key]
+
+        # The copies are made before we return, and the results might be
+        # changed
+        for waiter in waiting:
+            if not waiter.done ():
+                waiter.set_result (_copy (results))
+        return results
+
+    async def searchLimited (self, dn, scope, filterstr, attrlist = None, sizelimit = 0):
+        """Searches for at most sizelimit entries, see
+        Connection.searchLimited"""
+        results = []
+        try:
+            async for entry in self.searchIter (dn, scope, filterstr, attrlist, sizelimit):
+                results.append (entry)
+        except exceptions.LdapError as e:
+            if not isinstance (e.exception, ldap.SIZELIMIT_EXCEEDED):
+                raise
+            logger.debug ("Size limit %u exceeded searching %s with filter %s" %
+                    (sizelimit, dn, filterstr))
+            return results, False
+        return results, True
+
+    async def _write (self, operation, dn, attrs, send, convert, pre = None):
+        """Sends a modifying operation (send takes the LDAP object and the
+        server controls). If pre is given the entry is asked for with the
+        pre-read (or post-read) control when the server is known to support
+        it, and its attributes are returned, otherwise None."""
+        if pre is not None:
+            control = Connection._preReadControl if pre else Connection._postReadControl
+            if not self._supportedControls or control not in self._supportedControls:
+                pre = None
+        serverctrls = [_readControl (pre)] if pre is not None else None
+
+        start = time.time ()
+        try:
+            controls = await self._wait (lambda l: send (l, serverctrls))
+        except ldap.LDAPError as e:
+            raise convert (e)
+        finally:
+            self._record (operation, dn, None, start,
+                    bytes = size (dn, attrs) if attrs else 0)
+
+        if pre is not None:
+            return _readEntry (dn, controls, pre)
+        return None
+
+    async def modify (self, dn, oldAttrs, newAttrs):
+        """Modifies the entry dn, returning its attributes after the change
+        if the server can read them back (see Connection.modify)"""
+        ldif = ldap.modlist.modifyModlist (_encode (oldAttrs), _encode (newAttrs))
+        logger.debug ("LdapModify: dn=%s, ldif:\n%s" % (dn, ldif))
+        return await self._write ("modify", dn, newAttrs,
+                lambda l, serverctrls: l.modify_ext (dn, ldif, serverctrls = serverctrls),
+                lambda e: connection._convertModifyError (e, dn, newAttrs), pre = False)
+
+    async def delete (self, dn):
+        """Deletes the entry dn, returning its attributes before it was
+        deleted if the server can read them (see Connection.delete)"""
+        return await self._write ("delete", dn, None,
+                lambda l, serverctrls: l.delete_ext (dn, serverctrls = serverctrls),
+                lambda e: connection._convertDeleteError (e, dn), pre = True)
+
+    async def add (self, dn, attrs):
+        """Adds the entry dn, returning its attributes as read back if the
+        server can (see Connection.add)"""
+        ldif = ldap.modlist.addModlist (_encode (attrs))
+        return await self._write ("add", dn, attrs,
+                lambda l, serverctrls: l.add_ext (dn, ldif, serverctrls = serverctrls),
+                lambda e: connection._convertAddError (e, dn, attrs), pre = False)
+
+    def close (self):
+        """Unbinds, failing the pending operations"""
+        pending, self._pending = self._pending, {}
+        self._stopReading ()
+        for request in pending.values ():
+            request.fail (ldap.SERVER_DOWN ({"desc": "Connection closed"}))
+        self._ldap.unbind_ext ()
+        self.connected = False
+
+class AsyncNode:
+    """The counterpart of Node, where the operations are coroutines.
+
+    Nothing is read when the node is created: the attributes and children
+    are read when first asked for, once even if several tasks ask for them
+    at the same time."""
+
+    completionSizeLimit = Node.completionSizeLimit
+
+    def __init__ (self, con, dn, attributes = None):
+        self.con = con
+        self.parent = None
+        self._attributes = attributes
+        self._children = None
+        self._partialChildren = {}
+        self._completions = {}
+        self._lock = None
+
+        try:
+            self.dn = connection.dn2str (connection.str2dn (dn))
+        except exceptions.DNDecodingError:
+            raise exceptions.DNDecodingError (dn)
+
+    @property
+    def attributes (self):
+        """The attributes, if they have been read (see getAttributes)"""
+        return self._attributes
+
+    def _locked (self):
+        if self._lock is None:
+            self._lock = asyncio.Lock ()
+        return self._lock
+
+    def _child (self, dn, attributes = None):
+        node = AsyncNode (self.con, dn, attributes)
+        node.parent = self
+        return node
+
+    async def getAttributes (self):
+        if self._attributes is None:
+            async with self._locked ():
+                if self._attributes is None:
+                    if self.dn:
+                        entries = await self.con.search (self.dn, connection.scopeBase)
+                        self._attributes = entries[0][1]
+                    else:
+                        # The super root doesn't have any attributes
+                        self._attributes = {}
+        return self._attributes
+
+    async def getRelativeChildren (self):
+        if self._children is None:
+            async with self._locked ():
+                if self._children is None:
+                    await self._populateChildren ()
+        return self._children
+
+    async def getChildren (self):
+        return list ((await self.getRelativeChildren ()).values ())
+
+    async def _populateChildren (self):
+        children = {}
+        if self.dn:
+            for dn, attributes in await self.con.search (self.dn, connection.scopeOneLevel):
+                children[_rdn (dn)] = (dn, attributes)
+        else:
+            # The children of the super root are the roots
+            for root in await self.con.roots ():
+                children[root] = (root, None)
+
+        # Reuse the nodes we already know of, to keep the tree consistent
+        for key, (dn, attributes) in children.items ():
+            node = self._partialChildren.get (key)
+            if node is None:
+                node = self._child (dn, attributes)
+            elif attributes is not None:
+                node._attributes = attributes
+            children[key] = node
+
+        self._children = children
+        self._partialChildren = {}
+        logger.debug ("Populated DN=[%s] with children: %s" % (self.dn, list (children.keys ())))
+
+    async def setAttribute (self, attribute, newValue = None, oldValue = None):
+        await self.getAttributes ()
+        oldAttrs, newAttrs, newValues = _modification (self, attribute, newValue, oldValue)
+        attributes = await self.con.modify (self.dn, oldAttrs, newAttrs)
+        if attributes is not None:
+            # As the server has it, rather than our idea of it
+            self._attributes = attributes
+        else:
+            _applyModification (self._attributes, attribute, newValue, oldValue, newValues)
+
+    async def delete (self):
+        try:
+            children = await self.getChildren ()
+        except exceptions.NoSuchObject:
+            return
+
+        # The children (and their subtrees) are deleted at the same time
+        await asyncio.gather (*[child.delete () for child in children])
+
+        try:
+            await self.con.delete (self.dn)
+        except exceptions.NoSuchObject:
+            logger.warning ("Trying to delete non-existent Node: %s" % self.dn)
+
+        if self.parent:
+            key = self.relativeDN ()
+            if self.parent._children and key in self.parent._children:
+                del self.parent._children[key]
+            self.parent._partialChildren.pop (key, None)
+            self.parent._completions = {}
+
+    async def add (self, rdn, attr):
+        dn = "%s,%s" % (rdn, self.dn)
+        attributes = await self.con.add (dn, attr)
+
+        key = _rdn (dn)
+        child = self._child (dn, attributes if attributes is not None else _added (attr))
+        if self._children is not None:
+            self._children[key] = child
+        else:
+            self._partialChildren[key] = child
+        self._completions = {}
+
+    async def completeChild (self, text):
+        """Returns the relative DNs of the children starting with text, see
+        Node.completeChild"""
+        if self._children is not None:
+            return _matching (self._children.keys (), text)
+
+        rdns = _cachedCompletions (self._completions, text)
+        if rdns is None:
+            rdns = await self._searchCompletions (text)
+        return _matching (rdns, text)
+
+    async def _searchCompletions (self, text):
+        filterstr, key = _completionSearch (text)
+        results, complete = await self.con.searchLimited (self.dn,
+                connection.scopeOneLevel, filterstr,
+                attrlist = ["1.1"], sizelimit = self.completionSizeLimit)
+
+        rdns = [_rdn (dn) for dn, _ in results]
+        self._completions[key] = (rdns, complete)
+        return rdns
+
+    def _cachedChild (self, key):
+        """See Node._cachedChild"""
+        if self._children is None:
+            return self._partialChildren.get (key)
+
+        try:
+            return self._children[key]
+        except KeyError:
+            if self.dn:
+                raise exceptions.NoSuchObject ("%s,%s" % (key, self.dn))
+            else:
+                raise exceptions.NoSuchObjectInRoot (key)
+
+    async def descendant (self, keys):
+        """Returns the node reached by following the relative DNs in keys,
+        see Node.descendant"""
+        node = self
+        spliced = []
+        for key in keys:
+            child = node._cachedChild (key)
+            if child is None:
+                dn = "%s,%s" % (key, node.dn) if node.dn else key
+                try:
+                    child = node._child (dn)
+                except exceptions.DNDecodingError:
+                    raise exceptions.NoSuchObject (dn)
+                spliced.append ((node, key, child))
+            node = child
+
+        if spliced and spliced[-1][2] is node:
+            # Make sure the last node exists
+            await node.getAttributes ()
+
+        for parent, key, child in spliced:
+            parent._partialChildren[key] = child
+
+        return node
+
+    def relativeDN (self):
+        """The DN relative to the parent"""
+        dn = connection.str2dn (self.dn)
+        parent = connection.str2dn (self.parent.dn) if self.parent else []
+        return connection.dn2str (dn[:len(dn) - len(parent)])
+
+    def __str__ (self):
+        return self.dn
+
+class AsyncLdapy:
+    """The counterpart of Ldapy, browsing the directory through an
+    AsyncConnection"""
+
+    def __init__ (self, con):
+        self.connection = con
+        self._root = AsyncNode (con, "")
+        self._cwd = self._root
+
+    @property
+    def cwd (self):
+        return self._cwd.dn
+
+    async def _resolveRelativeDN (self, relDN):
+        """See Ldapy._resolveRelativeDN"""
+        roots = await self._root.getRelativeChildren ()
+        node, keys = _walk (self._root, self._cwd, relDN, roots.keys)
+        return await node.descendant (keys)
+
+    async def getAttributes (self, relDN):
+        return await (await self._resolveRelativeDN (relDN)).getAttributes ()
+
+    async def setAttribute (self, relDN, attribute, newValue = None, oldValue = None):
+        node = await self._resolveRelativeDN (relDN)
+        try:
+            await node.setAttribute (attribute, newValue = newValue, oldValue = oldValue)
+        except NodeError as e:
+            raise SetAttributeError (e.msg)
+
+    async def delete (self, relDN):
+        node = await self._resolveRelativeDN (relDN)
+        try:
+            await node.delete ()
+        except NodeError as e:
+            raise DeleteError (e.msg)
+
+    async def children (self):
+        return list ((await self._cwd.getRelativeChildren ()).keys ())
+
+    async def changeDN (self, to):
+        self._cwd = await self._resolveRelativeDN (to)
+
+    async def goUpOneLevel (self):
+        await self.changeDN ("..")
+
+    async def completeChild (self, text):
+        head, separator, tail = text.rpartition (Ldapy._path_separator)
+        if not separator:
+            return await self._cwd.completeChild (text)
+
+        try:
+            node = await self._resolveRelativeDN (head + separator)
+        except (LdapyError, exceptions.NoSuchObject, exceptions.NoSuchObjectInRoot):
+            return []
+        return [head + separator + rdn for rdn in await node.completeChild (tail)]
+
+    async def add (self, rdn, attr):
+        await self._cwd.add (rdn, attr)
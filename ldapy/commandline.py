@@ -13,19 +13,39 @@
 # You should have received a copy of the GNU General Public License
 # along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
 
+from __future__ import print_function
 import readline
 import shlex
 import sys
+import os
+import time
+import cProfile
+import pstats
+
+try:
+    input = raw_input
+except NameError:
+    # Python 3
+    pass
 
 class Command:
     def __init__ (self, command, options = []):
         self.command = command
         self.options = options
 
+    # The number of errors printed (see error)
+    errors = 0
+
+    def error (self, message):
+        """Prints an error, which is counted (see Commandline.errorCount)"""
+        print (message)
+        self.errors += 1
+
     _syntax_error = "Syntax error!"
 
     def syntaxError (self, reason, args):
-        print Command._syntax_error, reason
+        print (Command._syntax_error, reason)
+        self.errors += 1
         self.usage (args)
 
     def __call__ (self, args):
@@ -54,23 +74,71 @@ class ExitCommand (Command):
 Exit ldapy."""
 
     def usage (self, words):
-        print ExitCommand._usage % self.name
+        print (ExitCommand._usage % self.name)
+
+def splitCommands (line):
+    """Splits a line into the commands separated by ;, leaving any quoted or
+    escaped ; alone"""
+    commands = []
+    current = []
+    quote = None
+    escaped = False
+    for c in line:
+        if escaped:
+            escaped = False
+        elif c == "\\" and quote != "'":
+            escaped = True
+        elif quote:
+            if c == quote:
+                quote = None
+        elif c in "\"'":
+            quote = c
+        elif c == ";":
+            commands.append ("".join (current))
+            current = []
+            continue
+        current.append (c)
+    commands.append ("".join (current))
+
+    return [command for command in commands if command.strip ()]
 
 class Commandline:
-    def __init__ (self, commands, prompt = "$ "):
+    def __init__ (self, commands, prompt = "$ ", interactive = True, statistics = None):
+        """Creates a command line dispatching to commands. If statistics
+        (see ldapy.statistics) is given, time and profile tells how much of
+        the time was spent waiting for the server."""
         self.prompt = prompt
-        readline.parse_and_bind('tab: complete')
-        readline.set_completer (self.complete)
-        readline.set_completer_delims (" \t")
+        self.statistics = statistics
+        if interactive:
+            readline.parse_and_bind('tab: complete')
+            readline.set_completer (self.complete)
+            readline.set_completer_delims (" \t")
         self.commands = { "exit" : ExitCommand(), "quit" : ExitCommand() }
         for cmd in commands:
             self.commands[cmd.command] = cmd
 
+        # The errors raised by the commands or reported (see report)
+        self.errors = 0
+
     def parse_and_dispatch (self, line):
         words = shlex.split (line)
         if not words:
             return False
 
+        # The prefixes measuring a command, eg: time ls
+        if words[0] == "time" and len(words) > 1:
+            return self.measure (lambda: self.dispatch (words[1:]))
+        elif words[0] == "profile" and len(words) > 1:
+            profiler = cProfile.Profile ()
+            try:
+                return self.measure (lambda: profiler.runcall (self.dispatch, words[1:]))
+            finally:
+                stats = pstats.Stats (profiler, stream = sys.stdout)
+                stats.sort_stats ("cumulative").print_stats (Commandline.profileLines)
+        else:
+            return self.dispatch (words)
+
+    def dispatch (self, words):
         cmd_name = words.pop (0)
         try:
             cmd = self.commands[cmd_name]
@@ -83,13 +151,44 @@ class Commandline:
 
     _no_such_command = "No such command: %s"
 
+    # The number of functions shown by profile
+    profileLines = 25
+
+    _timing = "real %.3fs: server %.3fs (%u round trips), client %.3fs (cpu %.3fs)"
+
+    def measure (self, function):
+        """Calls function and prints the time it took, split into the time
+        spent waiting for the server and the time spent by the client"""
+        if self.statistics:
+            roundTrips = self.statistics.totalRoundTrips
+            waited = self.statistics.totalSeconds
+
+        start = time.time ()
+        cpu = sum (os.times ()[:2])
+        try:
+            return function ()
+        finally:
+            real = time.time () - start
+            cpu = sum (os.times ()[:2]) - cpu
+            if self.statistics:
+                roundTrips = self.statistics.totalRoundTrips - roundTrips
+                waited = self.statistics.totalSeconds - waited
+            else:
+                roundTrips, waited = 0, 0.0
+            print (Commandline._timing % (real, waited, roundTrips, max (real - waited, 0.0), cpu))
+
+    # If set, the commands executed in batch mode are profiled and the
+    # profiles saved in the directory it names (one file per command, which
+    # can be read using pstats)
+    profileVariable = "LDAPY_PROFILE"
+
     def loop (self):
         while True:
            try:
-               line = raw_input (self.prompt)
+               line = input (self.prompt)
                self.parse_and_dispatch (line)
            except NoSuchCommand as e:
-               print e
+               print (e)
            except KeyboardInterrupt:
                sys.stdout.write ("\n")
                if not readline.get_line_buffer():
@@ -99,7 +198,55 @@ class Commandline:
            except ExitCommandline:
                return
            except Exception as e:
-               print e
+               print (e)
+
+    def report (self, error):
+        """Prints an error reported after the command causing it, eg by a
+        pipelined operation (see Connection.startPipelining), which is
+        counted"""
+        print (error)
+        self.errors += 1
+
+    @property
+    def errorCount (self):
+        """The number of errors raised by, printed by (see Command.error) or
+        reported (see report) for the commands, so that batch mode can tell
+        whether they all succeeded"""
+        return self.errors + sum ([cmd.errors for cmd in self.commands.values ()])
+
+    def execute (self, lines):
+        """Executes the commands in lines (eg a file) non-interactively,
+        where several commands on one line are separated by ; and lines
+        starting with # are ignored. The errors are counted, see
+        errorCount."""
+        directory = os.environ.get (Commandline.profileVariable)
+        n = 0
+        for line in lines:
+            if line.strip ().startswith ("#"):
+                continue
+
+            for command in splitCommands (line):
+                n += 1
+                try:
+                    if directory:
+                        self.profileTo (directory, n, command)
+                    else:
+                        self.parse_and_dispatch (command)
+                except NoSuchCommand as e:
+                    self.report (e)
+                except ExitCommandline:
+                    return
+                except Exception as e:
+                    self.report (e)
+
+    def profileTo (self, directory, n, command):
+        """Profiles the n:th command and saves the profile in directory"""
+        name = "".join ([c if c.isalnum () else "_" for c in command.split ()[0]])
+        profiler = cProfile.Profile ()
+        try:
+            profiler.runcall (self.parse_and_dispatch, command)
+        finally:
+            profiler.dump_stats (os.path.join (directory, "%04u-%s.prof" % (n, name)))
 
     def complete (self, text, state):
         # Check if it's the first time we are getting a call for this text,
@@ -128,7 +275,7 @@ class Commandline:
                             self.matches.append (cmd)
             else:
                 # If there's none, we populate the matches with the commands' names
-                self.matches = self.commands.keys()
+                self.matches = list (self.commands.keys())
 
             self.matches.sort ()
 
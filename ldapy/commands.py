@@ -13,9 +13,14 @@
 # You should have received a copy of the GNU General Public License
 # along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
 
-from commandline import Command
-from ldapy import Ldapy, AlreadyAtRoot
-from exceptions import NoSuchObject, NoSuchObjectInRoot
+from __future__ import print_function
+import contextlib
+from .commandline import Command
+from .ldapy import Ldapy, AlreadyAtRoot, RenameError, CopyError, ApplyError
+from .exceptions import NoSuchObject, NoSuchObjectInRoot, AlreadyExists, LdapError
+from .connection_data import ConnectionDataManagerError
+from . import connection
+from . import subtree
 
 class List (Command):
     def __init__ (self, ldapy):
@@ -30,13 +35,13 @@ class List (Command):
             self.syntaxError (List._wrong_number_of_arguments % self.name, args)
             return
 
-        print "\t".join (self.ldapy.children)
+        print ("\t".join (self.ldapy.children))
 
     _usage = """Usage: %s
 Lists children of current DN (currently: %s)."""
 
     def usage (self, words):
-        print List._usage % (self.name, self.ldapy.cwd)
+        print (List._usage % (self.name, self.ldapy.cwd))
 
 
 class ChangeDN (Command):
@@ -56,11 +61,11 @@ class ChangeDN (Command):
         try:
             self.ldapy.changeDN (args[0])
         except AlreadyAtRoot as e:
-            print e
+            self.error (e)
         except NoSuchObject as e:
-            print e
+            self.error (e)
         except NoSuchObjectInRoot as e:
-            print e
+            self.error (e)
 
     def complete (self, words):
         if len(words) <= 1:
@@ -72,10 +77,11 @@ class ChangeDN (Command):
             return []
 
     _usage = """Usage: %s relativeDN
-Changes DN to a child DN specified by relativeDN."""
+Changes DN to a child DN specified by relativeDN. Several levels can be given
+separated by /, where .. is the parent and a leading / starts from the roots."""
 
     def usage (self, words):
-        print ChangeDN._usage % self.name
+        print (ChangeDN._usage % self.name)
 
 class PrintWorkingDN (Command):
     def __init__ (self, ldapy):
@@ -90,13 +96,13 @@ class PrintWorkingDN (Command):
             self.syntaxError (PrintWorkingDN._wrong_number_of_arguments % self.name, args)
             return
 
-        print self.ldapy.cwd
+        print (self.ldapy.cwd)
 
     _usage = """Usage: %s
 Prints current DN (which currently is: %s)."""
 
     def usage (self, words):
-        print PrintWorkingDN._usage % (self.name, self.ldapy.cwd)
+        print (PrintWorkingDN._usage % (self.name, self.ldapy.cwd))
 
 class Cat (Command):
     def __init__ (self, ldapy):
@@ -115,11 +121,11 @@ class Cat (Command):
             attributes = self.ldapy.getAttributes (args[0])
             for attribute, value_list in attributes.items():
                 for value in value_list:
-                    print "%s: %s" % (attribute, value)
+                    print ("%s: %s" % (attribute, value))
         except AlreadyAtRoot as e:
-            print e
+            self.error (e)
         except NoSuchObject as e:
-            print e
+            self.error (e)
 
     def complete (self, words):
         if len(words) <= 1:
@@ -134,7 +140,7 @@ class Cat (Command):
 Prints the attributes of a DN specified by relativeDN."""
 
     def usage (self, words):
-        print Cat._usage % self.name
+        print (Cat._usage % self.name)
 
 class Modify (Command):
     def __init__ (self, ldapy):
@@ -144,7 +150,7 @@ class Modify (Command):
 
     def __call__ (self, args):
         if len(args) < 2:
-            print Modify._too_few_arguments % self.name
+            self.error (Modify._too_few_arguments % self.name)
             self.usage(args)
             return 
 
@@ -159,7 +165,7 @@ class Modify (Command):
         elif subcommand == "replace":
             self.replace (rdn, subArgs)
         else:
-            print Modify._unknown_subcommand % subcommand
+            self.error (Modify._unknown_subcommand % subcommand)
             self.usage (args)
     
     def complete (self, words):
@@ -185,11 +191,11 @@ Subcommands:
 """
 
     def usage (self, words):
-        print Modify._usage % self.name
+        print (Modify._usage % self.name)
 
     def add (self, rdn,  args):
         if len(args) != 2:
-            print Modify._wrong_number_of_arguments_to_subcommand % (self.name, "add")
+            self.error (Modify._wrong_number_of_arguments_to_subcommand % (self.name, "add"))
             self.usage (args)
             return
 
@@ -200,11 +206,11 @@ Subcommands:
             self.ldapy.setAttribute (rdn, attribute,
                     newValue = newValue, oldValue = None)
         except NoSuchObject as e:
-            print e
+            self.error (e)
 
     def delete (self, rdn, args):
         if len(args) != 2:
-            print Modify._wrong_number_of_arguments_to_subcommand % (self.name, "delete")
+            self.error (Modify._wrong_number_of_arguments_to_subcommand % (self.name, "delete"))
             self.usage (args)
             return
 
@@ -215,11 +221,11 @@ Subcommands:
             self.ldapy.setAttribute (rdn, attribute,
                     oldValue = oldValue, newValue = None)
         except NoSuchObject as e:
-            print e
+            self.error (e)
 
     def replace (self, rdn, args):
         if len(args) != 3:
-            print Modify._wrong_number_of_arguments_to_subcommand % (self.name, "replace")
+            self.error (Modify._wrong_number_of_arguments_to_subcommand % (self.name, "replace"))
             self.usage (args)
             return
 
@@ -231,7 +237,7 @@ Subcommands:
             self.ldapy.setAttribute (rdn, attribute,
                     oldValue = oldValue, newValue = newValue)
         except NoSuchObject as e:
-            print e
+            self.error (e)
 
 class Delete(Command):
     def __init__ (self, ldapy):
@@ -241,7 +247,7 @@ class Delete(Command):
 
     def __call__ (self, args):
         if len(args) != 1:
-            print Delete._wrong_number_of_arguments % self.name
+            self.error (Delete._wrong_number_of_arguments % self.name)
             self.usage (args)
             return
 
@@ -249,7 +255,7 @@ class Delete(Command):
         try:
             self.ldapy.delete (relDN)
         except NoSuchObject as e:
-            print e
+            self.error (e)
 
     _wrong_number_of_arguments = "%s has to be called with only one argument."
     _usage = """Usage: %s relativeDN
@@ -258,7 +264,7 @@ will be deleted recusively as well.
 """
 
     def usage (self, words):
-        print Delete._usage % self.name
+        print (Delete._usage % self.name)
 
     def complete (self, words):
         # On the first word we complete by children
@@ -270,6 +276,269 @@ will be deleted recusively as well.
         else:
             return []
 
+class Move (Command):
+    def __init__ (self, ldapy):
+        self.name = "mv"
+        Command.__init__ (self, self.name)
+        self.ldapy = ldapy
+
+    _wrong_number_of_arguments = "%s has to be called with exactly two arguments."
+    _usage = """Usage: %s relativeDN destination
+Moves the object specified by relativeDN, along with its children, below the
+destination if it exists, otherwise to the destination's parent with the last
+relative DN of the destination as its new relative DN.
+"""
+
+    def usage (self, words):
+        print (Move._usage % self.name)
+
+    def __call__ (self, args):
+        if len(args) != 2:
+            self.error (Move._wrong_number_of_arguments % self.name)
+            self.usage (args)
+            return
+
+        try:
+            self.ldapy.move (args[0], args[1])
+        except (AlreadyAtRoot, RenameError, NoSuchObject, NoSuchObjectInRoot,
+                AlreadyExists, LdapError) as e:
+            self.error (e)
+
+    def complete (self, words):
+        # Both the object and the destination are completed by children
+        if len(words) <= 2:
+            if len(words):
+                return self.ldapy.completeChild (words[-1])
+            else:
+                return self.ldapy.children
+        else:
+            return []
+
+class Rename (Command):
+    def __init__ (self, ldapy):
+        self.name = "rename"
+        Command.__init__ (self, self.name)
+        self.ldapy = ldapy
+
+    _wrong_number_of_arguments = "%s has to be called with exactly two arguments."
+    _usage = """Usage: %s relativeDN newRDN
+Renames the object specified by relativeDN to newRDN, keeping it (and its
+children) where it is.
+"""
+
+    def usage (self, words):
+        print (Rename._usage % self.name)
+
+    def __call__ (self, args):
+        if len(args) != 2:
+            self.error (Rename._wrong_number_of_arguments % self.name)
+            self.usage (args)
+            return
+
+        try:
+            self.ldapy.rename (args[0], args[1])
+        except (AlreadyAtRoot, RenameError, NoSuchObject, NoSuchObjectInRoot,
+                AlreadyExists, LdapError) as e:
+            self.error (e)
+
+    def complete (self, words):
+        # On the first word we complete by children
+        if len(words) <= 1:
+            if len(words) == 1:
+                return self.ldapy.completeChild (words[0])
+            else:
+                return self.ldapy.children
+        else:
+            return []
+
+def _parseOptions (args, flags, options):
+    """Splits args into the flags given (among flags), the values of the
+    options given (among options, which take one value each) and the other
+    arguments. Returns None if an argument is malformed."""
+    given = set ()
+    values = {}
+    rest = []
+    words = list (args)
+    while words:
+        word = words.pop (0)
+        if word in flags:
+            given.add (word)
+        elif word in options and words and word not in values:
+            values[word] = words.pop (0)
+        elif word.startswith ("-"):
+            return None
+        else:
+            rest.append (word)
+    return given, values, rest
+
+@contextlib.contextmanager
+def _savedLdapy (ldapy, name):
+    """Yields an Ldapy on the saved connection name, which is connected to
+    and closed afterwards, or None if name is None"""
+    if name is None:
+        yield None
+        return
+
+    connectionData = ldapy.connectionDataManager.getConnection (name)
+    con = connection.connect (connectionData)
+    try:
+        yield Ldapy (con)
+    finally:
+        con.close ()
+
+class Copy (Command):
+    def __init__ (self, ldapy):
+        self.name = "cp"
+        Command.__init__ (self, self.name)
+        self.ldapy = ldapy
+
+    _wrong_arguments = "%s has to be called with two arguments, optionally preceded by -r and --to NAME."
+    _usage = """Usage: %s [-r] [--to NAME] relativeDN destination
+Copies the object specified by relativeDN below the destination if it exists,
+otherwise to the destination's parent with the last relative DN of the
+destination as its relative DN.
+  -r         copies the children as well, recursively
+  --to NAME  copies through the saved connection NAME, where the destination
+             is a path from the roots
+"""
+
+    def usage (self, words):
+        print (Copy._usage % self.name)
+
+    def parse (self, args):
+        """Returns whether to recurse, the name of the target connection (or
+        None) and the remaining arguments, None if malformed"""
+        parsed = _parseOptions (args, ["-r", "-R", "--recursive"], ["--to"])
+        if parsed is None:
+            return None
+        flags, options, rest = parsed
+        return bool (flags), options.get ("--to"), rest
+
+    def __call__ (self, args):
+        parsed = self.parse (args)
+        if parsed is None or len(parsed[2]) != 2:
+            self.error (Copy._wrong_arguments % self.name)
+            self.usage (args)
+            return
+
+        recursive, name, (relDN, destination) = parsed
+        try:
+            with _savedLdapy (self.ldapy, name) as target:
+                self.ldapy.copy (relDN, destination, target = target,
+                        recursive = recursive, errback = self.error)
+        except (AlreadyAtRoot, CopyError, NoSuchObject, NoSuchObjectInRoot,
+                LdapError, ConnectionDataManagerError, connection.ConnectionError) as e:
+            self.error (e)
+
+    def complete (self, words):
+        # Both the object and the destination are completed by children
+        parsed = self.parse (words)
+        if parsed is None or len(parsed[2]) > 2:
+            return []
+        elif parsed[2]:
+            return self.ldapy.completeChild (parsed[2][-1])
+        else:
+            return self.ldapy.children
+
+class Diff (Command):
+    def __init__ (self, ldapy):
+        self.name = "diff"
+        Command.__init__ (self, self.name)
+        self.ldapy = ldapy
+
+    _wrong_arguments = "%s has to be called with two arguments, optionally preceded by --with NAME."
+    _usage = """Usage: %s [--with NAME] relativeDN other
+Prints, as LDIF, the changes turning the subtree at relativeDN into a copy of
+the subtree at other: the entries to add, modify and delete, in an order they
+can be applied in.
+  --with NAME  reads other through the saved connection NAME, where it is a
+               path from the roots
+"""
+
+    def usage (self, words):
+        print (Diff._usage % self.name)
+
+    def __call__ (self, args):
+        parsed = _parseOptions (args, [], ["--with"])
+        if parsed is None or len(parsed[2]) != 2:
+            self.error (Diff._wrong_arguments % self.name)
+            self.usage (args)
+            return
+
+        _, options, (relDN, other) = parsed
+        try:
+            name = options.get ("--with")
+            with _savedLdapy (self.ldapy, name) as target:
+                for record in self.ldapy.diff (relDN, other, target = target):
+                    print ("\n".join (subtree.ldif (record)))
+                    print ()
+        except (AlreadyAtRoot, NoSuchObject, NoSuchObjectInRoot, LdapError,
+                ConnectionDataManagerError, connection.ConnectionError) as e:
+            self.error (e)
+
+    def complete (self, words):
+        parsed = _parseOptions (words, [], ["--with"])
+        if parsed is None or len(parsed[2]) > 2:
+            return []
+        elif parsed[2]:
+            return self.ldapy.completeChild (parsed[2][-1])
+        else:
+            return self.ldapy.children
+
+class Apply (Command):
+    def __init__ (self, ldapy):
+        self.name = "apply"
+        Command.__init__ (self, self.name)
+        self.ldapy = ldapy
+
+    _wrong_arguments = "%s has to be called with the name of an LDIF file, optionally preceded by --dry-run."
+    _usage = """Usage: %s [--dry-run] file
+Makes the subtree described by the entries of the LDIF file, whose first
+entry is the base of the subtree, look like them: the entries missing are
+added, those which differ are modified and those not in the file are
+deleted. The changes are pipelined, parents added before their children and
+children deleted before their parents.
+  -n, --dry-run  prints the changes, as LDIF, instead of making them
+"""
+    _summary = "%u adds, %u modifies and %u deletes: %u made, %u failed."
+
+    def usage (self, words):
+        print (Apply._usage % self.name)
+
+    def __call__ (self, args):
+        parsed = _parseOptions (args, ["-n", "--dry-run"], [])
+        if parsed is None or len(parsed[2]) != 1:
+            self.error (Apply._wrong_arguments % self.name)
+            self.usage (args)
+            return
+
+        flags, _, (filename,) = parsed
+        errors = []
+        def errback (e):
+            errors.append (e)
+            self.error (e)
+
+        try:
+            with open (filename) as f:
+                records = self.ldapy.apply (f, errback = errback, dryRun = bool (flags))
+        except (ApplyError, LdapError, IOError) as e:
+            self.error (e)
+            return
+
+        if flags:
+            for record in records:
+                print ("\n".join (subtree.ldif (record)))
+                print ()
+        else:
+            changetypes = [changetype for changetype, _, _ in records]
+            print (Apply._summary % (changetypes.count ("add"),
+                changetypes.count ("modify"), changetypes.count ("delete"),
+                len(records) - len(errors), len(errors)))
+
+    def complete (self, words):
+        # The file isn't completed
+        return []
+
 class Add(Command):
     def __init__ (self, ldapy):
         self.name = "add"
@@ -283,11 +552,11 @@ Adds an object with relativeDN and attributes to the current object.
     _malformed_attribute = "Malformed attribute: %s"
 
     def usage (self, words):
-        print Add._usage % self.name
+        print (Add._usage % self.name)
 
     def __call__ (self, args):
         if len(args) < 2:
-            print Add._wrong_number_of_arguments % self.name
+            self.error (Add._wrong_number_of_arguments % self.name)
             self.usage(args)
             return
 
@@ -296,7 +565,7 @@ Adds an object with relativeDN and attributes to the current object.
         for raw in args[1:]:
             pair = raw.split (":", 1)
             if len(pair) != 2:
-                print Add._malformed_attribute % raw
+                self.error (Add._malformed_attribute % raw)
                 self.usage(args)
                 return
 
@@ -305,3 +574,77 @@ Adds an object with relativeDN and attributes to the current object.
             attrs[attr] = value
 
         self.ldapy.add (rdn, attrs)
+
+class Stats (Command):
+    def __init__ (self, ldapy):
+        self.name = "stats"
+        Command.__init__ (self, self.name)
+        self.ldapy = ldapy
+
+    _wrong_arguments = "%s must be called without arguments, or with reset or log"
+    _usage = """Usage: %s [reset|log]
+Prints the number of round trips made to the server for each kind of operation,
+with the entries and bytes transferred and histograms of their latencies.
+  reset  forgets the operations made so far
+  log    prints the most recent operations"""
+
+    _scopes = {connection.scopeBase: "base", connection.scopeOneLevel: "one",
+            connection.scopeSubtree: "sub", None: "-"}
+
+    def usage (self, words):
+        print (Stats._usage % self.name)
+
+    def complete (self, words):
+        if len(words) <= 1:
+            text = words[0] if words else ""
+            return [word for word in ["reset", "log"] if word.startswith (text)]
+        else:
+            return []
+
+    def __call__ (self, args):
+        statistics = self.ldapy.connection.statistics
+        if args == ["reset"]:
+            statistics.reset ()
+        elif args == ["log"]:
+            self.printLog (statistics)
+        elif args:
+            self.syntaxError (Stats._wrong_arguments % self.name, args)
+        else:
+            self.printSummaries (statistics)
+
+    def printSummaries (self, statistics):
+        print ("%-14s %8s %8s %10s %10s %10s" % ("operation", "count",
+                "entries", "bytes", "total ms", "mean ms"))
+        summaries = sorted (statistics.summaries.values (), key = lambda s: s.operation)
+        for s in summaries:
+            print ("%-14s %8u %8u %10u %10.1f %10.2f" % (s.operation, s.count,
+                    s.entries, s.bytes, 1000 * s.seconds, 1000 * s.seconds / s.count))
+        print ("Round trips: %u" % statistics.roundTrips)
+        if statistics.cacheHits:
+            print ("Cache hits: %u" % statistics.cacheHits)
+
+        for s in summaries:
+            print ()
+            print ("%s latency:" % s.operation)
+            biggest = max (s.histogram)
+            for n, count in enumerate (s.histogram):
+                if not count:
+                    continue
+                if n < len(statistics.buckets):
+                    bucket = "<= %u ms" % statistics.buckets[n]
+                else:
+                    bucket = "> %u ms" % statistics.buckets[-1]
+                print ("  %10s %8u %s" % (bucket, count, "#" * (40 * count // biggest)))
+
+    def printLog (self, statistics):
+        for r in statistics.log:
+            print ("%-14s %-4s %6u %8u %8.2f ms  %s" % (r.operation,
+                    Stats._scopes.get (r.scope, r.scope), r.entries, r.bytes,
+                    1000 * r.seconds, r.dn))
+
+def allCommands (ldapy):
+    """The commands of the command line, operating on ldapy"""
+    return [List (ldapy), ChangeDN (ldapy), PrintWorkingDN (ldapy),
+            Cat (ldapy), Modify (ldapy), Delete (ldapy), Add (ldapy),
+            Move (ldapy), Rename (ldapy), Copy (ldapy), Diff (ldapy),
+            Apply (ldapy), Stats (ldapy)]
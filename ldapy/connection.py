@@ -15,8 +15,15 @@
 
 import ldap
 import ldap.modlist
+import ldap.filter
+import ldap.controls
+import collections
 import sys
-import exceptions
+import threading
+import time
+from . import exceptions
+from . import connection_data
+from .statistics import Statistics
 
 import logging
 logger = logging.getLogger("ldapy.%s" %  __name__)
@@ -44,93 +51,806 @@ def str2dn (string):
     except ldap.DECODING_ERROR:
         raise exceptions.DNDecodingError(string)
 
+if bytes is str:
+    # Python 2, where python-ldap gives and takes the values as str
+    def _decode (entries):
+        return entries
+
+    def _encode (attributes):
+        return attributes
+else:
+    def _decode (entries):
+        """Decodes the values of the entries received from python-ldap, which
+        are bytes, to str (binary values survive being encoded again)"""
+        decoded = []
+        for dn, attributes in entries:
+            if dn is not None:
+                attributes = dict ([(attribute, [value.decode ("utf-8", "surrogateescape")
+                    for value in values]) for attribute, values in attributes.items ()])
+            decoded.append ((dn, attributes))
+        return decoded
+
+    def _encode (attributes):
+        """Encodes the values of attributes, each a str or a list of them, to
+        the bytes python-ldap expects"""
+        return dict ([(attribute, [value.encode ("utf-8", "surrogateescape")
+            for value in (values if isinstance (values, list) else [values])])
+            for attribute, values in attributes.items ()])
+
+def _copy (entries):
+    """Copies entries, so that the callers sharing the result of a search
+    can change what they got"""
+    return [(dn, dict ([(attribute, list (values)) for attribute, values in attributes.items ()]))
+            for dn, attributes in entries]
+
+def _searchKey (dn, scope, filterstr, attrlist, *rest):
+    """The key of a search, the same for searches which are bound to give
+    the same result"""
+    return (dn.lower (), scope, filterstr,
+            tuple (sorted (attrlist)) if attrlist is not None else None) + rest
+
+def _normalize (dn):
+    """The DN as the cache knows it"""
+    try:
+        return dn2str (str2dn (dn)).lower ()
+    except exceptions.DNDecodingError:
+        return dn.lower ()
+
+def _ancestors (dn):
+    """The normalized DN followed by the DNs of its ancestors, the last
+    being the super root"""
+    try:
+        rdns = str2dn (dn)
+    except exceptions.DNDecodingError:
+        return [dn.lower ()]
+    return [dn2str (rdns[n:]).lower () for n in range (len(rdns) + 1)]
+
+class _ResultCache:
+    """Keeps the results of at most size searches for seconds, forgetting the
+    least recently used first. The results are keyed as by _searchKey, with
+    the base DN normalized."""
+
+    def __init__ (self, size, seconds):
+        self.size = size
+        self.seconds = seconds
+        self.generation = 0
+        self._results = collections.OrderedDict ()
+
+        # The keys of the results, by their base DN
+        self._bases = {}
+        self._lock = threading.Lock ()
+
+    def get (self, key):
+        with self._lock:
+            item = self._results.pop (key, None)
+            if item is None:
+                return None
+
+            expires, result = item
+            if expires < time.time ():
+                self._unindex (key)
+                return None
+
+            # Now the most recently used
+            self._results[key] = item
+            return result
+
+    def put (self, key, result, generation):
+        """Keeps result, unless something has been invalidated since
+        generation (taken before the search was sent)"""
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._results.pop (key, None)
+            self._results[key] = (time.time () + self.seconds, result)
+            self._bases.setdefault (key[0], set ()).add (key)
+
+            while len(self._results) > self.size:
+                oldest = next (iter (self._results))
+                del self._results[oldest]
+                self._unindex (oldest)
+
+    def invalidate (self, dn):
+        """Forgets the results which a change of dn (an add, modify or delete)
+        might affect: the searches based on it or its parent, and the subtree
+        searches of its other ancestors"""
+        with self._lock:
+            self.generation += 1
+            for n, base in enumerate (_ancestors (dn)):
+                for key in list (self._bases.get (base, ())):
+                    if n <= 1 or key[1] == scopeSubtree:
+                        del self._results[key]
+                        self._unindex (key)
+
+    def clear (self):
+        with self._lock:
+            self.generation += 1
+            self._results.clear ()
+            self._bases = {}
+
+    def _unindex (self, key):
+        keys = self._bases[key[0]]
+        keys.discard (key)
+        if not keys:
+            del self._bases[key[0]]
+
+class _Flight:
+    """A search in flight, which identical searches wait for instead of
+    sending their own"""
+
+    def __init__ (self):
+        self.done = threading.Event ()
+        self.waiting = 0
+        self.result = None
+        self.error = None
+
+    def wait (self):
+        self.done.wait ()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+def prefixFilter (attribute, prefix):
+    """Returns a filter matching entries where attribute starts with prefix"""
+    return "(%s=%s*)" % (attribute, ldap.filter.escape_filter_chars (prefix))
+
+class _Server:
+    """One of the servers a Connection spreads its operations over"""
+
+    def __init__ (self, uri, traces, timeout):
+        self.uri = uri
+        self.traces = traces
+        self.timeout = timeout
+        self.latency = None
+        self.bound = False
+        self.downSince = None
+        self._initialize ()
+
+    def _initialize (self):
+        self.ldap = ldap.initialize (self.uri, trace_level = self.traces, trace_file = sys.stdout)
+        if self.timeout:
+            self.ldap.set_option (ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+
+    def bind (self, who, cred):
+        self.ldap.simple_bind_s (who, cred)
+        self.bound = True
+        self.downSince = None
+
+    def markDown (self):
+        logger.warning ("Server %s is down" % self.uri)
+        self.downSince = time.time ()
+        self.bound = False
+        # A fresh LDAP object to connect with when we try it again
+        self._initialize ()
+
+    def available (self, retryInterval):
+        return self.downSince is None or \
+                time.time () - self.downSince >= retryInterval
+
+    def measure (self, seconds):
+        # An exponentially weighted moving average of the latency
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = 0.8 * self.latency + 0.2 * seconds
+
 class Connection:
-    """The class managing the LDAP connection."""
+    """The class managing the LDAP connection.
+
+    The connection can be given a list of URIs, in which case the modifying
+    operations are sent to the first one (the provider) while the reading
+    operations are spread over all of them according to the strategy:
+        failover      - the first server which is not down
+        round-robin   - the servers which are not down, in turn
+        least-latency - the server which has been the fastest to respond
+    A server found to be down is not used again until retryInterval seconds
+    have passed, when it's probed by binding to it again.
+
+    If every server is found to be down (eg when an idle connection has been
+    dropped) the connection is reestablished and the reading operations are
+    replayed, waiting exponentially longer between each attempt. Modifying
+    operations are never replayed, since it's unknown if they reached the
+    server before the connection was lost."""
 
     _connection_error_msg = "Unable to connect to %s."
     _bad_auth_error_msg = "Unable to authenticate user: %s."
     _server_unwilling = "Server unwilling to perform requested operation."
+    _unknown_strategy = "Unknown strategy: %s"
 
-    def __init__ (self, uri, traces = 0):
-        logger.info ("Connecting to %s" % uri)
-        self.uri = uri
-        self._ldap = ldap.initialize (uri, trace_level = traces, trace_file = sys.stdout)
+    strategies = connection_data.strategies
+
+    # Seconds before a server found to be down is tried again
+    retryInterval = 30
+
+    # Seconds to wait when connecting to a server, when there are other
+    # servers to fail over to
+    networkTimeout = 5
+
+    # The number of attempts at reconnecting when all servers are down, the
+    # first after reconnectDelay seconds and then doubling the delay
+    reconnectAttempts = 5
+    reconnectDelay = 0.1
+
+    # The number of search results to cache (by default none), and the
+    # number of seconds they are kept. The results are forgotten when an
+    # entry they might include is changed through this connection, but not
+    # when it's changed by others.
+    cacheSize = 0
+    cacheSeconds = 60
+
+    def __init__ (self, uri, traces = 0, strategy = None, cacheSize = None,
+            cacheSeconds = None):
+        uris = uri if isinstance (uri, list) else [uri]
+        strategy = strategy if strategy else Connection.strategies[0]
+        if strategy not in Connection.strategies:
+            raise ValueError (Connection._unknown_strategy % strategy)
+
+        logger.info ("Connecting to %s" % " ".join (uris))
+        self.uri = " ".join (uris)
+        self.uris = uris
+        self.strategy = strategy
+        timeout = Connection.networkTimeout if len(uris) > 1 else None
+        self._servers = [_Server (u, traces, timeout) for u in uris]
+        self._turn = 0
+        self._credentials = None
         self.connected = False
         self._roots = None
+        self._supportedControls = None
+        self._pipeline = None
+        self._flights = {}
+        self._flightsLock = threading.Lock ()
+        self.statistics = Statistics ()
+
+        cacheSize = Connection.cacheSize if cacheSize is None else cacheSize
+        cacheSeconds = Connection.cacheSeconds if cacheSeconds is None else cacheSeconds
+        self.cache = _ResultCache (cacheSize, cacheSeconds) if cacheSize else None
+
+    @property
+    def _ldap (self):
+        """The LDAP object of the provider"""
+        return self._servers[0].ldap
 
     def _raise_error (self, msg, exception = None):
-        if exception and hasattr(exception, "message") and exception.message.has_key ("info"):
-            raise ConnectionError (self, msg, exception.message["info"])
+        if exception and "info" in exceptions.details (exception):
+            raise ConnectionError (self, msg, exceptions.details (exception)["info"])
         else:
             raise ConnectionError (self, msg)
 
 
     def bind (self, who, cred):
+        """Binds to the first server which is up, the other servers are bound
+        when they are first used"""
+        self.flush ()
+        for server in self._servers:
+            try:
+                with self.statistics.measure ("bind", who):
+                    server.bind (who, cred)
+                break
+            except ldap.SERVER_DOWN as e:
+                server.markDown ()
+                down = e
+            except ldap.INVALID_CREDENTIALS as e:
+                self._raise_error (Connection._bad_auth_error_msg % who, e)
+            except ldap.UNWILLING_TO_PERFORM as e:
+                self._raise_error (Connection._server_unwilling, e)
+        else:
+            self._raise_error (Connection._connection_error_msg % self.uri, down)
+
+        self._credentials = (who, cred)
+        self.connected = True
+
+    def _bound (self, server):
+        """Makes sure server is bound with our credentials"""
+        if not server.bound and self._credentials:
+            server.bind (*self._credentials)
+
+    def _candidates (self):
+        """Returns the servers to try for a reading operation, in the order
+        decided by the strategy"""
+        servers = [s for s in self._servers if s.available (self.retryInterval)]
+        if not servers:
+            # Everything seems to be down, so let's try them all anyway
+            servers = list (self._servers)
+
+        if self.strategy == "round-robin":
+            n = self._turn % len(servers)
+            self._turn += 1
+            return servers[n:] + servers[:n]
+        elif self.strategy == "least-latency":
+            return sorted (servers, key = lambda s: s.latency or 0.0)
+        else:
+            return servers
+
+    def _backoff (self):
+        """Yields the number of each attempt at reconnecting, after sleeping
+        an exponentially increasing time"""
+        delay = self.reconnectDelay
+        for attempt in range (self.reconnectAttempts):
+            logger.info ("Reconnecting to %s in %.1f seconds" % (self.uri, delay))
+            time.sleep (delay)
+            yield attempt
+            delay *= 2
+
+    def _read (self, operation):
+        """Performs operation, a function taking an LDAP object, on the
+        server chosen by the strategy and fails over to the other servers if
+        it's down. If they are all down, the operation is replayed when
+        we're able to reconnect."""
+        try:
+            return self._tryRead (operation, self._candidates ())
+        except (ldap.SERVER_DOWN, ldap.TIMEOUT) as e:
+            down = e
+
+        for attempt in self._backoff ():
+            try:
+                return self._tryRead (operation, self._servers)
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT) as e:
+                down = e
+        raise down
+
+    def _tryRead (self, operation, servers):
+        for server in servers:
+            try:
+                self._bound (server)
+                start = time.time ()
+                result = operation (server.ldap)
+                server.measure (time.time () - start)
+                return result
+            except (ldap.SERVER_DOWN, ldap.TIMEOUT) as e:
+                server.markDown ()
+                down = e
+        raise down
+
+    def _writer (self):
+        """Returns the LDAP object of the provider, which all the modifying
+        operations are sent to, reconnecting to it if needed"""
+        provider = self._servers[0]
         try:
-            self._ldap.simple_bind_s (who, cred)
+            self._bound (provider)
+            return provider.ldap
         except ldap.SERVER_DOWN as e:
-            self._raise_error (Connection._connection_error_msg % self.uri, e)
-        except ldap.INVALID_CREDENTIALS as e:
-            self._raise_error (Connection._bad_auth_error_msg % who, e)
-        except ldap.UNWILLING_TO_PERFORM as e:
-            self._raise_error (Connection._server_unwilling, e)
+            provider.markDown ()
+            down = e
 
-        self.connected = True
+        # Nothing has been sent yet, so it's safe to wait for the provider
+        for attempt in self._backoff ():
+            try:
+                self._bound (provider)
+                return provider.ldap
+            except ldap.SERVER_DOWN as e:
+                provider.markDown ()
+                down = e
+        raise down
 
     @property
     def roots (self):
         if not self._roots:
-            results = self._ldap.search_s ("", ldap.SCOPE_BASE, attrlist = ["namingContexts"])
+            self.flush ()
+            with self.statistics.measure ("search", "", scopeBase) as m:
+                results = _decode (self._read (lambda l:
+                        l.search_s ("", ldap.SCOPE_BASE,
+                            attrlist = ["namingContexts", "supportedControl"])))
+                m.returned (results)
             self._roots = results[0][1]["namingContexts"]
+            self._supportedControls = results[0][1].get ("supportedControl", [])
 
             logger.debug ("Roots: %s" % self._roots)
 
         return self._roots
 
 
+    def _coalesce (self, key, operation):
+        """Performs operation (a search), unless a search with the same key
+        is already in flight in another thread, in which case we wait for it
+        and get a copy of its result"""
+        with self._flightsLock:
+            flight = self._flights.get (key)
+            if flight is None:
+                flight = self._flights[key] = _Flight ()
+                leader = True
+            else:
+                flight.waiting += 1
+                leader = False
+
+        if not leader:
+            logger.debug ("Waiting for the identical search in flight: %s" % (key,))
+            return self._share (flight.wait ())
+
+        result = None
+        try:
+            result = operation ()
+            return result
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flightsLock:
+                del self._flights[key]
+            if flight.error is None and flight.waiting:
+                flight.result = self._share (result)
+            flight.done.set ()
+
+    def _share (self, result):
+        # The waiting searches each get their own copy of a copy made
+        # before the leader returns (and might change its result)
+        if isinstance (result, tuple):
+            entries, complete = result
+            return _copy (entries), complete
+        return _copy (result)
+
+    def _cached (self, key, operation):
+        """Performs operation, a search, unless its result is cached (in which
+        case a copy is returned). Identical searches are coalesced, see
+        _coalesce."""
+        if not self.cache:
+            return self._coalesce (key, operation)
+
+        key = (_normalize (key[0]),) + key[1:]
+        result = self.cache.get (key)
+        if result is not None:
+            self.statistics.cacheHit ()
+            return self._share (result)
+
+        def search ():
+            generation = self.cache.generation
+            result = operation ()
+            self.cache.put (key, self._share (result), generation)
+            return result
+        return self._coalesce (key, search)
+
     def search (self, dn, scope, attrlist = None):
+        self.flush ()
+        return self._cached (_searchKey (dn, scope, None, attrlist),
+                lambda: self._search (dn, scope, attrlist))
+
+    def _search (self, dn, scope, attrlist):
         try:
-            return self._ldap.search_s (dn, scope, attrlist = attrlist)
+            with self.statistics.measure ("search", dn, scope) as m:
+                results = _decode (self._read (lambda l: l.search_s (dn, scope, attrlist = attrlist)))
+                m.returned (results)
+                return results
         except ldap.NO_SUCH_OBJECT as e:
             raise exceptions.NoSuchObject.convert(dn, e)
         except ldap.LDAPError as e:
             raise exceptions.LdapError (e)
 
-    def modify (self, dn, oldAttrs, newAttrs):
+    def searchLimited (self, dn, scope, filterstr, attrlist = None, sizelimit = 0):
+        """Searches for entries matching filterstr, but asks the server to
+        return at most sizelimit entries. Returns a tuple of the entries
+        received and a boolean telling if they are all the matching entries,
+        ie False if the size limit was exceeded."""
+        def limited (l):
+            results = []
+            msgid = l.search_ext (dn, scope, filterstr,
+                    attrlist = attrlist, sizelimit = sizelimit)
+            try:
+                while True:
+                    kind, entries = l.result (msgid, all = 0)
+                    if kind == ldap.RES_SEARCH_RESULT:
+                        return results, True
+                    results.extend (_decode ([entry for entry in entries if entry[0]]))
+            except ldap.SIZELIMIT_EXCEEDED:
+                logger.debug ("Size limit %u exceeded searching %s with filter %s" %
+                        (sizelimit, dn, filterstr))
+                return results, False
+
+        self.flush ()
+        return self._cached (_searchKey (dn, scope, filterstr, attrlist, sizelimit),
+                lambda: self._searchLimited (dn, scope, filterstr, limited))
+
+    def _searchLimited (self, dn, scope, filterstr, limited):
         try:
-            ldif = ldap.modlist.modifyModlist (oldAttrs, newAttrs)
-            logger.debug ("LdapModify: dn=%s, ldif:\n%s" % (dn, ldif))
-            self._ldap.modify_s (dn, ldif)
-        except ldap.UNDEFINED_TYPE as e:
-            raise exceptions.UndefinedType.convert (e)
-        except ldap.TYPE_OR_VALUE_EXISTS as e:
-            raise exceptions.TypeOrValueExists.convert (e, dn, newAttrs)
+            with self.statistics.measure ("search", dn, scope) as m:
+                results, complete = self._read (limited)
+                m.returned (results)
+                return results, complete
+        except ldap.NO_SUCH_OBJECT as e:
+            raise exceptions.NoSuchObject.convert(dn, e)
         except ldap.LDAPError as e:
             raise exceptions.LdapError (e)
 
-    def delete (self, dn):
+    def searchPaged (self, dn, scope, filterstr = "(objectClass=*)",
+            attrlist = None, pageSize = 500):
+        """Searches for entries matching filterstr using the simple paged
+        results control (RFC 2696), yielding the entries as each page of at
+        most pageSize entries arrives instead of waiting for all of them.
+
+        Since the server keeps track of the pages, all of them are asked for
+        from the same server."""
+        self.flush ()
+        server = self._candidates ()[0]
+        control = ldap.controls.SimplePagedResultsControl (True, size = pageSize, cookie = b"")
         try:
-            self._ldap.delete_s (dn)
+            self._bound (server)
+            while True:
+                with self.statistics.measure ("search (page)", dn, scope) as m:
+                    msgid = server.ldap.search_ext (dn, scope, filterstr,
+                            attrlist = attrlist, serverctrls = [control])
+                    _, entries, _, controls = server.ldap.result3 (msgid)
+                    entries = _decode ([entry for entry in entries if entry[0]])
+                    m.returned (entries)
+
+                for entry in entries:
+                    yield entry
+
+                cookies = [c.cookie for c in controls
+                        if c.controlType == control.controlType]
+                if not cookies or not cookies[0]:
+                    return
+                control.cookie = cookies[0]
         except ldap.NO_SUCH_OBJECT as e:
-            raise exceptions.NoSuchObject.convert (dn, e)
+            raise exceptions.NoSuchObject.convert(dn, e)
         except ldap.LDAPError as e:
             raise exceptions.LdapError (e)
 
+    # The OIDs of the pre-read and post-read controls (RFC 4527), which
+    # have the server return the entry as it was before or after a change
+    _preReadControl = "1.3.6.1.1.13.1"
+    _postReadControl = "1.3.6.1.1.13.2"
+
+    def _supports (self, control):
+        """Checks if the server is known to support control (which is learnt
+        along with the roots)"""
+        return bool (self._supportedControls) and control in self._supportedControls
+
+    def modify (self, dn, oldAttrs, newAttrs):
+        """Modifies the entry dn. Returns its attributes after the change, as
+        read by the server (using the post-read control) if it's known to
+        support it, otherwise None (and always when pipelining)."""
+        ldif = ldap.modlist.modifyModlist (_encode (oldAttrs), _encode (newAttrs))
+        logger.debug ("LdapModify: dn=%s, ldif:\n%s" % (dn, ldif))
+
+        postRead = self._supports (Connection._postReadControl)
+        def synchronous (l):
+            if postRead:
+                return _sendAndRead (l, dn, lambda **kwargs: l.modify_ext (dn, ldif, **kwargs))
+            l.modify_s (dn, ldif)
+
+        with self.statistics.measure ("modify", dn) as m:
+            m.sent (newAttrs)
+            return self._write (dn, synchronous,
+                    lambda l: l.modify_ext (dn, ldif),
+                    lambda e: _convertModifyError (e, dn, newAttrs))
+
+    def delete (self, dn):
+        """Deletes the entry dn. Returns its attributes before it was deleted,
+        as read by the server (using the pre-read control) if it's known to
+        support it, otherwise None (and always when pipelining)."""
+        preRead = self._supports (Connection._preReadControl)
+        def synchronous (l):
+            if preRead:
+                return _sendAndRead (l, dn, lambda **kwargs: l.delete_ext (dn, **kwargs),
+                        pre = True)
+            l.delete_s (dn)
+
+        with self.statistics.measure ("delete", dn):
+            return self._write (dn, synchronous,
+                    lambda l: l.delete_ext (dn),
+                    lambda e: _convertDeleteError (e, dn))
+
+    def rename (self, dn, newRdn, newSuperior = None):
+        """Renames the entry dn to newRdn, and moves it below newSuperior if
+        given, with one modrdn operation: its subtree goes along. The values
+        of the old RDN are removed from the entry.
+
+        It's not pipelined, since the operations which depend on it are those
+        on either of its DNs."""
+        if newSuperior is None:
+            newDN = dn2str (str2dn (newRdn) + str2dn (dn)[1:])
+        else:
+            newDN = "%s,%s" % (newRdn, newSuperior)
+
+        with self.statistics.measure ("rename", dn):
+            try:
+                self._write (dn, lambda l: l.rename_s (dn, newRdn, newSuperior, delold = 1),
+                        None, lambda e: _convertRenameError (e, dn, newDN))
+            finally:
+                # Any search below either DN might have changed
+                if self.cache:
+                    self.cache.clear ()
+
     def add (self, dn, attrs):
-        ldif = ldap.modlist.addModlist (attrs)
+        """Adds the entry dn. Returns its attributes as read back by the
+        server (using the post-read control) if it's known to support it,
+        otherwise None (and always when pipelining)."""
+        ldif = ldap.modlist.addModlist (_encode (attrs))
+
+        postRead = self._supports (Connection._postReadControl)
+        def synchronous (l):
+            if postRead:
+                return _sendAndRead (l, dn, lambda **kwargs: l.add_ext (dn, ldif, **kwargs))
+            l.add_s (dn, ldif)
+
+        with self.statistics.measure ("add", dn) as m:
+            m.sent (attrs)
+            return self._write (dn, synchronous,
+                    lambda l: l.add_ext (dn, ldif),
+                    lambda e: _convertAddError (e, dn, attrs))
+
+    def _write (self, dn, synchronous, asynchronous, convert):
+        """Performs a modifying operation on the provider, using synchronous
+        or, when pipelining, asynchronous (which should return the message id).
+        An operation without asynchronous is never pipelined, it waits for the
+        pending operations and then uses synchronous. Returns what synchronous
+        returned. Errors are converted using convert."""
+        if self.cache:
+            self.cache.invalidate (dn)
+
+        if self._pipeline is not None:
+            if asynchronous is not None:
+                return self._enqueue (dn, asynchronous, convert)
+            self.flush ()
+
         try:
-            self._ldap.add_s (dn, ldif)
-        except ldap.NO_SUCH_OBJECT as e:
-            raise exceptions.NoSuchObject.convert (dn, e)
-        except ldap.ALREADY_EXISTS as e:
-            raise exceptions.AlreadyExists.convert (dn, e)
-        except ldap.UNDEFINED_TYPE as e:
-            raise exceptions.UndefinedType.convert (e)
-        except ldap.TYPE_OR_VALUE_EXISTS as e:
-            raise exceptions.TypeOrValueExists.convert (e, dn, attrs)
+            result = synchronous (self._writer ())
+            if self.cache:
+                # Again, in case another thread read dn while it was changed
+                self.cache.invalidate (dn)
+            return result
+        except ldap.SERVER_DOWN as e:
+            # Reconnect for the next operation, but don't replay this one
+            self._servers[0].markDown ()
+            logger.warning ("Lost the connection while modifying %s, the "
+                    "modification might not have been made" % dn)
+            raise convert (e)
         except ldap.LDAPError as e:
-            raise exceptions.LdapError (e)
+            raise convert (e)
+
+    # The maximum number of operations waiting for their results when
+    # pipelining
+    pipelineDepth = 64
+
+    def startPipelining (self, errback = None):
+        """Starts pipelining the modifying operations (add, modify and delete):
+        instead of waiting for the result of each operation, it's sent to the
+        server and its result is collected when needed, ie before any search
+        or before an operation on a DN related to (the same as, or an ancestor
+        or descendant of) the DN of a pending operation.
+
+        Since the operations return before their results are known, errors are
+        instead passed to errback (logged if not given)."""
+        self.flush ()
+        self._pipeline = []
+        self._pipelineErrback = errback if errback else logger.error
+
+    def stopPipelining (self):
+        """Collects the results of the pending operations and stops
+        pipelining"""
+        self.flush ()
+        self._pipeline = None
+
+    @property
+    def pipelining (self):
+        return self._pipeline is not None
+
+    @property
+    def pipelineErrback (self):
+        """Where the errors of the pipelined operations are passed, None
+        unless pipelining"""
+        return self._pipelineErrback if self._pipeline is not None else None
+
+    def flush (self):
+        """Collects the results of the pending pipelined operations"""
+        if not self._pipeline:
+            return
+
+        pipeline, self._pipeline = self._pipeline, []
+        logger.debug ("Collecting results of %u pipelined operations" % len(pipeline))
+        lost = None
+        for _, msgid, convert in pipeline:
+            if lost:
+                # The results of the remaining operations are lost as well
+                self._pipelineErrback (convert (lost))
+                continue
+
+            try:
+                self._ldap.result (msgid, all = 1)
+            except ldap.SERVER_DOWN as e:
+                self._pipelineErrback (convert (e))
+                lost = e
+            except ldap.LDAPError as e:
+                self._pipelineErrback (convert (e))
+
+        if lost:
+            self._servers[0].markDown ()
+
+    def close (self):
+        """Collects the results of the pending pipelined operations and
+        unbinds from the servers"""
+        self.flush ()
+        for server in self._servers:
+            try:
+                server.ldap.unbind_s ()
+            except ldap.LDAPError as e:
+                logger.debug ("Failed to unbind from %s: %s" % (server.uri, e))
+            server.bound = False
+        self.connected = False
+
+    def _enqueue (self, dn, send, convert):
+        key = dn.lower ()
+        if len(self._pipeline) >= self.pipelineDepth or \
+                any ([_related (key, pending) for pending, _, _ in self._pipeline]):
+            self.flush ()
+
+        try:
+            msgid = send (self._writer ())
+        except ldap.LDAPError as e:
+            self._pipelineErrback (convert (e))
+            return
+
+        self._pipeline.append ((key, msgid, convert))
+
+def connect (connectionData):
+    """Connects and binds as described by connectionData"""
+    con = Connection (connectionData.uri, strategy = connectionData.strategy)
+    con.bind (connectionData.bind_dn, connectionData.password)
+    return con
+
+def _readControl (pre):
+    """The control asking for the entry as it was before (pre) or after a
+    change"""
+    from ldap.controls.readentry import PreReadControl, PostReadControl
+    return (PreReadControl if pre else PostReadControl) (criticality = False, attrList = ["*"])
+
+def _readEntry (dn, controls, pre):
+    """Returns the attributes of the entry dn returned in controls (the
+    response controls of an operation sent with _readControl (pre)), None if
+    it isn't there"""
+    control = _readControl (pre)
+    for c in controls or []:
+        if c.controlType == control.controlType:
+            return _decode ([(dn, c.entry)])[0][1]
+    return None
+
+def _sendAndRead (l, dn, send, pre = False):
+    """Sends a modifying operation (send takes the server controls and
+    returns the message id) asking for the entry with the pre-read or
+    post-read control, and returns its attributes (None if they weren't
+    returned)"""
+    msgid = send (serverctrls = [_readControl (pre)])
+    _, _, _, controls = l.result3 (msgid)
+    return _readEntry (dn, controls, pre)
+
+def _related (a, b):
+    """Checks if the (lower case) DNs are the same, or if one of them is an
+    ancestor of the other"""
+    return a == b or a.endswith ("," + b) or b.endswith ("," + a)
+
+def _convertModifyError (e, dn, attrs):
+    if isinstance (e, ldap.UNDEFINED_TYPE):
+        return exceptions.UndefinedType.convert (e)
+    elif isinstance (e, ldap.TYPE_OR_VALUE_EXISTS):
+        return exceptions.TypeOrValueExists.convert (e, dn, attrs)
+    else:
+        return exceptions.LdapError (e)
+
+def _convertDeleteError (e, dn):
+    if isinstance (e, ldap.NO_SUCH_OBJECT):
+        return exceptions.NoSuchObject.convert (dn, e)
+    else:
+        return exceptions.LdapError (e)
+
+def _convertRenameError (e, dn, newDN):
+    if isinstance (e, ldap.NO_SUCH_OBJECT):
+        return exceptions.NoSuchObject.convert (dn, e)
+    elif isinstance (e, ldap.ALREADY_EXISTS):
+        return exceptions.AlreadyExists.convert (newDN, e)
+    else:
+        return exceptions.LdapError (e)
+
+def _convertAddError (e, dn, attrs):
+    if isinstance (e, ldap.NO_SUCH_OBJECT):
+        return exceptions.NoSuchObject.convert (dn, e)
+    elif isinstance (e, ldap.ALREADY_EXISTS):
+        return exceptions.AlreadyExists.convert (dn, e)
+    elif isinstance (e, ldap.UNDEFINED_TYPE):
+        return exceptions.UndefinedType.convert (e)
+    elif isinstance (e, ldap.TYPE_OR_VALUE_EXISTS):
+        return exceptions.TypeOrValueExists.convert (e, dn, attrs)
+    else:
+        return exceptions.LdapError (e)
 
 
 scopeOneLevel = ldap.SCOPE_ONELEVEL
 scopeBase = ldap.SCOPE_BASE
+scopeSubtree = ldap.SCOPE_SUBTREE
@@ -14,28 +14,38 @@
 # along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import os
 import os.path
+import fcntl
+import tempfile
+import contextlib
 import logging
 logger = logging.getLogger("ldapy.%s" % __name__)
 
 
 
+# The strategies for spreading the operations over several URIs, see
+# Connection (which this module avoids importing, to not load python-ldap)
+strategies = ["failover", "round-robin", "least-latency"]
+
 class ConnectionData:
-    """A simple container for connection data, eg URI and bind DN"""
-    def __init__ (self, uri, bind_dn, password = None):
+    """A simple container for connection data, eg URI and bind DN.
+
+    The URI can also be a list of URIs, see Connection, in which case a
+    strategy for spreading the operations over them can be given."""
+    def __init__ (self, uri, bind_dn, password = None, strategy = None):
         self.uri = uri
         self.bind_dn = bind_dn
         self.password = password
+        self.strategy = strategy
 
     @staticmethod
     def load (data):
         """Converts a dictionary to a ConnectionData object"""
         try:
-            if "password" in data:
-                return ConnectionData (data["uri"], data["bind_dn"], data["password"])
-            else:
-                return ConnectionData (data["uri"], data["bind_dn"])
-        except KeyError, key:
+            return ConnectionData (data["uri"], data["bind_dn"],
+                    data.get ("password"), data.get ("strategy"))
+        except KeyError as key:
             raise SyntaxError("Syntax error parsing connection data: no %s field" % key)
 
     def save (self):
@@ -45,16 +55,31 @@ class ConnectionData:
         if self.password:
             data["password"] = self.password
 
+        if self.strategy:
+            data["strategy"] = self.strategy
+
         return data
 
     def __eq__ (self, other):
         return isinstance(other, self.__class__) and \
                 self.uri == other.uri and \
                 self.bind_dn == other.bind_dn and \
-                self.password == other.password
+                self.password == other.password and \
+                self.strategy == other.strategy
+
+    def __ne__ (self, other):
+        return not self == other
 
     def __str__ (self):
-        return "%s, %s" % (self.uri, self.bind_dn)
+        if isinstance (self.uri, list):
+            uri = " ".join (self.uri)
+        else:
+            uri = self.uri
+
+        if self.strategy:
+            return "%s (%s), %s" % (uri, self.strategy, self.bind_dn)
+        else:
+            return "%s, %s" % (uri, self.bind_dn)
 
 
 class ConnectionDataManagerError (Exception):
@@ -86,37 +111,209 @@ def _filename (variable):
 
 class ConnectionDataManager:
     """A class for managing ConnectionData items for recent and saved
-    connections"""
+    connections.
+
+    The connections are stored in the file specified by filename, while the
+    changes are appended to a log (filename + ".log"), which is compacted
+    into the file once it has grown larger than compactSize bytes. The
+    file is replaced atomically when written, and the processes using it
+    take turns by locking filename + ".lock".
+
+    The files are parsed when the connections are first needed, except for
+    the most recent connection which is read from the end of the log (where
+    it is kept also when the log is compacted)."""
 
     variable = "LDAPY_HISTORY"
     filename = _filename(variable)
 
+    # The number of recent connections remembered
+    maxRecent = 100
+
+    # The size in bytes of the log which causes it to be compacted
+    compactSize = 32 * 1024
+
+    # The size of the blocks in which the log is read backwards
+    blockSize = 4096
+
     def __init__ (self):
-        """Initializes the ConnectionDataManager, by parsing the file
-        containing the recent and saved connections"""
+        """Initializes the ConnectionDataManager, which parses the file
+        containing the recent and saved connections when they are needed"""
+        self._lazyState = None
 
-        self.recent, self.saved = ConnectionDataManager._readAndParseFile()
+    def _state (self):
+        if self._lazyState is None:
+            self._lazyState = ConnectionDataManager._readAndParseFile()
+        return self._lazyState
+
+    @property
+    def recent (self):
+        return self._state ()[0]
+
+    @property
+    def saved (self):
+        return self._state ()[1]
+
+    @staticmethod
+    def _logFilename ():
+        return ConnectionDataManager.filename + ".log"
+
+    @staticmethod
+    @contextlib.contextmanager
+    def _locked (operation):
+        """Holds a lock (fcntl.LOCK_SH or LOCK_EX) on the lock file during
+        the with statement, or goes on without it if it can't be created"""
+        try:
+            fd = os.open (ConnectionDataManager.filename + ".lock",
+                    os.O_RDWR | os.O_CREAT, 0o600)
+        except OSError as e:
+            logger.info ("Unable to create lock file: %s" % e)
+            yield
+            return
+
+        try:
+            fcntl.flock (fd, operation)
+            yield
+        finally:
+            os.close (fd)
 
     @staticmethod
     def _readAndParseFile ():
-        """Parses the file specified by ConnectionDataManager.filename and
-        returns a tuple:
+        """Parses the file specified by ConnectionDataManager.filename,
+        applies the changes in the log, and returns a tuple:
             (list of recent connections, dictionary of saved connections)"""
+        with ConnectionDataManager._locked (fcntl.LOCK_SH):
+            return ConnectionDataManager._readState ()
+
+    @staticmethod
+    def _readState ():
         try:
             with open(ConnectionDataManager.filename, "r") as f:
                 raw = f.read()
-                return ConnectionDataManager._parse(raw)
+                recent, saved = ConnectionDataManager._parse(raw)
         except IOError as e:
             logger.info("Error opening file %s: %s" %
                     (ConnectionDataManager.filename, e))
-            return [], {}
-    
+            recent, saved = [], {}
+
+        ConnectionDataManager._replayLog (recent, saved)
+        return recent, saved
+
+    @staticmethod
+    def _replayLog (recent, saved):
+        """Applies the changes in the log to recent and saved"""
+        try:
+            with open(ConnectionDataManager._logFilename (), "r") as f:
+                for line in f:
+                    try:
+                        ConnectionDataManager._apply (recent, saved, json.loads (line))
+                    except (ValueError, SyntaxError) as e:
+                        # Eg a line only partially written when interrupted
+                        logger.warning ("Skipping malformed line in %s: %s" %
+                                (ConnectionDataManager._logFilename (), e))
+        except IOError as e:
+            logger.debug ("No log to replay: %s" % e)
+
+    @staticmethod
+    def _readLatest ():
+        """Returns the last recent connection recorded in the log, or None if
+        there is none"""
+        with ConnectionDataManager._locked (fcntl.LOCK_SH):
+            try:
+                with open(ConnectionDataManager._logFilename (), "rb") as f:
+                    for line in ConnectionDataManager._reversedLines (f):
+                        try:
+                            change = json.loads (line.decode ("utf-8"))
+                            if "recent" in change:
+                                return ConnectionData.load (change["recent"])
+                        except (ValueError, SyntaxError, TypeError):
+                            continue
+            except IOError as e:
+                logger.debug ("No log to read: %s" % e)
+        return None
+
+    @staticmethod
+    def _reversedLines (f):
+        """Yields the lines of f, last line first, reading it from the end
+        one block at a time"""
+        f.seek (0, os.SEEK_END)
+        position = f.tell ()
+        rest = b""
+        while position > 0:
+            n = min (ConnectionDataManager.blockSize, position)
+            position -= n
+            f.seek (position)
+            lines = (f.read (n) + rest).split (b"\n")
+            rest = lines.pop (0)
+            for line in reversed (lines):
+                if line:
+                    yield line
+        if rest:
+            yield rest
+
+    @staticmethod
+    def _apply (recent, saved, change):
+        """Applies a change, as recorded in the log, to recent and saved"""
+        if "recent" in change:
+            ConnectionDataManager._addRecent (recent, ConnectionData.load (change["recent"]))
+        elif "save" in change:
+            saved[change["save"]] = ConnectionData.load (change["data"])
+        elif "remove" in change:
+            saved.pop (change["remove"], None)
+        else:
+            raise SyntaxError ("Syntax error: unknown change: %s" % change)
+
+    @staticmethod
+    def _addRecent (recent, connectionData):
+        """Puts connectionData first among the recent connections, without
+        keeping any earlier occurrences of it"""
+        recent[:] = [connectionData] + [r for r in recent if r != connectionData]
+        del recent[ConnectionDataManager.maxRecent:]
+
+    def _record (self, change):
+        """Appends the change to the log, and compacts the log if it has
+        grown too large"""
+        line = ConnectionDataManager._line (change)
+        with ConnectionDataManager._locked (fcntl.LOCK_EX):
+            fd = os.open (ConnectionDataManager._logFilename (),
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+            try:
+                os.write (fd, line.encode ("utf-8"))
+                size = os.fstat (fd).st_size
+            finally:
+                os.close (fd)
+
+            if size > ConnectionDataManager.compactSize:
+                self._compact ()
+
+    @staticmethod
+    def _line (change):
+        return json.dumps (change, sort_keys=True, separators=(',', ':')) + "\n"
+
+    def _compact (self):
+        """Writes the current state, including the changes made by other
+        processes, to the file and empties the log, except for the most
+        recent connection (the lock must be held)"""
+        logger.info ("Compacting %s" % ConnectionDataManager._logFilename ())
+        self._lazyState = ConnectionDataManager._readState ()
+        self._unparseAndSaveFile ()
+        with open (ConnectionDataManager._logFilename (), "w") as f:
+            if self.recent:
+                f.write (ConnectionDataManager._line ({"recent": self.recent[0].save ()}))
+
     def _unparseAndSaveFile (self):
         """Unparses the data and saves it to the file specified by
-        ConnectionDataManager.filename"""
-        with open(ConnectionDataManager.filename, "w") as f:
-            raw = ConnectionDataManager._unparse (self.recent, self.saved)
-            f.write (raw)
+        ConnectionDataManager.filename, by writing a temporary file which
+        then replaces it"""
+        directory, name = os.path.split (ConnectionDataManager.filename)
+        fd, temporary = tempfile.mkstemp (prefix = name + ".", dir = directory or ".")
+        try:
+            with os.fdopen (fd, "w") as f:
+                raw = ConnectionDataManager._unparse (self.recent, self.saved)
+                f.write (raw)
+            os.rename (temporary, ConnectionDataManager.filename)
+        except:
+            os.remove (temporary)
+            raise
 
     @staticmethod
     def _parse (raw):
@@ -146,11 +343,11 @@ class ConnectionDataManager:
                 raise SyntaxError("Syntax error: saved element should be a dictionary")
 
             saved = {}
-            for name, data in rawSaved.iteritems():
+            for name, data in rawSaved.items():
                 saved[name] = ConnectionData.load(data)
 
             return (recent, saved)
-        except KeyError, key:
+        except KeyError as key:
             raise SyntaxError("Syntax error parsing connection data: no %s field" % key)
 
     @staticmethod
@@ -165,7 +362,7 @@ class ConnectionDataManager:
 
         recentList = [r.save() for r in recent]
         savedDict = {}
-        for k, s in saved.iteritems():
+        for k, s in saved.items():
             savedDict[k] = s.save()
 
         return json.dumps (
@@ -177,11 +374,17 @@ class ConnectionDataManager:
 
     def addRecentConnection (self, connectionData):
         """Saves a connection to the history of recent connections"""
-        self.recent.insert(0, connectionData)
-        self._unparseAndSaveFile ()
+        if self._lazyState is not None:
+            ConnectionDataManager._addRecent (self.recent, connectionData)
+        self._record ({"recent": connectionData.save ()})
 
     def getRecentConnection (self, N = 0):
         """Retrieves the N:th connection in the history"""
+        if N == 0 and self._lazyState is None:
+            latest = ConnectionDataManager._readLatest ()
+            if latest is not None:
+                return latest
+
         try:
             return self.recent[N]
         except IndexError:
@@ -199,15 +402,15 @@ class ConnectionDataManager:
     def saveConnection (self, name, connectionData):
         """Saves a connection to be retrieved by the specified name"""
         self.saved[name] = connectionData
-        self._unparseAndSaveFile ()
+        self._record ({"save": name, "data": connectionData.save ()})
     
     def removeConnection (self, name):
         """Removes a previously saved connection by the specified name"""
         try:
             del self.saved[name]
-            self._unparseAndSaveFile ()
         except KeyError:
             raise NoSuchSavedConnection (name)
+        self._record ({"remove": name})
 
     def getConnection (self, name):
         """Retrieves the connection with the specified name"""
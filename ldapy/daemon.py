@@ -0,0 +1,275 @@
+# This file is part of ldapy.
+#
+# ldapy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ldapy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
+
+# A daemon keeping bound connections (and the nodes read through them)
+# between invocations of ldapy, which forwards its commands to the daemon
+# when given --daemon. The daemon is started by the first such invocation
+# and exits after being idle for a while.
+#
+# The daemon listens on a Unix socket, by default ~/.ldapy_daemon (or the
+# path in LDAPY_DAEMON), only accessible by the user. Each request is one
+# line of JSON:
+#    {"connection": <ConnectionData.save ()>, "commands": [<lines>]}
+# answered by one line of JSON:
+#    {"output": <what the commands printed>, "status": <the exit status>}
+# or {"error": <why the connection failed>}.
+
+from __future__ import print_function
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from .connection_data import ConnectionData
+
+try:
+    import SocketServer as socketserver
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    import socketserver
+    from io import StringIO
+
+import logging
+logger = logging.getLogger("ldapy.%s" % __name__)
+
+variable = "LDAPY_DAEMON"
+
+def socketPath ():
+    return os.path.expanduser (os.environ.get (variable, "~/.ldapy_daemon"))
+
+def _key (connectionData):
+    return json.dumps (connectionData.save (), sort_keys = True)
+
+def _connect (connectionData):
+    from . import connection
+    return connection.connect (connectionData)
+
+class _Pooled:
+    """A bound connection, and the Ldapy browsing through it"""
+
+    def __init__ (self, con):
+        self.connection = con
+        self.refresh ()
+
+    def refresh (self):
+        from .ldapy import Ldapy
+        self.ldapy = Ldapy (self.connection)
+        self.created = time.time ()
+
+class _Handler (socketserver.StreamRequestHandler):
+    def handle (self):
+        line = self.rfile.readline ()
+        if not line:
+            # Eg a client checking if the daemon is running
+            return
+
+        try:
+            request = json.loads (line.decode ("utf-8"))
+            response = self.server.daemon.handle (request)
+        except Exception as e:
+            logger.error ("Failed request: %s" % e)
+            response = {"error": str(e)}
+
+        self.wfile.write ((json.dumps (response) + "\n").encode ("utf-8"))
+
+class _Server (socketserver.UnixStreamServer):
+    def handle_timeout (self):
+        self.daemon.idle = True
+
+class Daemon:
+    """Serves the requests of the clients, one at a time, using a pool of
+    bound connections.
+
+    The nodes, with the attributes and children they have read, are kept
+    for cacheSeconds, after which the next request starts over with a new
+    Ldapy on the same connection (since the directory might have been
+    changed by others in the meantime)."""
+
+    # The number of seconds the nodes are kept
+    cacheSeconds = 10
+
+    # The number of seconds without requests after which the daemon exits
+    idleSeconds = 600
+
+    def __init__ (self, path = None, connect = _connect):
+        self.path = path or socketPath ()
+        self.connect = connect
+        self.pool = {}
+        self.idle = False
+
+    def pooled (self, connectionData):
+        key = _key (connectionData)
+        if key not in self.pool:
+            logger.info ("Connecting to %s" % connectionData)
+            self.pool[key] = _Pooled (self.connect (connectionData))
+        elif time.time () - self.pool[key].created > self.cacheSeconds:
+            self.pool[key].refresh ()
+        return self.pool[key]
+
+    def handle (self, request):
+        """Executes the commands of the request, returning what they
+        printed and the exit status of batch mode (non-zero if any of them
+        failed)"""
+        from .commandline import Commandline
+        from .commands import allCommands
+        from . import connection
+        try:
+            pooled = self.pooled (ConnectionData.load (request["connection"]))
+        except connection.ConnectionError as e:
+            return {"error": str(e)}
+
+        ldapy = pooled.ldapy
+        ldapy.changeDN ("/")
+
+        output = StringIO ()
+        stdout, sys.stdout = sys.stdout, output
+        try:
+            cli = Commandline (allCommands (ldapy), interactive = False,
+                    statistics = ldapy.connection.statistics)
+            ldapy.startPipelining (cli.report)
+            try:
+                cli.execute (request["commands"])
+            finally:
+                ldapy.stopPipelining ()
+        finally:
+            sys.stdout = stdout
+
+        return {"output": output.getvalue (),
+                "status": 1 if cli.errorCount else 0}
+
+    def serve (self):
+        """Serves the requests until idle for idleSeconds"""
+        if os.path.exists (self.path):
+            os.remove (self.path)
+
+        umask = os.umask (0o077)
+        try:
+            server = _Server (self.path, _Handler)
+        finally:
+            os.umask (umask)
+
+        server.daemon = self
+        server.timeout = self.idleSeconds
+        logger.info ("Serving on %s" % self.path)
+        try:
+            while not self.idle:
+                server.handle_request ()
+        finally:
+            server.server_close ()
+            os.remove (self.path)
+
+@contextlib.contextmanager
+def _exclusive (path):
+    """Yields whether the lock on path was taken, ie if no other daemon
+    uses it"""
+    fd = os.open (path, os.O_RDWR | os.O_CREAT, 0o600)
+    try:
+        fcntl.flock (fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        os.close (fd)
+        yield False
+        return
+
+    try:
+        yield True
+    finally:
+        os.close (fd)
+
+def main (path = None):
+    path = path or socketPath ()
+    handler = logging.FileHandler (path + ".log")
+    handler.setFormatter (logging.Formatter("%(asctime)s %(levelname)s:%(name)s: %(message)s"))
+    logging.getLogger ("ldapy").addHandler (handler)
+    logging.getLogger ("ldapy").setLevel (logging.INFO)
+
+    with _exclusive (path + ".lock") as taken:
+        if taken:
+            Daemon (path).serve ()
+
+class Client:
+    """Forwards commands to the daemon, starting it if it isn't running"""
+
+    # The number of seconds to wait for a started daemon to listen
+    startSeconds = 5.0
+
+    def __init__ (self, path = None):
+        self.path = path or socketPath ()
+
+    def _connect (self):
+        s = socket.socket (socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            s.connect (self.path)
+            return s
+        except:
+            s.close ()
+            raise
+
+    def _start (self):
+        logger.info ("Starting the daemon on %s" % self.path)
+        with open (os.devnull, "r+") as devnull:
+            subprocess.Popen ([sys.executable, "-c",
+                "import ldapy.daemon, sys; ldapy.daemon.main (sys.argv[1])", self.path],
+                stdin = devnull, stdout = devnull, stderr = devnull,
+                close_fds = True, preexec_fn = os.setsid)
+
+    def connect (self):
+        try:
+            return self._connect ()
+        except socket.error as e:
+            if e.errno not in (errno.ENOENT, errno.ECONNREFUSED):
+                raise
+        self._start ()
+
+        deadline = time.time () + Client.startSeconds
+        delay = 0.01
+        while True:
+            try:
+                return self._connect ()
+            except socket.error:
+                if time.time () > deadline:
+                    raise
+                time.sleep (delay)
+                delay = min (2 * delay, 0.5)
+
+    def request (self, connectionData, lines):
+        """Sends the commands in lines to be executed using connectionData,
+        and returns the response"""
+        s = self.connect ()
+        try:
+            f = s.makefile ("rw")
+            f.write (json.dumps ({"connection": connectionData.save (),
+                "commands": list (lines)}) + "\n")
+            f.flush ()
+            return json.loads (f.readline ())
+        finally:
+            s.close ()
+
+    def forward (self, ldapy, lines):
+        """Executes the commands in lines in the daemon, using the connection
+        given by the arguments of ldapy. Returns the exit status."""
+        response = self.request (ldapy.connectionData, lines)
+        if "error" in response:
+            logger.critical (response["error"])
+            return 1
+
+        sys.stdout.write (response["output"])
+        if ldapy.newConnection:
+            ldapy.connectionDataManager.addRecentConnection (ldapy.connectionData)
+        return response["status"]
@@ -13,6 +13,13 @@
 # You should have received a copy of the GNU General Public License
 # along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
 
+def details (exception):
+    """Returns the dictionary python-ldap gives its exceptions (with eg desc,
+    info and matched), or an empty dictionary if there is none"""
+    if exception.args and isinstance (exception.args[0], dict):
+        return exception.args[0]
+    return {}
+
 class LdapError (Exception):
     def __init__ (self, exception):
         self.exception = exception
@@ -28,8 +35,7 @@ class NoSuchObject (Exception):
     @staticmethod
     def convert (dn, exception):
         e = NoSuchObject (dn)
-        if "matched" in exception.message:
-            e.matched = exception.message["matched"]
+        e.matched = details (exception).get ("matched")
         return e
 
     _dn_does_not_exist = "DN does not exits: %s"
@@ -54,6 +60,11 @@ class AlreadyExists (Exception):
     def convert (dn, exception):
         return AlreadyExists (dn)
 
+    _dn_already_exists = "DN already exists: %s"
+
+    def __str__ (self):
+        return self._dn_already_exists % self.dn
+
 class UndefinedType (Exception):
     def __init__ (self, info):
         self.info = info
@@ -63,7 +74,7 @@ class UndefinedType (Exception):
 
     @staticmethod
     def convert (exception):
-        return UndefinedType (exception.message["info"])
+        return UndefinedType (details (exception).get ("info"))
 
 class TypeOrValueExists (Exception):
     def __init__ (self, dn, attributes):
@@ -13,13 +13,17 @@
 # You should have received a copy of the GNU General Public License
 # along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
 
-from node import Node, NodeError
+from __future__ import print_function
 import argparse
-import ldapurl
-import connection
-import exceptions
+from . import exceptions
+from . import tracing
 import sys
-from connection_data import ConnectionData, ConnectionDataManager, ConnectionDataManagerError
+import threading
+from .connection_data import ConnectionData, ConnectionDataManager, ConnectionDataManagerError, strategies
+
+# The modules depending on python-ldap (connection and node) are imported
+# when needed, so that the arguments which don't need a connection (eg
+# --previous and --help) are handled without loading python-ldap
 
 import logging
 logger = logging.getLogger("ldapy.%s" % __name__)
@@ -43,17 +47,117 @@ class DeleteError (LdapyError):
     def __init__ (self, msg):
         self.msg = msg
 
+class RenameError (LdapyError):
+    def __init__ (self, msg):
+        self.msg = msg
+
+class CopyError (LdapyError):
+    def __init__ (self, msg):
+        self.msg = msg
+
+class ApplyError (LdapyError):
+    def __init__ (self, msg):
+        self.msg = msg
+
+def _walk (root, cwd, relDN, roots):
+    """Walks a path (see Ldapy._resolveRelativeDN) as far as possible without
+    asking the server, returning the node reached and the relative DNs to
+    follow from it. roots is called for the relative DNs of the roots if the
+    path starts from the super root."""
+    if relDN.startswith (Ldapy._path_separator):
+        node = root
+    else:
+        node = cwd
+
+    keys = []
+    for component in relDN.split (Ldapy._path_separator):
+        if component in ("", "."):
+            continue
+        elif component == "..":
+            if keys:
+                keys.pop ()
+            elif node.parent:
+                node = node.parent
+            else:
+                raise AlreadyAtRoot ()
+        elif node.dn or keys:
+            keys.extend (_splitComponent (component))
+        else:
+            keys.extend (_splitComponent (component, roots ()))
+
+    return node, keys
+
+def _splitComponent (component, roots = None):
+    """Splits a path component, which might be a DN consisting of several
+    RDNs, into the relative DNs of each level. roots are the relative DNs of
+    the roots if the component is below the super root."""
+    from . import connection
+    try:
+        dn = connection.str2dn (component)
+    except exceptions.DNDecodingError:
+        return [component]
+
+    rdns = [connection.dn2str ([rdn]) for rdn in reversed (dn)]
+    if roots is None:
+        return rdns
+
+    # The children of the super root are the roots, which might consist
+    # of several RDNs
+    for root in roots:
+        rootDN = connection.str2dn (root)
+        if len(rootDN) <= len(dn) and dn[len(dn) - len(rootDN):] == rootDN:
+            return [root] + rdns[len(rootDN):]
+    return [component]
+
+def _sameServer (a, b):
+    """Checks if the connections a and b might be to the same server, ie if
+    they are the same or share a URI"""
+    if a is b:
+        return True
+    uris = lambda con: set ([uri.lower ().rstrip ("/") for uri in getattr (con, "uris", [])])
+    return bool (uris (a) & uris (b))
+
+class _Session:
+    """Where in the tree a user of Ldapy is"""
+
+    def __init__ (self, cwd):
+        self.cwd = cwd
+
+class _ThreadSession (threading.local):
+    """A _Session of its own for each thread, starting at the same node"""
+
+    def __init__ (self, cwd):
+        self.cwd = cwd
+
 class Ldapy:
-    def __init__ (self, con = None):
+    """Browses the directory, keeping track of the current node.
+
+    A synchronized Ldapy can be used by several threads at once (given a
+    connection which can, ie not pipelining): they share the nodes read
+    (see Node) but each thread has its own current node, starting at the
+    super root."""
+
+    def __init__ (self, con = None, synchronized = False):
         self._lazyConnectionDataManager = None
+        self.args = None
 
         if con:
             self.connection = con
         else:
             connectionData, newConnection = self.parseArguments ()
 
+            if self.args.daemon:
+                # The commands are forwarded to the daemon, which connects
+                # (see ldapy.daemon)
+                self.connectionData = connectionData
+                self.newConnection = newConnection
+                self.connection = None
+                return
+
+            from . import connection
             try:
-                self.connection = connection.Connection (connectionData.uri)
+                self.connection = connection.Connection (connectionData.uri,
+                        strategy = connectionData.strategy)
                 self.connection.bind (connectionData.bind_dn,
                                       connectionData.password)
 
@@ -64,7 +168,16 @@ class Ldapy:
                 logger.critical (e)
                 sys.exit (1)
 
-        self._cwd = Node (self.connection, "")
+        from .node import Node
+        self._root = Node (self.connection, "", synchronized = synchronized)
+        if synchronized:
+            self._session = _ThreadSession (self._root)
+        else:
+            self._session = _Session (self._root)
+
+    @property
+    def _cwd (self):
+        return self._session.cwd
 
     @property
     def connectionDataManager (self):
@@ -80,54 +193,221 @@ class Ldapy:
     def attributes (self):
         return self._cwd.attributes
 
+    _path_separator = "/"
+
     def _resolveRelativeDN (self, relDN):
-        if relDN == ".":
-            return self._cwd
-        elif relDN == "..":
-            if self._cwd.parent:
-                return self._cwd.parent
-            else:
-                raise AlreadyAtRoot ()
-        else:
-            try:
-                return self._cwd.relativeChildren[relDN]
-            except KeyError:
-                if self.cwd:
-                    raise exceptions.NoSuchObject ("%s,%s" % (relDN, self.cwd))
-                else:
-                    raise exceptions.NoSuchObjectInRoot (relDN)
+        """Resolves a path of relative DNs separated by /, where . is the
+        current DN, .. is the parent and a leading / starts from the super
+        root. Only the target is looked up on the server, see Node.descendant."""
+        node, keys = _walk (self._root, self._cwd, relDN,
+                lambda: self._root.relativeChildren.keys ())
+        return node.descendant (keys)
 
     def getAttributes (self, relDN):
-        return self._resolveRelativeDN (relDN).attributes
+        with tracing.span ("Ldapy.getAttributes", path = relDN):
+            return self._resolveRelativeDN (relDN).attributes
 
     def setAttribute (self, relDN, attribute, newValue = None, oldValue = None):
-        try:
-            return self._resolveRelativeDN (relDN).setAttribute (attribute,
-                    newValue = newValue, oldValue = oldValue)
-        except NodeError as e:
-            raise SetAttributeError (e.msg)
+        from .node import NodeError
+        with tracing.span ("Ldapy.setAttribute", path = relDN, attribute = attribute):
+            try:
+                return self._resolveRelativeDN (relDN).setAttribute (attribute,
+                        newValue = newValue, oldValue = oldValue)
+            except NodeError as e:
+                raise SetAttributeError (e.msg)
 
     def delete (self, relDN):
+        from .node import NodeError
+        with tracing.span ("Ldapy.delete", path = relDN):
+            try:
+                self._resolveRelativeDN (relDN).delete ()
+            except NodeError as e:
+                raise DeleteError (e.msg)
+
+    def rename (self, relDN, newRdn):
+        """Renames the node at relDN to newRdn, keeping it where it is"""
+        from .node import NodeError
+        with tracing.span ("Ldapy.rename", path = relDN, rdn = newRdn):
+            try:
+                self._resolveRelativeDN (relDN).rename (newRdn)
+            except NodeError as e:
+                raise RenameError (e.msg)
+
+    def _destination (self, to, rdn):
+        """Figures out where mv and cp put a node with the relative DN rdn:
+        below the node at the path to if it exists, otherwise below the
+        parent of to with the last relative DN of to. Returns the parent and
+        the relative DN."""
         try:
-            self._resolveRelativeDN (relDN).delete ()
-        except NodeError as e:
-            raise DeleteError (e.msg)
+            return self._resolveRelativeDN (to), rdn
+        except (exceptions.NoSuchObject, exceptions.NoSuchObjectInRoot):
+            parent, keys = _walk (self._root, self._cwd, to,
+                    lambda: self._root.relativeChildren.keys ())
+            return parent.descendant (keys[:-1]), keys[-1]
+
+    def move (self, relDN, to):
+        """Moves the node at relDN (with its subtree) like mv, see
+        _destination"""
+        from .node import NodeError, _rdn
+        with tracing.span ("Ldapy.move", path = relDN, to = to):
+            node = self._resolveRelativeDN (relDN)
+            parent, rdn = self._destination (to, _rdn (node.dn))
+            try:
+                node.rename (rdn, parent)
+            except NodeError as e:
+                raise RenameError (e.msg)
+
+    _cannot_copy_to_super_root = "Cannot copy to the super root."
+    _cannot_copy_below_itself = "Cannot copy below itself: %s"
+
+    def copy (self, relDN, to, target = None, recursive = False, errback = None):
+        """Copies the node at relDN, with its subtree if recursive, like cp
+        (see _destination). The copy is made through target, another Ldapy
+        where to is resolved, if given.
+
+        The entries are streamed from one server to the other (see
+        subtree.copy) rather than read into nodes, and what was copied is
+        read when needed. Returns the number of entries copied, errors are
+        passed to errback."""
+        from .node import _rdn
+        from . import connection, subtree
+        target = target or self
+        with tracing.span ("Ldapy.copy", path = relDN, to = to):
+            node = self._resolveRelativeDN (relDN)
+            parent, rdn = target._destination (to, _rdn (node.dn))
+            if not parent.dn:
+                raise CopyError (Ldapy._cannot_copy_to_super_root)
+
+            newDN = connection.dn2str (connection.str2dn ("%s,%s" % (rdn, parent.dn)))
+            if recursive and _sameServer (self.connection, target.connection):
+                key, newKey = node.dn.lower (), newDN.lower ()
+                if newKey == key or newKey.endswith ("," + key):
+                    raise CopyError (Ldapy._cannot_copy_below_itself % newDN)
+
+            copied, baseCopied = subtree.copy (self.connection, node.dn,
+                    target.connection, newDN, recursive = recursive, errback = errback)
+            if baseCopied:
+                parent._adopt (_rdn (newDN), parent._child (newDN, lazy = True))
+            else:
+                # It might have been there already, with children added
+                parent._reread ()
+            return copied
+
+    def diff (self, relDN, other, target = None):
+        """Returns the change records (see subtree.diff) turning the subtree
+        at relDN into a copy of the subtree at other, resolved in target,
+        another Ldapy, if given. The records are yielded as the subtrees
+        are read and compared, which they are entry by entry."""
+        from . import subtree
+        target = target or self
+        with tracing.span ("Ldapy.diff", path = relDN, other = other):
+            node = self._resolveRelativeDN (relDN)
+            otherNode = target._resolveRelativeDN (other)
+            return subtree.changes (self.connection, node.dn,
+                    target.connection, otherNode.dn)
+
+    def apply (self, lines, errback = None, dryRun = False):
+        """Converges the subtree described by the LDIF lines, whose first
+        entry is its base, to them (see subtree.plan): the entries missing
+        are added, those which differ are modified and those not in the LDIF
+        are deleted, pipelined (errors are passed to errback). Returns the
+        change records, which are only made unless dryRun.
+
+        What was read of the subtree is read again when needed."""
+        from . import subtree
+        with tracing.span ("Ldapy.apply", dryRun = dryRun):
+            try:
+                dn, records = subtree.plan (self.connection, subtree.parseLdif (lines))
+            except (ValueError, exceptions.DNDecodingError) as e:
+                raise ApplyError (str (e))
+
+            if records and not dryRun:
+                try:
+                    subtree.execute (records, self.connection, errback)
+                finally:
+                    self._reread (dn)
+            return records
+
+    def _reread (self, dn):
+        """Has the Nodes of the subtree at dn read again when needed, or
+        those of the closest ancestor known if it isn't"""
+        node = self._root
+        for key in _splitComponent (dn, list (self._root.relativeChildren.keys ())):
+            try:
+                child = node._cachedChild (key)
+            except (exceptions.NoSuchObject, exceptions.NoSuchObjectInRoot):
+                child = None
+            if child is None:
+                break
+            node = child
+
+        # The super root is not read again
+        if node.dn:
+            node._reread ()
+            return node
+        return None
+
+    def startPipelining (self, errback = None):
+        """Starts pipelining the modifying operations of the connection (see
+        Connection.startPipelining), passing their errors to errback.
+
+        The Nodes are changed when the operations are sent, before their
+        results are known, so on an error the parent of the entry it was
+        about (or all the roots if it doesn't tell) is read again when
+        needed."""
+        errback = errback if errback else logger.error
+        def failed (error):
+            self._failed (error)
+            errback (error)
+        self.connection.startPipelining (failed)
+
+    def stopPipelining (self):
+        self.connection.stopPipelining ()
+
+    def _failed (self, error):
+        from . import connection
+        dn = getattr (error, "dn", None)
+        if dn:
+            try:
+                parentDN = connection.dn2str (connection.str2dn (dn)[1:])
+            except exceptions.DNDecodingError:
+                parentDN = ""
+            if parentDN and self._reread (parentDN):
+                return
+
+        for root in self._root.relativeChildren.values ():
+            root._reread ()
 
     @property
     def children (self):
-        return self._cwd.relativeChildren.keys ()
+        with tracing.span ("Ldapy.children", dn = self._cwd.dn):
+            return list (self._cwd.relativeChildren.keys ())
 
     def changeDN (self, to):
-        self._cwd = self._resolveRelativeDN (to)
+        with tracing.span ("Ldapy.changeDN", path = to):
+            self._session.cwd = self._resolveRelativeDN (to)
 
     def goUpOneLevel (self):
         self.changeDN ("..")
 
     def completeChild (self, text):
-        return [ i.relativeDN () for i in self._cwd.children if i.dn.startswith (text)]
+        with tracing.span ("Ldapy.completeChild", text = text):
+            return self._completeChild (text)
+
+    def _completeChild (self, text):
+        head, separator, tail = text.rpartition (Ldapy._path_separator)
+        if not separator:
+            return self._cwd.completeChild (text)
+
+        try:
+            node = self._resolveRelativeDN (head + separator)
+        except (LdapyError, exceptions.NoSuchObject, exceptions.NoSuchObjectInRoot):
+            return []
+        return [head + separator + rdn for rdn in node.completeChild (tail)]
 
     def add (self, rdn, attr):
-        self._cwd.add (rdn, attr)
+        with tracing.span ("Ldapy.add", rdn = rdn):
+            self._cwd.add (rdn, attr)
 
     _neither_host_nor_uri_given = "Must specify either a host (--host) or an URI."
     _both_host_and_uri_given = "Both host and URI specified, only one allowed."
@@ -135,6 +415,7 @@ class Ldapy:
     _port_is_not_a_valid_number = "Port is not a valid number."
     _too_many_arguments = "too many arguments given"
     _first_argument_must_be_a_number = "first argument to --save must be a number"
+    _daemon_without_commands = "--daemon needs the commands to be given by --command, --file or standard input"
 
     def parseArguments (self, args = None, name = "ldapy"):
         parser = argparse.ArgumentParser (prog=name)
@@ -147,8 +428,11 @@ class Ldapy:
                              help="Specifies DN used for binding.")
         parser.add_argument ("--password", "-w", default="",
                              help="Specifies password used for binding.")
-        parser.add_argument ("URI", nargs="?",
-                help="Specifies URI to connect to, in the format: ldap://host[:port]")
+        parser.add_argument ("URI", nargs="*",
+                help="Specifies URI to connect to, in the format: ldap://host[:port]. "
+                     "When several are given the first one receives the modifications.")
+        parser.add_argument ("--strategy", choices=strategies,
+                help="Specifies how the reading operations are spread over several URIs.")
         parser.add_argument ("--verbose", "-v", default=False, action="store_true",
                 help="Output more information about what's happening behind the scenes.")
         parser.add_argument ("--debug", "-d", default=False, action="store_true",
@@ -164,6 +448,14 @@ class Ldapy:
         store.add_argument ("--remove", type=str, metavar="NAME",
                 help="Removes a saved connection with the specified name.")
 
+        batch = parser.add_argument_group('batch mode')
+        batch.add_argument ("--command", "-c", metavar="COMMANDS",
+                help="Executes the commands, separated by ';', instead of reading them interactively.")
+        batch.add_argument ("--file", "-f", type=argparse.FileType("r"), metavar="FILE",
+                help="Executes the commands in FILE ('-' for standard input) instead of reading them interactively.")
+        batch.add_argument ("--daemon", default=False, action="store_true",
+                help="Executes the commands in a daemon (started if needed) which keeps the connection between invocations.")
+
         self.args = parser.parse_args (args)
 
         # Take this opportunity to set the logging levels as early as possible
@@ -182,6 +474,9 @@ class Ldapy:
 
         logger.debug ("Arguments before validation: %s" % vars(self.args))
 
+        if self.args.daemon and self.batchInput () is None:
+            parser.error (Ldapy._daemon_without_commands)
+
         # Execute the --save command
         if self.args.save:
             try:
@@ -194,7 +489,7 @@ class Ldapy:
             except ValueError:
                 parser.error (self._first_argument_must_be_a_number)
             except ConnectionDataManagerError as e:
-                print >> sys.stderr, e
+                print (e, file = sys.stderr)
                 sys.exit(3)
 
         # Execute the --remove command
@@ -203,7 +498,7 @@ class Ldapy:
                 self.connectionDataManager.removeConnection (self.args.remove)
                 sys.exit (0)
             except ConnectionDataManagerError as e:
-                print >> sys.stderr, e
+                print (e, file = sys.stderr)
                 sys.exit(3)
 
         # Execute the --previous command
@@ -212,7 +507,7 @@ class Ldapy:
                 # Print the connections
                 n = 0
                 for connection in self.connectionDataManager.getRecentConnections():
-                    print "%u %s" % (n, connection)
+                    print ("%u %s" % (n, connection))
                     n += 1
                 sys.exit (0)
             elif len(self.args.previous) == 1:
@@ -221,7 +516,7 @@ class Ldapy:
                 try:
                     return self.connectionDataManager.getRecentConnection (N), False
                 except ConnectionDataManagerError as e:
-                    print >> sys.stderr, e
+                    print (e, file = sys.stderr)
                     sys.exit(3)
             else:
                 parser.error ("--previous: %s" % Ldapy._too_many_arguments)
@@ -231,7 +526,7 @@ class Ldapy:
             if len(self.args.saved) == 0:
                 # Print the connections
                 for name, connection in sorted(self.connectionDataManager.getConnections().items()):
-                    print "%s %s" % (name, connection)
+                    print ("%s %s" % (name, connection))
                 sys.exit (0)
             elif len(self.args.saved) == 1:
                 # Fetch the connection
@@ -239,7 +534,7 @@ class Ldapy:
                 try:
                     return self.connectionDataManager.getConnection (name), False
                 except ConnectionDataManagerError as e:
-                    print >> sys.stderr, e
+                    print (e, file = sys.stderr)
                     sys.exit(3)
             else:
                 parser.error ("--saved: %s" % Ldapy._too_many_arguments)
@@ -257,23 +552,48 @@ class Ldapy:
             parser.error (Ldapy._both_host_and_uri_given)
 
         if self.args.URI:
-            try:
-                uri = ldapurl.LDAPUrl (self.args.URI)
-                hostport = uri.hostport.split (":")
-                self.args.host = hostport[0]
-                if len(hostport) == 2:
-                    self.args.port = int(hostport[1])
-            except ValueError:
-                parser.error (Ldapy._uri_malformed)
+            import ldapurl
+            for URI in self.args.URI:
+                try:
+                    uri = ldapurl.LDAPUrl (URI)
+                    hostport = uri.hostport.split (":")
+                    # Each URI is checked with its own port
+                    port = int(hostport[1]) if len(hostport) == 2 else None
+                except ValueError:
+                    parser.error (Ldapy._uri_malformed)
+
+                if port is not None and (port < 0 or port > 0xffff):
+                    parser.error (Ldapy._port_is_not_a_valid_number)
         else:
-            self.args.URI = "ldap://%s:%s" % (self.args.host, self.args.port)
+            if self.args.port < 0 or self.args.port > 0xffff:
+                parser.error (Ldapy._port_is_not_a_valid_number)
 
-        if self.args.port < 0 or self.args.port > 0xffff:
-            parser.error (Ldapy._port_is_not_a_valid_number)
+            self.args.URI = ["ldap://%s:%s" % (self.args.host, self.args.port)]
 
         logger.debug ("Arguments: %s" % vars(self.args))
 
-        return ConnectionData (self.args.URI, self.args.bind_dn, self.args.password), True
+        if len(self.args.URI) == 1:
+            uri = self.args.URI[0]
+        else:
+            uri = self.args.URI
+
+        return ConnectionData (uri, self.args.bind_dn, self.args.password,
+                self.args.strategy), True
+
+    def batchInput (self):
+        """Returns the lines of commands to execute non-interactively, as
+        asked for by the arguments or by having standard input redirected, or
+        None if the commands should be read interactively"""
+        if self.args is None:
+            return None
+        elif self.args.command is not None:
+            return [self.args.command]
+        elif self.args.file is not None:
+            return self.args.file
+        elif not sys.stdin.isatty ():
+            return sys.stdin
+        else:
+            return None
 
     def setLoggingLevels (self):
         # Obtain the global ldapy logger
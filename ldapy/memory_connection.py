@@ -0,0 +1,424 @@
+# This file is part of ldapy.
+#
+# ldapy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ldapy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import time
+from . import connection
+from . import exceptions
+from .statistics import Statistics
+
+import logging
+logger = logging.getLogger("ldapy.%s" % __name__)
+
+class FilterError (Exception):
+    def __init__ (self, filterstr):
+        self.filterstr = filterstr
+
+    _bad_filter = "Bad search filter: %s"
+
+    def __str__ (self):
+        return self._bad_filter % self.filterstr
+
+def _values (value):
+    if isinstance (value, (list, tuple)):
+        return list (value)
+    else:
+        return [value]
+
+def _lookup (attributes, name):
+    """Returns the values of the attribute name (case insensitively)"""
+    name = name.lower ()
+    for attribute, values in attributes.items ():
+        if attribute.lower () == name:
+            return values
+    return []
+
+def _setValues (attributes, name, values):
+    """Sets the values of the attribute name (case insensitively), removing
+    it if there are none"""
+    for attribute in list (attributes.keys ()):
+        if attribute.lower () == name.lower ():
+            del attributes[attribute]
+            name = attribute
+    if values:
+        attributes[name] = values
+
+def _unescape (value):
+    # Values in filters escape special characters as \XX
+    parts = value.split ("\\")
+    unescaped = parts[0]
+    for part in parts[1:]:
+        unescaped += chr (int (part[:2], 16)) + part[2:]
+    return unescaped
+
+def parseFilter (filterstr):
+    """Parses a search filter (as described in RFC 4515) and returns a
+    function which, given the attributes of an entry, checks if it matches.
+
+    Values are compared case insensitively and approximate matching (~=) is
+    the same as equality, since there is no schema to tell otherwise."""
+    try:
+        match, rest = _parseFilter (filterstr.strip ())
+    except (IndexError, ValueError):
+        raise FilterError (filterstr)
+
+    if rest:
+        raise FilterError (filterstr)
+    return match
+
+def _parseFilter (s):
+    """Parses the filter at the beginning of s, returning a tuple of the
+    match function and the rest of s"""
+    if s[0] != "(":
+        raise ValueError (s)
+
+    if s[1] in "&|!":
+        operator = s[1]
+        matches = []
+        s = s[2:]
+        while s[0] == "(":
+            match, s = _parseFilter (s)
+            matches.append (match)
+        if s[0] != ")" or not matches or (operator == "!" and len(matches) != 1):
+            raise ValueError (s)
+
+        if operator == "&":
+            return (lambda attrs: all ([m (attrs) for m in matches])), s[1:]
+        elif operator == "|":
+            return (lambda attrs: any ([m (attrs) for m in matches])), s[1:]
+        else:
+            return (lambda attrs: not matches[0] (attrs)), s[1:]
+
+    end = s.index (")")
+    return _parseItem (s[1:end]), s[end + 1:]
+
+def _parseItem (item):
+    equals = item.index ("=")
+    if equals > 0 and item[equals - 1] in "~<>":
+        attribute, operator = item[:equals - 1], item[equals - 1:equals + 1]
+    else:
+        attribute, operator = item[:equals], "="
+    value = item[equals + 1:]
+
+    if not attribute:
+        raise ValueError (item)
+
+    if operator == "=" and value == "*":
+        return lambda attrs: len (_lookup (attrs, attribute)) > 0
+    elif operator == "=" and "*" in value:
+        return _substrings (attribute, [_unescape (v).lower () for v in value.split ("*")])
+
+    value = _unescape (value).lower ()
+    if operator == ">=":
+        return lambda attrs: any ([v.lower () >= value for v in _lookup (attrs, attribute)])
+    elif operator == "<=":
+        return lambda attrs: any ([v.lower () <= value for v in _lookup (attrs, attribute)])
+    else:
+        return lambda attrs: any ([v.lower () == value for v in _lookup (attrs, attribute)])
+
+def _substrings (attribute, parts):
+    initial, any_, final = parts[0], parts[1:-1], parts[-1]
+
+    def matchValue (value):
+        value = value.lower ()
+        if not value.startswith (initial):
+            return False
+        position = len(initial)
+        for part in any_:
+            position = value.find (part, position)
+            if position < 0:
+                return False
+            position += len(part)
+        return len(value) - len(final) >= position and value.endswith (final)
+
+    return lambda attrs: any ([matchValue (v) for v in _lookup (attrs, attribute)])
+
+def _key (dn):
+    return connection.dn2str (connection.str2dn (dn)).lower ()
+
+def _parentKey (dn):
+    return connection.dn2str (connection.str2dn (dn)[1:]).lower ()
+
+class MemoryConnection:
+    """A connection to a directory kept in memory, implementing the same
+    interface as Connection, so that the rest of ldapy can be tested and
+    benchmarked without an LDAP server.
+
+    The roots are created with the attributes of their RDN. There is no
+    schema, so any attributes are accepted and the values are compared case
+    insensitively. Each operation sleeps latency seconds (and each page of a
+    paged search as well) to imitate the round trip to a server."""
+
+    def __init__ (self, roots = ["dc=nodomain"], latency = 0.0):
+        self.uri = "memory://"
+        self.latency = latency
+        self.connected = False
+        self._roots = list (roots)
+        self._entries = {}
+        self._children = {}
+        self._pipelineErrback = None
+        self.statistics = Statistics ()
+
+        for root in self._roots:
+            attributes = {"objectClass": ["top"]}
+            for attribute, value, _ in connection.str2dn (root)[0]:
+                attributes[attribute] = [value]
+            self._insert (root, attributes)
+
+    def _wait (self):
+        if self.latency:
+            time.sleep (self.latency)
+
+    def _insert (self, dn, attributes):
+        key = _key (dn)
+        self._entries[key] = (dn, attributes)
+        self._children[key] = collections.OrderedDict ()
+
+    def _entry (self, dn):
+        try:
+            return self._entries[_key (dn)]
+        except KeyError:
+            raise exceptions.NoSuchObject (dn)
+
+    def bind (self, who, cred):
+        with self.statistics.measure ("bind", who):
+            self._wait ()
+        self.connected = True
+
+    @property
+    def roots (self):
+        return self._roots
+
+    def _scope (self, dn, scope):
+        """Yields the keys of the entries in scope of dn, parents before
+        their children"""
+        key = _key (dn)
+        if key not in self._entries:
+            raise exceptions.NoSuchObject (dn)
+
+        if scope == connection.scopeBase:
+            yield key
+        elif scope == connection.scopeOneLevel:
+            for child in list (self._children[key].keys ()):
+                yield child
+        else:
+            stack = [key]
+            while stack:
+                current = stack.pop ()
+                yield current
+                stack.extend (reversed (list (self._children.get (current, {}).keys ())))
+
+    def _select (self, key, attrlist):
+        # Return copies, the caller is free to modify what it receives
+        dn, attributes = self._entries[key]
+        if attrlist is None or "*" in attrlist:
+            selected = attributes
+        else:
+            wanted = [attribute.lower () for attribute in attrlist]
+            selected = dict ([(attribute, values) for attribute, values in attributes.items ()
+                    if attribute.lower () in wanted])
+        return dn, dict ([(attribute, list (values)) for attribute, values in selected.items ()])
+
+    def _search (self, dn, scope, filterstr, attrlist):
+        with self.statistics.measure ("search", dn, scope) as m:
+            self._wait ()
+            match = parseFilter (filterstr)
+            results = [self._select (key, attrlist) for key in self._scope (dn, scope)
+                    if match (self._entries[key][1])]
+            m.returned (results)
+            return results
+
+    def search (self, dn, scope, attrlist = None):
+        return self._search (dn, scope, "(objectClass=*)", attrlist)
+
+    def searchLimited (self, dn, scope, filterstr, attrlist = None, sizelimit = 0):
+        results = self._search (dn, scope, filterstr, attrlist)
+        if sizelimit and len(results) > sizelimit:
+            return results[:sizelimit], False
+        return results, True
+
+    def searchPaged (self, dn, scope, filterstr = "(objectClass=*)",
+            attrlist = None, pageSize = 500):
+        match = parseFilter (filterstr)
+        scoped = self._scope (dn, scope)
+        while True:
+            with self.statistics.measure ("search (page)", dn, scope) as m:
+                self._wait ()
+                page = []
+                for key in scoped:
+                    # Entries might be deleted while the pages are fetched
+                    if key in self._entries and match (self._entries[key][1]):
+                        page.append (self._select (key, attrlist))
+                        if len(page) == pageSize:
+                            break
+                m.returned (page)
+
+            for entry in page:
+                yield entry
+            if len(page) < pageSize:
+                return
+
+    def add (self, dn, attrs):
+        with self.statistics.measure ("add", dn) as m:
+            m.sent (attrs)
+            self._write (self._add, dn, attrs)
+
+    def _add (self, dn, attrs):
+        key = _key (dn)
+        if key in self._entries:
+            raise exceptions.AlreadyExists (dn)
+
+        parent = _parentKey (dn)
+        if parent not in self._entries:
+            raise exceptions.NoSuchObject (dn)
+
+        attributes = {}
+        for attribute, value in attrs.items ():
+            values = _values (value)
+            if len (set ([v.lower () for v in values])) != len(values):
+                raise exceptions.TypeOrValueExists (dn, attrs)
+            attributes[attribute] = values
+
+        self._insert (dn, attributes)
+        self._children[parent][key] = True
+
+    def modify (self, dn, oldAttrs, newAttrs):
+        with self.statistics.measure ("modify", dn) as m:
+            m.sent (newAttrs)
+            self._write (self._modify, dn, oldAttrs, newAttrs)
+
+    def _modify (self, dn, oldAttrs, newAttrs):
+        """Applies the difference between oldAttrs and newAttrs, the same way
+        as the modlist sent by Connection: an attribute only in newAttrs gets
+        the values added, one only in oldAttrs is removed and one in both
+        gets its values replaced"""
+        _, attributes = self._entry (dn)
+        modified = dict ([(attribute, list (values)) for attribute, values in attributes.items ()])
+
+        for attribute in oldAttrs:
+            if attribute not in newAttrs:
+                modified.pop (attribute, None)
+
+        for attribute, value in newAttrs.items ():
+            values = _values (value)
+            if attribute in oldAttrs:
+                if values:
+                    modified[attribute] = values
+                else:
+                    modified.pop (attribute, None)
+            else:
+                existing = [v.lower () for v in modified.get (attribute, [])]
+                if [v for v in values if v.lower () in existing]:
+                    raise exceptions.TypeOrValueExists (dn, newAttrs)
+                modified[attribute] = modified.get (attribute, []) + values
+
+        self._entries[_key (dn)] = (dn, modified)
+
+    def delete (self, dn):
+        with self.statistics.measure ("delete", dn):
+            self._write (self._delete, dn)
+
+    def _delete (self, dn):
+        self._entry (dn)
+        key = _key (dn)
+        if self._children[key]:
+            raise exceptions.LdapError ("Operation not allowed on non-leaf: %s" % dn)
+
+        del self._entries[key]
+        del self._children[key]
+
+        # The roots have no parent entry
+        self._children.get (_parentKey (dn), {}).pop (key, None)
+
+    def rename (self, dn, newRdn, newSuperior = None):
+        # Not pipelined, as by Connection
+        with self.statistics.measure ("rename", dn):
+            self._wait ()
+            self._rename (dn, newRdn, newSuperior)
+
+    def _rename (self, dn, newRdn, newSuperior):
+        """Moves the entry dn, and its subtree, to newRdn below newSuperior
+        (or its parent), replacing the values of the old RDN in the entry
+        with those of the new one"""
+        _, attributes = self._entry (dn)
+        key = _key (dn)
+        parentDN = connection.dn2str (connection.str2dn (dn)[1:])
+        newDN = "%s,%s" % (newRdn, newSuperior if newSuperior is not None else parentDN)
+        newKey = _key (newDN)
+        if newKey in self._entries:
+            raise exceptions.AlreadyExists (newDN)
+
+        newParent = _parentKey (newDN)
+        if newParent not in self._entries:
+            raise exceptions.NoSuchObject (newSuperior)
+        if newParent == key or newParent.endswith ("," + key):
+            raise exceptions.LdapError ("Cannot move %s below itself" % dn)
+
+        renamed = dict ([(attribute, list (values)) for attribute, values in attributes.items ()])
+        for attribute, value, _ in connection.str2dn (dn)[0]:
+            _setValues (renamed, attribute, [v for v in _lookup (renamed, attribute)
+                if v.lower () != value.lower ()])
+        for attribute, value, _ in connection.str2dn (newRdn)[0]:
+            values = _lookup (renamed, attribute)
+            if value.lower () not in [v.lower () for v in values]:
+                _setValues (renamed, attribute, values + [value])
+
+        # Move the subtree, keeping the order of the children
+        del self._children[_parentKey (dn)][key]
+        self._children[newParent][newKey] = True
+        depth = len(connection.str2dn (dn))
+        moved = lambda old: old[:len(old) - len(key)] + newKey
+        for old in list (self._scope (dn, connection.scopeSubtree)):
+            oldDN, oldAttributes = self._entries.pop (old)
+            if old == key:
+                self._entries[newKey] = (newDN, renamed)
+            else:
+                rdns = connection.dn2str (connection.str2dn (oldDN)[:-depth])
+                self._entries[moved (old)] = ("%s,%s" % (rdns, newDN), oldAttributes)
+            self._children[moved (old)] = collections.OrderedDict ([(moved (child), True)
+                for child in self._children.pop (old)])
+
+    def _write (self, operation, *args):
+        self._wait ()
+        try:
+            operation (*args)
+        except (exceptions.LdapError, exceptions.NoSuchObject,
+                exceptions.AlreadyExists, exceptions.TypeOrValueExists) as e:
+            if self._pipelineErrback is None:
+                raise
+            self._pipelineErrback (e)
+
+    # The operations are made immediately, so pipelining only means that the
+    # errors are passed to the errback instead of being raised
+
+    def startPipelining (self, errback = None):
+        self._pipelineErrback = errback if errback else logger.error
+
+    def stopPipelining (self):
+        self._pipelineErrback = None
+
+    @property
+    def pipelining (self):
+        return self._pipelineErrback is not None
+
+    @property
+    def pipelineErrback (self):
+        return self._pipelineErrback
+
+    def flush (self):
+        pass
+
+    def close (self):
+        self.connected = False
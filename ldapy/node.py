@@ -13,9 +13,10 @@
 # You should have received a copy of the GNU General Public License
 # along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
 
-import connection
-import exceptions
-
+from . import connection
+from . import exceptions
+from . import tracing
+import threading
 import logging
 logger = logging.getLogger("ldapy.%s" % __name__)
 
@@ -27,107 +28,230 @@ class NodeError (Exception):
     def __str__ (self):
         return "Node(\"%s\"): %s" % (self.node.dn, self.msg)
 
+def _modification (node, attribute, newValue, oldValue):
+    """Figures out the modification setting attribute of node (see
+    Node.setAttribute): the old and new attributes to send to the server and
+    the values left after it, if they are changed"""
+    # Make sure we have enough arguments
+    if not newValue and not oldValue:
+        raise NodeError (node, Node._set_attribute_called_without_values)
+
+    # Figure out the difference
+    newValues = None
+    if oldValue:
+        # We want to replace or remove something
+        if attribute in node.attributes:
+            oldValues = node.attributes[attribute]
+            if oldValue in oldValues:
+                oldAttrs = {attribute: oldValues}
+                if newValue:
+                    # We want to replace an existing value
+                    newValues = [newValue if (value == oldValue) else value
+                            for value in oldValues]
+                    newAttrs = {attribute: newValues}
+                else:
+                    # We want to remove an existing value
+                    newValues = oldValues[:]
+                    newValues.remove (oldValue)
+                    newAttrs = {attribute: newValues}
+            else:
+                raise NodeError (node, Node._attribute_has_no_such_value %
+                        (attribute, oldValue))
+        else:
+            raise NodeError (node, Node._no_such_attribute %
+                        (node.dn, attribute))
+    else: # Here we know newValue != None
+        # We want to add something
+        oldAttrs = {}
+        newAttrs = {attribute: newValue}
+
+    return oldAttrs, newAttrs, newValues
+
+def _applyModification (attributes, attribute, newValue, oldValue, newValues):
+    """Changes the cached attributes as the server did when given the
+    modification figured out by _modification"""
+    if newValues:
+        # The values were changed, but we still have some values left
+        attributes[attribute] = newValues
+    elif oldValue and not newValue:
+        # A value was removed, leaving no other values
+        del attributes[attribute]
+    elif newValue and not oldValue:
+        # We should add a new value
+        if attribute in attributes:
+            attributes[attribute].append(newValue)
+        else:
+            attributes[attribute] = [newValue]
+
+def _cachedCompletions (completions, text):
+    """Returns the completions of the longest prefix of text with a complete
+    answer in completions (keyed by the lower case prefixes), None if there
+    is none"""
+    text = text.lower ()
+    for n in range (len(text), -1, -1):
+        if text[:n] in completions:
+            rdns, complete = completions[text[:n]]
+            if complete:
+                return rdns
+    return None
+
+def _matching (rdns, text):
+    """Returns the relative DNs in rdns starting with text, ignoring case as
+    the filter asking the server for them does"""
+    text = text.lower ()
+    return [rdn for rdn in rdns if rdn.lower ().startswith (text)]
+
+def _completionSearch (text):
+    """Returns the filter asking for the children which might start with
+    text, and the key of the answer among the completions. Without a
+    complete attribute name (or with a value we can't simply turn into a
+    filter) all the children are asked for, which are the completions of any
+    text."""
+    attribute, sep, prefix = text.partition ("=")
+    if not sep or not attribute or set(",+\\") & set(prefix):
+        return "(objectClass=*)", ""
+    return connection.prefixFilter (attribute, prefix), text.lower ()
+
+def _added (attr):
+    """The attributes of an entry added with attr, where each value might be
+    a list or a single value"""
+    return dict ([(attribute, list (values) if isinstance (values, (list, tuple)) else [values])
+        for attribute, values in attr.items ()])
+
+def _rdn (dn):
+    """The first RDN of dn, ie the key of a child in its parent"""
+    return connection.dn2str (connection.str2dn (dn)[:1])
+
+class _NoLock:
+    """Stands in for the lock of a Node which isn't synchronized"""
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        return False
+
+_noLock = _NoLock ()
+
 class Node:
-    """Class representing a node in the database"""
+    """Class representing a node in the database.
+
+    A synchronized Node (and the Nodes created from it) can be shared by
+    several threads: each Node has a lock, taken when populating it (so
+    that threads asking for the same attributes or children at the same
+    time wait for one search instead of making their own) and when changing
+    it. The children and attributes are then changed on copies, so what a
+    thread has been given never changes under it."""
 
     _attributes_failed = "Unable to obtain attributes for: %s"
     _no_such_attribute = "%s has no such attribute: %s"
     _attribute_has_no_such_value = "Attribute %s does not contain value: %s"
     _set_attribute_called_without_values = "Need to specify either an old value or a new value."
+    _cannot_rename_root = "Cannot rename or move a root."
+    _cannot_move_below_itself = "Cannot move below itself: %s"
+    _cannot_move_to_super_root = "Cannot move to the super root."
 
-    def __init__ (self, con, dn, attributes = None):
+    # The maximum number of children asked for when completing in a Node which
+    # children are not populated
+    completionSizeLimit = 100
+
+    def __init__ (self, con, dn, attributes = None, lazy = False, synchronized = False):
         logger.info ("Creating Node with DN=[%s]" % dn)
         self.con = con
         self.parent = None
+        self.synchronized = synchronized
+        self._lock = threading.RLock () if synchronized else _noLock
         self._children = None
         self._relativeChildren = None
+        self._completions = {}
+
+        # Children we know of without having populated all the children,
+        # keyed by their relative DN
+        self._partialChildren = {}
 
         try:
-            self.dn = connection.dn2str(connection.str2dn(dn))
+            self._dn = connection.dn2str(connection.str2dn(dn))
         except exceptions.DNDecodingError:
             raise exceptions.DNDecodingError (dn)
 
+        # The DN of the parent when our DN was last figured out (see dn)
+        self._parentDN = None
+
         # If we were'n given a dn, then we populate the Node with the roots
         if not self.dn:
             logger.debug ("Populating root node with roots: %s" % self.con.roots)
             self._children = {}
             for root in self.con.roots:
                 try:
-                    node = Node (self.con, root)
-                    node.parent = self
-                    self._children[root] = node
+                    self._children[root] = self._child (root)
                 except exceptions.NoSuchObject as e:
                     logger.error (e)
                     logger.error ("Skipping root %s" % root)
 
         # If we were given our attributes, thank the caller, otherwise we
-        # populate them ourselves
+        # populate them ourselves (unless asked to be lazy about it, in which
+        # case they are populated when first needed)
         if attributes is not None:
-            self.attributes = attributes
+            self._attributes = attributes
+        elif lazy:
+            self._attributes = None
         else:
             self._populateAttributes ()
 
+    @property
+    def dn (self):
+        """The DN, which follows the parent if it's renamed or moved (see
+        rename): it's figured out again when asked for, rather than for each
+        of the descendants when the parent is renamed"""
+        parent = self.parent
+        if parent is not None:
+            parentDN = parent.dn
+            if parentDN is not self._parentDN:
+                if self._parentDN is not None:
+                    self._dn = "%s,%s" % (_rdn (self._dn), parentDN)
+                self._parentDN = parentDN
+        return self._dn
+
+    @property
+    def attributes (self):
+        if self._attributes is None:
+            with self._lock:
+                if self._attributes is None:
+                    self._populateAttributes ()
+        return self._attributes
+
     def _populateAttributes (self):
         # If we are the root node, then we don't have any attributes
         if not self.dn:
-            self.attributes = {}
+            self._attributes = {}
             return
 
-        nodes = self.con.search (self.dn, connection.scopeBase)
+        with tracing.span ("Node.populateAttributes", dn = self.dn):
+            nodes = self.con.search (self.dn, connection.scopeBase)
         node = nodes[0]
-        self.attributes = node[1]
-        logger.debug ("Attributes for DN=[%s]: %s" % (self.dn, self.attributes))
+        self._attributes = node[1]
+        logger.debug ("Attributes for DN=[%s]: %s" % (self.dn, self._attributes))
 
     def setAttribute (self, attribute, newValue = None, oldValue = None):
-        # Make sure we have enough arguments
-        if not newValue and not oldValue:
-            raise NodeError (self, Node._set_attribute_called_without_values)
-
-        # Figure out the difference
-        newValues = None
-        if oldValue:
-            # We want to replace or remove something
-            if attribute in self.attributes:
-                oldValues = self.attributes[attribute]
-                if oldValue in oldValues:
-                    oldAttrs = {attribute: oldValues}
-                    if newValue:
-                        # We want to replace an existing value
-                        newValues = [newValue if (value == oldValue) else value
-                                for value in oldValues]
-                        newAttrs = {attribute: newValues}
-                    else:
-                        # We want to remove an existing value
-                        newValues = oldValues[:]
-                        newValues.remove (oldValue)
-                        newAttrs = {attribute: newValues}
-                else:
-                    raise NodeError (self, Node._attribute_has_no_such_value %
-                            (attribute, oldValue))
-            else:
-                raise NodeError (self, Node._no_such_attribute %
-                            (self.dn, attribute))
-        else: # Here we know newValue != None
-            # We want to add something
-            oldAttrs = {}
-            newAttrs = {attribute: newValue}
-        
-        # Send the modification to the server
-        self.con.modify(self.dn, oldAttrs, newAttrs)
-
-        # Change our cached value
-        if newValues:
-            # The values were changed, but we still have some values left
-            self.attributes[attribute] = newValues
-        elif oldValue and not newValue:
-            # A value was removed, leaving no other values
-            del self.attributes[attribute]
-        elif newValue and not oldValue:
-            # We should add a new value
-            if attribute in self.attributes:
-                self.attributes[attribute].append(newValue)
+        with self._lock:
+            oldAttrs, newAttrs, newValues = _modification (self, attribute, newValue, oldValue)
+
+            # Send the modification to the server
+            attributes = self.con.modify(self.dn, oldAttrs, newAttrs)
+
+            if attributes is not None:
+                # The server returned the entry as it is after the change
+                # (see Connection.modify), which is more accurate than
+                # applying the change to what we had read
+                self._attributes = attributes
+            elif self.synchronized:
+                attributes = dict (self.attributes)
+                if attribute in attributes:
+                    attributes[attribute] = list (attributes[attribute])
+                _applyModification (attributes, attribute, newValue, oldValue, newValues)
+                self._attributes = attributes
             else:
-                self.attributes[attribute] = [newValue]
+                _applyModification (self.attributes, attribute, newValue, oldValue, newValues)
 
     def delete (self):
         try:
@@ -145,20 +269,55 @@ class Node:
         except exceptions.NoSuchObject:
             logger.warning ("Trying to delete non-existent Node: %s" % self.dn)
 
-        # If this Node has a parent, remove this Node from its list
-        key = self.relativeDN()
-        if self.parent and key in self.parent._children:
-            del self.parent._children[key]
+        # If this Node has a parent, remove this Node from its lists
+        if self.parent:
+            self.parent._forget (self.relativeDN())
+
+    def _forget (self, key):
+        with self._lock:
+            if self._children and key in self._children:
+                children = self._changeable (self._children)
+                del children[key]
+                self._children = children
+            self._partialChildren.pop (key, None)
+            self._completions = {}
 
     def add (self, rdn, attr):
         dn = "%s,%s" % (rdn, self.dn)
-        self.con.add (dn, attr)
-        self._insertChild (dn)
+        attributes = self.con.add (dn, attr)
+        if attributes is None:
+            # Unless the connection read the entry back, its attributes are
+            # what we sent (but the operational ones, which are only
+            # returned when asked for anyway)
+            attributes = _added (attr)
+
+        with self._lock:
+            if self._children is not None:
+                children = self._changeable (self._children)
+                self._insertChild (children, dn, attributes)
+                self._children = children
+            else:
+                self._partialChildren[_rdn (dn)] = self._child (dn, attributes)
+            self._completions = {}
+
+    def _reread (self):
+        """Forgets what has been read of this Node and below it, which is
+        read again when needed"""
+        with self._lock:
+            self._attributes = None
+            self._children = None
+            self._partialChildren = {}
+            self._completions = {}
+
+    def _changeable (self, children):
+        """Returns the children to change and then store in _children, a copy
+        if synchronized since other threads might be using them"""
+        return dict (children) if self.synchronized else children
 
     @property
     def children (self):
         self._populateChildren()
-        return self._children.values()
+        return list (self._children.values())
 
     @property
     def relativeChildren (self):
@@ -167,17 +326,165 @@ class Node:
 
     def _populateChildren (self):
         if self._children is None:
-            self._children = {}
-            children = self.con.search (self.dn, connection.scopeOneLevel)
-            for child in children:
-                self._insertChild (child[0], child[1])
+            with self._lock:
+                if self._children is None:
+                    self._readChildren ()
+
+    def _readChildren (self):
+        with tracing.span ("Node.populateChildren", dn = self.dn) as span:
+            children = {}
+            for dn, attributes in self.con.search (self.dn, connection.scopeOneLevel):
+                self._insertChild (children, dn, attributes)
+            self._children = children
+            self._partialChildren = {}
+            span.setAttribute ("children", len(children))
+
+        logger.debug ("Populated DN=[%s] with children: %s" % (self.dn, children))
+
+    def completeChild (self, text):
+        """Returns the relative DNs of the children starting with text,
+        ignoring case.
+
+        If the children are not populated, only the children matching text
+        are asked for, and the answer is cached so that longer prefixes can
+        be completed without asking the server again."""
+        if self._children is not None:
+            return _matching (self._children.keys(), text)
+
+        rdns = _cachedCompletions (self._completions, text)
+        if rdns is None:
+            rdns = self._searchCompletions (text)
+        return _matching (rdns, text)
+
+    def _searchCompletions (self, text):
+        filterstr, key = _completionSearch (text)
+        with tracing.span ("Node.searchCompletions", dn = self.dn, text = text):
+            results, complete = self.con.searchLimited (self.dn,
+                    connection.scopeOneLevel, filterstr,
+                    attrlist = ["1.1"], sizelimit = self.completionSizeLimit)
+
+        rdns = [_rdn (dn) for dn, _ in results]
+        self._completions[key] = (rdns, complete)
+        logger.debug ("Completions for %s in DN=[%s] (complete: %s): %s" %
+                (text, self.dn, complete, rdns))
+        return rdns
+
+    def _insertChild (self, children, dn, attr = None, lazy = False):
+        # Reuse the Node if we already know of it, to keep the tree consistent
+        key = _rdn (dn)
+        node = self._partialChildren.get (key)
+        if node is None:
+            node = self._child (dn, attr, lazy = lazy)
+        elif attr is not None:
+            node._attributes = attr
+        children[key] = node
+
+    def _child (self, dn, attributes = None, lazy = False):
+        node = Node (self.con, dn, attributes, lazy = lazy, synchronized = self.synchronized)
+        node.parent = self
+        node._parentDN = self.dn
+        return node
+
+    def _adopt (self, key, node):
+        """Makes node our child with the relative DN key"""
+        with self._lock:
+            if self._children is not None:
+                children = self._changeable (self._children)
+                children[key] = node
+                self._children = children
+            else:
+                self._partialChildren[key] = node
+            self._completions = {}
+
+    def rename (self, newRdn, newParent = None):
+        """Renames this Node to newRdn, and moves it below newParent (a Node)
+        if given, with one operation on the server.
+
+        What we have read below this Node moves along, instead of being read
+        again: the descendants keep their attributes and children, and their
+        DNs follow when next asked for. Only the attributes of this Node are
+        read again, since the values of its RDN have changed."""
+        if not self.parent or not self.parent.dn:
+            raise NodeError (self, Node._cannot_rename_root)
+
+        if newParent is None or newParent is self.parent:
+            newParent = self.parent
+            newSuperior = None
+        elif not newParent.dn:
+            raise NodeError (self, Node._cannot_move_to_super_root)
+        else:
+            ancestor = newParent
+            while ancestor is not None:
+                if ancestor is self:
+                    raise NodeError (self, Node._cannot_move_below_itself % newParent.dn)
+                ancestor = ancestor.parent
+            newSuperior = newParent.dn
+
+        with tracing.span ("Node.rename", dn = self.dn, rdn = newRdn):
+            self.con.rename (self.dn, newRdn, newSuperior)
+
+        key = _rdn (self.dn)
+        with self._lock:
+            self._dn = connection.dn2str (connection.str2dn ("%s,%s" % (newRdn, newParent.dn)))
+            self._parentDN = newParent.dn
+            self._attributes = None
+
+        self.parent._forget (key)
+        self.parent = newParent
+        newParent._adopt (_rdn (self._dn), self)
+
+    def _cachedChild (self, key):
+        """Returns the child with the relative DN key if it's known, None if
+        it might exist and raises if the populated children says it doesn't"""
+        if self._children is None:
+            return self._partialChildren.get (key)
 
-            logger.debug ("Populated DN=[%s] with children: %s" % (self.dn, self._children))
+        try:
+            return self._children[key]
+        except KeyError:
+            if self.dn:
+                raise exceptions.NoSuchObject ("%s,%s" % (key, self.dn))
+            else:
+                raise exceptions.NoSuchObjectInRoot (key)
+
+    def descendant (self, keys):
+        """Returns the Node reached by following the relative DNs in keys,
+        one level at a time, from this Node.
+
+        Only the last Node is looked up on the server (with one base search)
+        if it's not already known. The Nodes in between are created without
+        populating them and are spliced into the tree once the last Node is
+        known to exist. If another thread has spliced some of them meanwhile,
+        its Nodes are used instead."""
+        node = self
+        spliced = []
+        for n, key in enumerate (keys):
+            child = node._cachedChild (key)
+            if child is None:
+                dn = "%s,%s" % (key, node.dn) if node.dn else key
+                try:
+                    child = node._child (dn, lazy = (n < len(keys) - 1))
+                except exceptions.DNDecodingError:
+                    raise exceptions.NoSuchObject (dn)
+                spliced.append ((node, key, child))
+            node = child
+
+        if not spliced:
+            return node
+
+        # Once one Node is not ours, the rest of the path is followed from it
+        node = spliced[0][0]
+        for _, key, child in spliced:
+            with node._lock:
+                if node._children is not None and key in node._children:
+                    known = node._children[key]
+                else:
+                    known = node._partialChildren.setdefault (key, child)
+            if known is child:
+                child.parent = node
+            node = known
 
-    def _insertChild (self, dn, attr = None):
-        node = Node (self.con, dn, attr)
-        node.parent = self
-        self._children[node.relativeDN()] = node
+        return node
 
 
     def relativeDN (self, to = None):
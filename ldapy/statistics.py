@@ -0,0 +1,141 @@
+# This file is part of ldapy.
+#
+# ldapy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ldapy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+from . import tracing
+Record = collections.namedtuple ("Record",
+        ["operation", "dn", "scope", "entries", "bytes", "seconds"])
+
+def size (dn, attributes):
+    """Estimates the size in bytes of an entry, ie its DN, attribute names
+    and values"""
+    n = len(dn)
+    for attribute, values in attributes.items ():
+        if not isinstance (values, (list, tuple)):
+            values = [values]
+        n += len(attribute) + sum ([len(value) for value in values])
+    return n
+
+class Summary:
+    """The totals of one kind of operation"""
+
+    def __init__ (self, operation):
+        self.operation = operation
+        self.count = 0
+        self.entries = 0
+        self.bytes = 0
+        self.seconds = 0.0
+        self.histogram = [0] * (len(Statistics.buckets) + 1)
+
+    def add (self, record):
+        self.count += 1
+        self.entries += record.entries
+        self.bytes += record.bytes
+        self.seconds += record.seconds
+
+        milliseconds = 1000 * record.seconds
+        bucket = 0
+        while bucket < len(Statistics.buckets) and milliseconds > Statistics.buckets[bucket]:
+            bucket += 1
+        self.histogram[bucket] += 1
+
+class Measurement:
+    """Measures the wall time of an operation, used as a context manager,
+    while the caller tells what was sent and returned"""
+
+    def __init__ (self, statistics, operation, dn, scope):
+        self.statistics = statistics
+        self.operation = operation
+        self.dn = dn
+        self.scope = scope
+        self.entries = 0
+        self.bytes = 0
+
+    def sent (self, attributes):
+        self.bytes += size (self.dn, attributes)
+
+    def returned (self, entries):
+        self.entries += len(entries)
+        self.bytes += sum ([size (dn, attributes) for dn, attributes in entries])
+
+    def __enter__ (self):
+        self.span = tracing.span ("ldap.%s" % self.operation, dn = self.dn, scope = self.scope)
+        self.span.__enter__ ()
+        self.start = time.time ()
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.statistics.record (Record (self.operation, self.dn, self.scope,
+            self.entries, self.bytes, time.time () - self.start))
+        self.span.setAttribute ("entries", self.entries)
+        self.span.setAttribute ("bytes", self.bytes)
+        self.span.__exit__ (type, value, traceback)
+        return False
+
+class Statistics:
+    """Records the operations (ie round trips) made by a connection: the
+    kind of operation, the base DN, the scope, the number of entries
+    returned, the bytes sent or returned and the wall time.
+
+    Pipelined operations are recorded when sent, so their time doesn't
+    include waiting for the result. The operations can be recorded from
+    several threads at once."""
+
+    # The upper bounds, in milliseconds, of the buckets of the latency
+    # histograms (the last bucket holds everything slower)
+    buckets = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+    # The number of operations kept in the log
+    logSize = 100
+
+    def __init__ (self):
+        self._lock = threading.Lock ()
+
+        # Totals since the creation, unaffected by reset
+        self.totalRoundTrips = 0
+        self.totalSeconds = 0.0
+        self.reset ()
+
+    def reset (self):
+        with self._lock:
+            self.summaries = {}
+            self.log = collections.deque (maxlen = Statistics.logSize)
+
+            # The searches answered by the cache of the connection, without a
+            # round trip
+            self.cacheHits = 0
+
+    def measure (self, operation, dn, scope = None):
+        return Measurement (self, operation, dn, scope)
+
+    def record (self, record):
+        with self._lock:
+            if record.operation not in self.summaries:
+                self.summaries[record.operation] = Summary (record.operation)
+            self.summaries[record.operation].add (record)
+            self.log.append (record)
+            self.totalRoundTrips += 1
+            self.totalSeconds += record.seconds
+
+    def cacheHit (self):
+        with self._lock:
+            self.cacheHits += 1
+
+    @property
+    def roundTrips (self):
+        with self._lock:
+            return sum ([summary.count for summary in self.summaries.values ()])
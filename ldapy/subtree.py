@@ -0,0 +1,504 @@
+# This file is part of ldapy.
+#
+# ldapy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ldapy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Operations on whole subtrees, which stream the entries through the
+# connections instead of building Nodes for them.
+
+import base64
+import contextlib
+import heapq
+import operator
+import tempfile
+from . import connection
+from . import exceptions
+
+try:
+    import cPickle as pickle
+except ImportError:
+    # Python 3
+    import pickle
+
+import logging
+logger = logging.getLogger("ldapy.%s" % __name__)
+
+def _key (rdns):
+    return connection.dn2str (rdns).lower ()
+
+def _renamed (attributes, oldRdn, newRdn):
+    """Returns a copy of the attributes of an entry with the values of
+    oldRdn replaced by those of newRdn (both as given by str2dn)"""
+    renamed = dict ([(attribute, list (values)) for attribute, values in attributes.items ()])
+    for attribute, value, _ in oldRdn:
+        for name in list (renamed.keys ()):
+            if name.lower () == attribute.lower ():
+                renamed[name] = [v for v in renamed[name] if v.lower () != value.lower ()]
+                if not renamed[name]:
+                    del renamed[name]
+    for attribute, value, _ in newRdn:
+        names = [name for name in renamed if name.lower () == attribute.lower ()]
+        name = names[0] if names else attribute
+        if value.lower () not in [v.lower () for v in renamed.get (name, [])]:
+            renamed[name] = renamed.get (name, []) + [value]
+    return renamed
+
+@contextlib.contextmanager
+def _pipelined (target, errback):
+    """Pipelines the operations on the connection target in the block (see
+    Connection.startPipelining), passing their errors to errback, or if not
+    given to the errback of target if it already pipelines. Gives the list
+    of the errors, which is complete once the block is left."""
+    previous = target.pipelineErrback
+    errors = []
+    def failed (e):
+        errors.append (e)
+        (errback or previous or logger.error) (e)
+
+    target.startPipelining (failed)
+    try:
+        yield errors
+    finally:
+        if previous is not None:
+            target.startPipelining (previous)
+        else:
+            target.stopPipelining ()
+
+def copy (source, dn, target, newDN, recursive = True, errback = None, pageSize = 500):
+    """Copies the entry dn, and its subtree if recursive, read through the
+    connection source to newDN written through the connection target (which
+    might be the same connection).
+
+    The entries are read with one paged search and added as they arrive,
+    pipelined (errors are passed to errback, see _pipelined). Since the
+    server might return an entry before its parent, such an entry is
+    deferred until its parent has been added. Returns the number of entries
+    copied and whether the entry dn was."""
+    base = connection.str2dn (dn)
+    newBase = connection.str2dn (newDN)
+    depth = len(base)
+
+    added = set ()
+    deferred = {}
+    sent = [0]
+    baseCopied = [False]
+
+    def add (rdns, attributes):
+        relative = rdns[:len(rdns) - depth]
+        if not relative:
+            attributes = _renamed (attributes, base[0], newBase[0])
+        target.add (connection.dn2str (relative + newBase), attributes)
+        if not relative:
+            # Its children wait for it anyway
+            target.flush ()
+            baseCopied[0] = not errors
+        added.add (_key (rdns))
+        sent[0] += 1
+
+    with _pipelined (target, errback) as errors:
+        scope = connection.scopeSubtree if recursive else connection.scopeBase
+        for entryDN, attributes in source.searchPaged (dn, scope, pageSize = pageSize):
+            rdns = connection.str2dn (entryDN)
+            parent = _key (rdns[1:])
+            if len(rdns) > depth and parent not in added:
+                deferred.setdefault (parent, []).append ((rdns, attributes))
+                continue
+
+            stack = [(rdns, attributes)]
+            while stack:
+                rdns, attributes = stack.pop ()
+                add (rdns, attributes)
+                stack.extend (deferred.pop (_key (rdns), []))
+
+        # Entries whose parents weren't returned (eg not readable by us) are
+        # still sent, for the errors to tell about them
+        for entries in deferred.values ():
+            for rdns, attributes in entries:
+                logger.warning ("The parent of %s was not copied" % connection.dn2str (rdns))
+                add (rdns, attributes)
+
+    return sent[0] - len(errors), baseCopied[0]
+
+# The number of entries sorted in memory when sorting a subtree by DN (see
+# sortedByDN), more entries are sorted in runs spilled to temporary files
+chunkSize = 10000
+
+def _normalized (rdn):
+    """A form of an RDN (as given by str2dn) for comparing it with others"""
+    return "+".join (sorted (["%s=%s" % (attribute.lower (), value.lower ())
+        for attribute, value, _ in rdn]))
+
+def _spill (records):
+    """Writes the records to a temporary file, returning it"""
+    f = tempfile.TemporaryFile ()
+    for record in records:
+        pickle.dump (record, f, pickle.HIGHEST_PROTOCOL)
+    f.seek (0)
+    return f
+
+def _unspill (f):
+    """Yields the records written by _spill"""
+    while True:
+        try:
+            yield pickle.load (f)
+        except EOFError:
+            return
+
+def sortedByDN (entries, base):
+    """Yields the entries below base (as returned by a search), decorated as
+    (key, dn, attributes), sorted by their DNs relative to base: the key is
+    the normalized RDNs from base down to the entry, so that parents come
+    before their children, and the entries of two subtrees sort the same
+    way whatever their bases.
+
+    Entries are sorted in memory, chunkSize at a time, and if there are more
+    the sorted runs are spilled to temporary files and merged (an external
+    merge sort), so the memory used is bounded whatever the size of the
+    subtree."""
+    depth = len(connection.str2dn (base))
+    runs = []
+    chunk = []
+    try:
+        # The records are numbered, so that the attributes of entries given
+        # twice are never compared when the runs are merged
+        for n, (dn, attributes) in enumerate (entries):
+            rdns = connection.str2dn (dn)
+            key = tuple ([_normalized (rdn) for rdn in reversed (rdns[:len(rdns) - depth])])
+            chunk.append ((key, n, dn, attributes))
+            if len(chunk) >= chunkSize:
+                chunk.sort (key = operator.itemgetter (0))
+                runs.append (_spill (chunk))
+                chunk = []
+
+        chunk.sort (key = operator.itemgetter (0))
+        if runs:
+            runs.append (_spill (chunk))
+            chunk = heapq.merge (*[_unspill (f) for f in runs])
+
+        for key, _, dn, attributes in chunk:
+            yield key, dn, attributes
+    finally:
+        for f in runs:
+            f.close ()
+
+def _lowered (attributes):
+    return dict ([(attribute.lower (), (attribute, values))
+        for attribute, values in attributes.items ()])
+
+def _modifications (old, new):
+    """Returns the modifications turning the attributes old into new, as a
+    list of (operation, attribute, values) where operation is add, delete
+    or replace, removing and adding single values rather than replacing all
+    of them"""
+    modifications = []
+    old, new = _lowered (old), _lowered (new)
+    for name in sorted (set (old.keys ()) | set (new.keys ())):
+        if name not in new:
+            modifications.append (("delete", old[name][0], []))
+        elif name not in old:
+            modifications.append (("add", new[name][0], list (new[name][1])))
+        else:
+            attribute, newValues = new[name]
+            oldValues = old[name][1]
+            removed = [value for value in oldValues if value not in newValues]
+            added = [value for value in newValues if value not in oldValues]
+            if removed and not added and len(removed) == len(oldValues):
+                modifications.append (("delete", attribute, []))
+            elif removed and added and len(removed) == len(oldValues):
+                modifications.append (("replace", attribute, list (newValues)))
+            else:
+                if removed:
+                    modifications.append (("delete", attribute, removed))
+                if added:
+                    modifications.append (("add", attribute, added))
+    return modifications
+
+def _changed (old, new):
+    """Returns the attributes which differ between the attributes old and
+    new, as (oldAttributes, newAttributes) where an attribute in both is
+    named as in old"""
+    changedOld, changedNew = {}, {}
+    old, new = _lowered (old), _lowered (new)
+    for name in set (old.keys ()) | set (new.keys ()):
+        if name in old and name in new and set (old[name][1]) == set (new[name][1]):
+            continue
+        attribute = old[name][0] if name in old else new[name][0]
+        if name in old:
+            changedOld[attribute] = list (old[name][1])
+        if name in new:
+            changedNew[attribute] = list (new[name][1])
+    return changedOld, changedNew
+
+def _ancestor (a, b):
+    """Checks if the key a is an ancestor of (or the same as) the key b"""
+    return b[:len(a)] == a
+
+def diff (old, oldDN, new, newDN):
+    """Yields the change records turning the subtree at oldDN into a copy of
+    the subtree at newDN, given the decorated entries of each sorted by DN
+    (see sortedByDN), as (changetype, dn, data) where:
+      add     has the attributes of the entry as data,
+      delete  has None,
+      modify  has the attributes which differ, before and after, as
+              (oldAttributes, newAttributes) to pass to modify of a
+              connection.
+    The DNs are those of the old subtree.
+
+    The sorted entries are merge-joined, so only the current entry of each
+    side is held, along with the deleted entries waiting for their children
+    (which have to be deleted first) to be passed."""
+    oldBase = connection.str2dn (oldDN)
+    newBase = connection.str2dn (newDN)
+    depth = len(newBase)
+
+    # The deleted entries whose descendants might follow, innermost last
+    deleting = []
+
+    def deletions (key):
+        while deleting and (key is None or not _ancestor (deleting[-1][0], key)):
+            yield ("delete", deleting.pop ()[1], None)
+
+    old, new = iter (old), iter (new)
+    a, b = next (old, None), next (new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            # Only in the old subtree
+            for record in deletions (a[0]):
+                yield record
+            deleting.append ((a[0], a[1]))
+            a = next (old, None)
+            continue
+
+        for record in deletions (b[0]):
+            yield record
+
+        key, dn, attributes = b
+        if not key and _normalized (newBase[0]) != _normalized (oldBase[0]):
+            # The bases have different RDNs
+            attributes = _renamed (attributes, newBase[0], oldBase[0])
+
+        if a is None or b[0] < a[0]:
+            # Only in the new subtree
+            rdns = connection.str2dn (dn)
+            yield ("add", connection.dn2str (rdns[:len(rdns) - depth] + oldBase), attributes)
+        else:
+            changed = _changed (a[2], attributes)
+            if changed != ({}, {}):
+                yield ("modify", a[1], changed)
+            a = next (old, None)
+        b = next (new, None)
+
+    for record in deletions (None):
+        yield record
+
+def changes (source, dn, target, targetDN, pageSize = 500):
+    """Yields the change records (see diff) turning the subtree at dn, read
+    through the connection source, into a copy of the subtree at targetDN,
+    read through the connection target (which might be the same
+    connection). Each subtree is read with one paged search."""
+    old = sortedByDN (source.searchPaged (dn, connection.scopeSubtree, pageSize = pageSize), dn)
+    new = sortedByDN (target.searchPaged (targetDN, connection.scopeSubtree, pageSize = pageSize), targetDN)
+    return diff (old, dn, new, targetDN)
+
+def _safe (value):
+    """Checks if value can be written as it is in LDIF (a SAFE-STRING in
+    RFC 2849), otherwise it's base64 encoded"""
+    if not value:
+        return True
+    if value[0] in " :<" or value[-1] == " ":
+        return False
+    return all ([0 < ord (c) < 128 and c not in "\r\n" for c in value])
+
+def _line (attribute, value):
+    if _safe (value):
+        return "%s: %s" % (attribute, value)
+    # Binary values were decoded with surrogateescape (see connection._decode)
+    data = value if isinstance (value, bytes) else value.encode ("utf-8", "surrogateescape")
+    return "%s:: %s" % (attribute, base64.b64encode (data).decode ("ascii"))
+
+def ldif (record):
+    """Returns the lines of LDIF (RFC 2849) of a change record (see diff)"""
+    changetype, dn, data = record
+    lines = [_line ("dn", dn), "changetype: %s" % changetype]
+    if changetype == "add":
+        for attribute in sorted (data.keys ()):
+            lines.extend ([_line (attribute, value) for value in data[attribute]])
+    elif changetype == "modify":
+        for operation, attribute, values in _modifications (*data):
+            lines.append ("%s: %s" % (operation, attribute))
+            lines.extend ([_line (attribute, value) for value in values])
+            lines.append ("-")
+    return lines
+
+def _decoded (value):
+    data = base64.b64decode (value)
+    if isinstance (data, str):
+        # Python 2, where the values are str
+        return data
+    # Binary values are decoded as connection._decode does
+    return data.decode ("utf-8", "surrogateescape")
+
+_malformed_line = "Line %u: malformed LDIF: %s"
+_not_an_entry = "Line %u: only entries, not change records, are supported: %s"
+_no_urls = "Line %u: values given by URLs are not supported: %s"
+
+def _logicalLines (lines):
+    """Yields the lines of LDIF unfolded, as (number, line), leaving out the
+    comments, with an empty line after each record"""
+    current = None
+    for n, line in enumerate (lines, 1):
+        line = line.rstrip ("\r\n")
+        if line.startswith (" ") and current is not None:
+            current = (current[0], current[1] + line[1:])
+            continue
+        if current is not None and not current[1].startswith ("#"):
+            yield current
+        current = (n, line) if line else None
+        if not line:
+            yield (n, "")
+    if current is not None and not current[1].startswith ("#"):
+        yield current
+    yield (None, "")
+
+def parseLdif (lines):
+    """Yields the entries, as (dn, attributes), of LDIF (RFC 2849) given as
+    lines. Only content records are supported, ValueError is raised for
+    change records, values given by URLs and malformed lines."""
+    dn = None
+    attributes = {}
+    for n, line in _logicalLines (lines):
+        if not line:
+            if dn is not None:
+                yield dn, attributes
+            dn, attributes = None, {}
+            continue
+
+        attribute, separator, value = line.partition (":")
+        if not separator or not attribute:
+            raise ValueError (_malformed_line % (n, line))
+        if value.startswith (":"):
+            try:
+                value = _decoded (value[1:].strip ())
+            except (TypeError, ValueError):
+                raise ValueError (_malformed_line % (n, line))
+        elif value.startswith ("<"):
+            raise ValueError (_no_urls % (n, line))
+        else:
+            value = value.lstrip (" ")
+
+        if dn is None:
+            if attribute.lower () == "version":
+                continue
+            if attribute.lower () != "dn":
+                raise ValueError (_malformed_line % (n, line))
+            dn = value
+        elif attribute.lower () in ("changetype", "control"):
+            raise ValueError (_not_an_entry % (n, line))
+        else:
+            attributes.setdefault (attribute, []).append (value)
+
+_not_below = "Not below the base %s: %s"
+_duplicate = "Given twice: %s"
+_no_parent = "The parent is not given: %s"
+
+def _existing (con, dn, pageSize):
+    """Yields the entries of the subtree at dn, none if it doesn't exist"""
+    found = False
+    try:
+        for entry in con.searchPaged (dn, connection.scopeSubtree, pageSize = pageSize):
+            found = True
+            yield entry
+    except exceptions.NoSuchObject:
+        if found:
+            raise
+
+def plan (con, entries, pageSize = 500):
+    """Returns the DN of the base of a subtree, the first of entries (as
+    yielded by parseLdif) which the others have to be below, and the change
+    records (see diff) converging the subtree as read through con to
+    entries: those missing are added, those which differ are modified and
+    those not among entries are deleted. The parent of each entry, but the
+    base, has to be among entries. The records are scheduled, see
+    schedule. Returns None and no records if there are no entries.
+
+    Both the entries and the subtree are sorted (see sortedByDN) before
+    they are compared, so any errors in the entries are raised before
+    anything is changed."""
+    entries = iter (entries)
+    first = next (entries, None)
+    if first is None:
+        return None, []
+
+    dn = first[0]
+    base = connection.str2dn (dn)
+    def desired ():
+        yield first
+        for entry in entries:
+            rdns = connection.str2dn (entry[0])
+            if len(rdns) <= len(base) or _key (rdns[len(rdns) - len(base):]) != _key (base):
+                raise ValueError (_not_below % (dn, entry[0]))
+            yield entry
+
+    def checked (records):
+        # The keys of the entries from the base down to the previous one,
+        # since sorted by DN the parent of an entry is among them if given
+        path = []
+        for record in records:
+            key = record[0]
+            if path and path[-1] == key:
+                raise ValueError (_duplicate % record[1])
+            while path and not _ancestor (path[-1], key):
+                path.pop ()
+            if key and (not path or path[-1] != key[:-1]):
+                raise ValueError (_no_parent % record[1])
+            path.append (key)
+            yield record
+
+    live = sortedByDN (_existing (con, dn, pageSize), dn)
+    return dn, schedule (diff (live, dn, checked (sortedByDN (desired (), dn)), dn))
+
+def schedule (records):
+    """Returns the change records (see diff) in an order in which they can
+    be made pipelined with few waits: the deletes level by level from the
+    deepest, then the modifies and the adds level by level from the
+    shallowest.
+
+    A connection waits for the pending operations before one on a related
+    DN (see Connection.startPipelining), eg adding an entry below one just
+    added, so made in the order of diff (depth first) there would be a wait
+    at almost every level of every branch, while now there is about one for
+    each level. Unlike diff, this holds all the records in memory."""
+    levels = {"delete": {}, "modify": {}, "add": {}}
+    for record in records:
+        depth = len(connection.str2dn (record[1]))
+        levels[record[0]].setdefault (depth, []).append (record)
+
+    ordered = []
+    for changetype, deepestFirst in [("delete", True), ("modify", False), ("add", False)]:
+        for depth in sorted (levels[changetype].keys (), reverse = deepestFirst):
+            ordered.extend (levels[changetype][depth])
+    return ordered
+
+def execute (records, target, errback = None):
+    """Makes the change records (see diff), in their order, through the
+    connection target, pipelined (errors are passed to errback, see
+    _pipelined). Returns the number of changes made."""
+    with _pipelined (target, errback) as errors:
+        for changetype, dn, data in records:
+            if changetype == "add":
+                target.add (dn, data)
+            elif changetype == "delete":
+                target.delete (dn)
+            else:
+                target.modify (dn, data[0], data[1])
+    return len(records) - len(errors)
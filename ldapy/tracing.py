@@ -0,0 +1,158 @@
+# This file is part of ldapy.
+#
+# ldapy is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# ldapy is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with ldapy.  If not, see <http://www.gnu.org/licenses/>.
+
+# Tracing of what ldapy does, as a tree of spans: the Ldapy methods, the
+# population of Nodes and the operations of the connection (each round trip
+# to the server).
+#
+# Spans are only created when an exporter has been added, eg:
+#    import ldapy.tracing
+#    ldapy.tracing.tracer.addExporter (ldapy.tracing.JsonFileExporter ("trace.json"))
+#
+# or by setting the LDAPY_TRACE environment variable to a file name. An
+# exporter is any object with an export method, which is given each span when
+# it ends (see Span.toDict).
+
+import json
+import os
+import random
+import threading
+import time
+
+import logging
+logger = logging.getLogger("ldapy.%s" % __name__)
+
+def _id (n):
+    """A random id of n bytes, as hex"""
+    return "%0*x" % (2 * n, random.getrandbits (8 * n))
+
+class Span:
+    """A timed operation, which might be a part of another span"""
+
+    def __init__ (self, tracer, name, parent, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.traceId = parent.traceId if parent else _id (16)
+        self.spanId = _id (8)
+        self.parentId = parent.spanId if parent else None
+        self.attributes = attributes
+        self.start = None
+        self.end = None
+        self.error = None
+
+    def setAttribute (self, key, value):
+        self.attributes[key] = value
+
+    def __enter__ (self):
+        self.start = time.time ()
+        self.tracer._stack ().append (self)
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        self.end = time.time ()
+        if value is not None:
+            self.error = "%s: %s" % (type.__name__, value)
+        self.tracer._stack ().pop ()
+        self.tracer._export (self)
+        return False
+
+    def toDict (self):
+        return {"name": self.name, "trace_id": self.traceId,
+                "span_id": self.spanId, "parent_id": self.parentId,
+                "start": self.start, "end": self.end,
+                "duration": self.end - self.start,
+                "attributes": self.attributes, "error": self.error}
+
+class _NoSpan:
+    """Stands in for a Span when nothing is exported"""
+
+    def setAttribute (self, key, value):
+        pass
+
+    def __enter__ (self):
+        return self
+
+    def __exit__ (self, type, value, traceback):
+        return False
+
+_noSpan = _NoSpan ()
+
+class Tracer:
+    def __init__ (self):
+        self.exporters = []
+        self._local = threading.local ()
+
+    def addExporter (self, exporter):
+        self.exporters.append (exporter)
+
+    def removeExporter (self, exporter):
+        self.exporters.remove (exporter)
+
+    def _stack (self):
+        # Each thread has its own stack of active spans
+        if not hasattr (self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @property
+    def current (self):
+        stack = self._stack ()
+        return stack[-1] if stack else None
+
+    def span (self, name, **attributes):
+        """Returns a span to be used as a context manager, which is a part of
+        the current span of this thread (if any)"""
+        if not self.exporters:
+            return _noSpan
+        return Span (self, name, self.current, attributes)
+
+    def _export (self, span):
+        for exporter in self.exporters:
+            try:
+                exporter.export (span)
+            except Exception as e:
+                logger.error ("Unable to export span %s: %s" % (span.name, e))
+
+class MemoryExporter:
+    """Keeps the spans in a list, eg for tests"""
+
+    def __init__ (self):
+        self.spans = []
+
+    def export (self, span):
+        self.spans.append (span)
+
+class JsonFileExporter:
+    """Appends the spans to a file, as one JSON object per line"""
+
+    def __init__ (self, filename):
+        self.filename = filename
+        self._lock = threading.Lock ()
+        self._file = open (filename, "a")
+
+    def export (self, span):
+        line = json.dumps (span.toDict (), sort_keys = True)
+        with self._lock:
+            self._file.write (line + "\n")
+            self._file.flush ()
+
+tracer = Tracer ()
+
+def span (name, **attributes):
+    return tracer.span (name, **attributes)
+
+variable = "LDAPY_TRACE"
+if os.environ.get (variable):
+    tracer.addExporter (JsonFileExporter (os.environ[variable]))
@@ -8,6 +8,7 @@ setup (name="ldapy",
             "Development Status :: 3 - Alpha",
             "License :: OSI Approved :: GNU General Public License v3 or later (GPLv3+)",
             "Programming Language :: Python :: 2.7",
+            "Programming Language :: Python :: 3",
             "Topic :: Database :: Front-Ends"],
         keywords="ldap browser commandline",
         url="http://github.com/rootmos/ldapy",
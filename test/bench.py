@@ -0,0 +1,272 @@
+from __future__ import print_function
+import argparse
+import atexit
+import gc
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+from ldapy.memory_connection import MemoryConnection
+from ldapy.node import Node
+from ldapy.connection_data import ConnectionData, ConnectionDataManager
+from generator import Shape, load
+
+# Benchmarks of the hot paths of ldapy, run against a MemoryConnection so
+# they don't depend on an LDAP server (and its performance).
+#
+#    python test/bench.py                         # runs all benchmarks
+#    python test/bench.py --output new.json       # stores the results
+#    python test/bench.py --compare old.json      # compares with stored results
+#    python test/bench.py node_construction       # runs only some of them
+#
+# Each benchmark runs in its own process, so that the peak memory can be
+# attributed to it. Where Linux allows resetting the maximum resident set
+# size, it is reset after the preparation and the peak memory is how much the
+# operations added to what was resident then. Elsewhere it is the maximum
+# resident set size of the whole process, preparation included.
+
+root = "dc=nodomain"
+
+class Benchmark:
+    """A benchmark calls operation iterations times, with what prepare
+    returned and what setup returns as arguments. Only the operation is
+    measured: prepare is called once and setup before each operation (by
+    default giving the number of the iteration)."""
+
+    def __init__ (self, name, iterations, prepare, setup, operation):
+        self.name = name
+        self.iterations = iterations
+        self.prepare = prepare
+        self.setup = setup
+        self.operation = operation
+
+    def run (self):
+        state = self.prepare ()
+        baseline = _resetPeakMemory ()
+        times = []
+        for n in range (self.iterations):
+            argument = self.setup (state, n)
+            start = timeit.default_timer ()
+            self.operation (state, argument)
+            times.append (timeit.default_timer () - start)
+
+        times.sort ()
+        return {"iterations": self.iterations,
+                "ops_per_sec": self.iterations / sum (times) if sum (times) else None,
+                "p50": _percentile (times, 50),
+                "p99": _percentile (times, 99),
+                "peak_memory_kb": _peakMemory (baseline)}
+
+def _status (field):
+    """Returns the field of /proc/self/status in kB"""
+    with open ("/proc/self/status") as f:
+        for line in f:
+            if line.startswith (field + ":"):
+                return int (line.split ()[1])
+    raise IOError ("No %s in /proc/self/status" % field)
+
+def _resetPeakMemory ():
+    """Resets the maximum resident set size of the process and returns the
+    resident set size, or None if it can't be reset"""
+    gc.collect ()
+    try:
+        with open ("/proc/self/clear_refs", "w") as f:
+            f.write ("5")
+        return _status ("VmRSS")
+    except IOError:
+        return None
+
+def _peakMemory (baseline):
+    """Returns the peak memory in kB since _resetPeakMemory returned
+    baseline"""
+    if baseline is None:
+        return resource.getrusage (resource.RUSAGE_SELF).ru_maxrss
+    return max (0, _status ("VmHWM") - baseline)
+
+def _percentile (times, p):
+    return times[min (len(times) - 1, len(times) * p // 100)]
+
+def _directory (fanout, **kwargs):
+    con = MemoryConnection ([root])
+    load (con, Shape (root, fanout, **kwargs))
+    return con
+
+def _container (level = 0):
+    return "ou=Level%uContainer0,%s" % (level, root)
+
+def _iteration (state, n):
+    return n
+
+# Node construction, ie a base search and the parsing of the DN
+def _nodeConstruction (con, _):
+    Node (con, "uid=user0,%s" % _container ())
+
+# Populating the children of a container with 10000 children
+def _populateChildren (con, _):
+    Node (con, _container ()).children
+
+def _relativeDN (node, _):
+    node.relativeDN ()
+
+def _relativeDNPrepare ():
+    con = _directory ([10, 10, 10])
+    return Node (con, "uid=user0,ou=Level1Container0,%s" % _container ())
+
+def _completeChild (con, _):
+    Node (con, _container (), lazy = True).completeChild ("uid=user12")
+
+# Adding a value to an attribute which has 10000 values
+def _setAttributePrepare ():
+    con = MemoryConnection ([root])
+    dn = "cn=huge,%s" % root
+    con.add (dn, {"objectClass": "groupOfNames",
+        "member": ["uid=user%u,%s" % (n, root) for n in range (10000)]})
+    return Node (con, dn)
+
+def _setAttribute (node, n):
+    node.setAttribute ("member", newValue = "uid=new%u,%s" % (n, root))
+
+# Deleting a container with 100 children, one at a time
+def _deleteSetup (con, n):
+    container = "ou=Deleted%u,%s" % (n, root)
+    con.add (container, {"objectClass": "organizationalUnit"})
+    for m in range (100):
+        con.add ("cn=leaf%u,%s" % (m, container), {"objectClass": "organizationalRole"})
+    return Node (con, container)
+
+def _delete (con, node):
+    node.delete ()
+
+# Loading and saving a history with 1000 recent connections
+def _historyPrepare ():
+    directory = tempfile.mkdtemp (prefix = "ldapy-bench")
+    atexit.register (shutil.rmtree, directory)
+    ConnectionDataManager.filename = os.path.join (directory, "history")
+    recent = [ConnectionData ("ldap://host%u" % n, "cn=admin,%s" % root) for n in range (1000)]
+    with open (ConnectionDataManager.filename, "w") as f:
+        f.write (ConnectionDataManager._unparse (recent, {}))
+    return None
+
+def _historyLoad (_, __):
+    ConnectionDataManager ().recent
+
+# Reading the most recent connection, as when connecting by default
+def _historyLatestPrepare ():
+    _historyPrepare ()
+    ConnectionDataManager ().addRecentConnection (ConnectionData ("ldap://latest", ""))
+
+def _historyLatest (_, __):
+    ConnectionDataManager ().getRecentConnection ()
+
+def _historySave (manager, n):
+    manager.addRecentConnection (ConnectionData ("ldap://new%u" % n, ""))
+
+def _historySavePrepare ():
+    _historyPrepare ()
+    return ConnectionDataManager ()
+
+# Starting ldapy to list the previous connections, as done from scripts
+def _startupPrepare ():
+    _historyPrepare ()
+    env = dict (os.environ)
+    env[ConnectionDataManager.variable] = ConnectionDataManager.filename
+    package = os.path.dirname (os.path.dirname (os.path.abspath (__file__)))
+    env["PYTHONPATH"] = os.pathsep.join ([package, env.get ("PYTHONPATH", "")])
+    script = os.path.join (package, "scripts", "ldapy")
+    return [sys.executable, script, "--previous"], env
+
+def _startup (state, _):
+    command, env = state
+    with open (os.devnull, "w") as devnull:
+        subprocess.check_call (command, env = env, stdout = devnull)
+
+benchmarks = [
+    Benchmark ("node_construction", 10000, lambda: _directory ([10, 10]),
+        _iteration, _nodeConstruction),
+    Benchmark ("populate_children_wide", 20, lambda: _directory ([1, 10000]),
+        _iteration, _populateChildren),
+    Benchmark ("relative_dn", 10000, _relativeDNPrepare, _iteration, _relativeDN),
+    Benchmark ("complete_child", 200, lambda: _directory ([1, 10000]),
+        _iteration, _completeChild),
+    Benchmark ("set_attribute_huge", 200, _setAttributePrepare, _iteration, _setAttribute),
+    Benchmark ("recursive_delete", 50, lambda: MemoryConnection ([root]),
+        _deleteSetup, _delete),
+    Benchmark ("connection_data_load", 200, _historyPrepare, _iteration, _historyLoad),
+    Benchmark ("connection_data_latest", 1000, _historyLatestPrepare, _iteration, _historyLatest),
+    Benchmark ("connection_data_save", 200, _historySavePrepare, _iteration, _historySave),
+    Benchmark ("startup_previous", 20, _startupPrepare, _iteration, _startup),
+    ]
+
+def runIsolated (name):
+    """Runs the benchmark in a new process and returns its results"""
+    output = subprocess.check_output ([sys.executable, os.path.abspath (__file__),
+        "--isolated", name])
+    return json.loads (output)
+
+def compare (old, new):
+    """Prints the change of each benchmark between old and new results, and
+    returns the names of the benchmarks which got slower by more than 10%"""
+    slower = []
+    print ("%-24s %14s %14s %8s" % ("benchmark", "old ops/sec", "new ops/sec", "change"))
+    for name in sorted (new.keys ()):
+        if name not in old or not old[name]["ops_per_sec"] or not new[name]["ops_per_sec"]:
+            continue
+        change = new[name]["ops_per_sec"] / old[name]["ops_per_sec"] - 1
+        print ("%-24s %14.1f %14.1f %+7.1f%%" % (name,
+                old[name]["ops_per_sec"], new[name]["ops_per_sec"], 100 * change))
+        if change < -0.1:
+            slower.append (name)
+    return slower
+
+def report (results):
+    print ("%-24s %14s %12s %12s %12s" % ("benchmark", "ops/sec", "p50 (ms)", "p99 (ms)", "peak (kB)"))
+    for name in sorted (results.keys ()):
+        r = results[name]
+        print ("%-24s %14.1f %12.3f %12.3f %12u" % (name, r["ops_per_sec"] or 0,
+                1000 * r["p50"], 1000 * r["p99"], r["peak_memory_kb"]))
+
+def main (args = None):
+    parser = argparse.ArgumentParser (description="Benchmarks ldapy.")
+    parser.add_argument ("names", nargs="*", metavar="BENCHMARK",
+            help="The benchmarks to run, all if none are given: %s" %
+            ", ".join ([b.name for b in benchmarks]))
+    parser.add_argument ("--output", "-o", help="Stores the results as JSON in this file.")
+    parser.add_argument ("--compare", "-c", metavar="FILE",
+            help="Compares the results with the ones stored in FILE, failing if any benchmark got slower.")
+    parser.add_argument ("--isolated", help=argparse.SUPPRESS)
+    args = parser.parse_args (args)
+
+    byName = dict ([(b.name, b) for b in benchmarks])
+
+    if args.isolated:
+        print (json.dumps (byName[args.isolated].run ()))
+        return 0
+
+    for name in args.names:
+        if name not in byName:
+            parser.error ("unknown benchmark: %s" % name)
+
+    results = {}
+    for benchmark in benchmarks:
+        if not args.names or benchmark.name in args.names:
+            results[benchmark.name] = runIsolated (benchmark.name)
+
+    report (results)
+
+    if args.output:
+        with open (args.output, "w") as f:
+            json.dump (results, f, indent = 2, sort_keys = True)
+
+    if args.compare:
+        with open (args.compare) as f:
+            if compare (json.load (f), results):
+                return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit (main ())
@@ -1,4 +1,6 @@
 import provisioning
+import threading
+import time
 from ldapy.connection import Connection
 
 host = "localhost"
@@ -14,3 +16,22 @@ def getConnection (traces = 0):
 def provision ():
     return provisioning.provision(uri, admin, admin_password)
 
+
+def inThreads (function, n = 5):
+    """Calls function in n threads at once and returns what they returned"""
+    results = []
+    threads = [threading.Thread (target = lambda: results.append (function ()))
+            for _ in range (n)]
+    for thread in threads:
+        thread.start ()
+    for thread in threads:
+        thread.join ()
+    return results
+
+def slowly (function, seconds = 0.05):
+    """Returns function delayed by seconds, so that calls from several
+    threads overlap"""
+    def slow (*args, **kwargs):
+        time.sleep (seconds)
+        return function (*args, **kwargs)
+    return slow
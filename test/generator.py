@@ -0,0 +1,163 @@
+from __future__ import print_function
+import argparse
+import random
+import sys
+import ldif
+from ldapy import connection
+
+# Generates directories of a configurable shape, for testing how ldapy scales.
+#
+# Example:
+#    shape = Shape("dc=nodomain", fanout=[10, 100], groups=2, members=50)
+#    load(con, shape)                     # adds the 1010 entries + 3 for the groups
+#    writeLdif(shape, open("big.ldif", "w"))
+#
+# or from the command line:
+#    python test/generator.py --fanout 100 100 100 --groups 10 --members 10000 > big.ldif
+
+class Shape:
+    """The shape of a generated directory below root.
+
+    fanout is the number of children at each level, where the entries on
+    the last level are people (inetOrgPerson) and the ones above are
+    containers (organizationalUnit). Each person gets a description of
+    attributeSize characters. If groups are asked for, they are put in
+    ou=Groups below root, each with members (groupOfNames) picked among the
+    people. The same seed gives the same directory."""
+
+    def __init__ (self, root, fanout, attributeSize = 32, groups = 0, members = 0, seed = 0):
+        self.root = root
+        self.fanout = fanout
+        self.attributeSize = attributeSize
+        self.groups = groups
+        self.members = members
+        self.seed = seed
+
+    @property
+    def people (self):
+        n = 1
+        for f in self.fanout:
+            n *= f
+        return n
+
+    @property
+    def size (self):
+        """The number of entries generated (the root excluded)"""
+        size, n = 0, 1
+        for f in self.fanout:
+            n *= f
+            size += n
+        if self.groups:
+            size += 1 + self.groups
+        return size
+
+    def personDN (self, index):
+        """The DN of the person with the index, which is 0 <= index < people"""
+        rdns = ["uid=user%u" % index]
+        index //= self.fanout[-1]
+        for level in range (len(self.fanout) - 2, -1, -1):
+            rdns.append ("ou=%s" % self._containerName (level, index % self.fanout[level]))
+            index //= self.fanout[level]
+        return ",".join (rdns + [self.root])
+
+    def _containerName (self, level, n):
+        return "Level%uContainer%u" % (level, n)
+
+    def entries (self):
+        """Yields the entries as tuples of DN and attributes, parents before
+        their children, without keeping them in memory"""
+        rng = random.Random (self.seed)
+        for entry in self._level (rng, 0, self.root, 0):
+            yield entry
+
+        if self.groups:
+            groups = "ou=Groups,%s" % self.root
+            yield groups, {"objectClass": ["organizationalUnit"], "ou": ["Groups"]}
+
+            for n in range (self.groups):
+                members = rng.sample (range (self.people), min (self.members, self.people))
+                yield "cn=group%u,%s" % (n, groups), {
+                        "objectClass": ["groupOfNames"],
+                        "cn": ["group%u" % n],
+                        "member": [self.personDN (m) for m in sorted (members)]}
+
+    def _level (self, rng, level, parent, index):
+        # index is the number of the parent among the entries on its level
+        if level == len(self.fanout) - 1:
+            for n in range (index * self.fanout[level], (index + 1) * self.fanout[level]):
+                uid = "user%u" % n
+                yield "uid=%s,%s" % (uid, parent), {
+                        "objectClass": ["inetOrgPerson"],
+                        "uid": [uid], "cn": [uid], "sn": ["User %u" % n],
+                        "description": [self._text (rng)]}
+            return
+
+        for n in range (self.fanout[level]):
+            name = self._containerName (level, n)
+            dn = "ou=%s,%s" % (name, parent)
+            yield dn, {"objectClass": ["organizationalUnit"], "ou": [name]}
+
+            for entry in self._level (rng, level + 1, dn, index * self.fanout[level] + n):
+                yield entry
+
+    _letters = "abcdefghijklmnopqrstuvwxyz"
+
+    def _text (self, rng):
+        return "".join ([rng.choice (self._letters) for _ in range (self.attributeSize)])
+
+def writeLdif (shape, output):
+    """Writes the entries of shape as LDIF to output, one at a time"""
+    writer = ldif.LDIFWriter (output)
+    for dn, attributes in shape.entries ():
+        # python-ldap writes the values as bytes on Python 3
+        writer.unparse (dn, connection._encode (attributes))
+
+def load (con, shape, errback = None):
+    """Adds the entries of shape using con (a Connection or anything with
+    the same interface), pipelining the adds. Returns the number of entries
+    added."""
+    n = 0
+    con.startPipelining (errback)
+    try:
+        for dn, attributes in shape.entries ():
+            con.add (dn, attributes)
+            n += 1
+    finally:
+        con.stopPipelining ()
+    return n
+
+def main (args = None):
+    parser = argparse.ArgumentParser (description="Generates a directory of a given shape.")
+    parser.add_argument ("--root", default="dc=nodomain",
+            help="The DN below which the entries are generated.")
+    parser.add_argument ("--fanout", type=int, nargs="+", default=[10, 100],
+            help="The number of children at each level, the last level consisting of people.")
+    parser.add_argument ("--attribute-size", type=int, default=32,
+            help="The length of the description of each person.")
+    parser.add_argument ("--groups", type=int, default=0,
+            help="The number of groups.")
+    parser.add_argument ("--members", type=int, default=0,
+            help="The number of members of each group.")
+    parser.add_argument ("--seed", type=int, default=0)
+    parser.add_argument ("--uri",
+            help="Adds the entries using this URI instead of writing LDIF to standard output.")
+    parser.add_argument ("--bind-dn", "-D", default="cn=admin,dc=nodomain")
+    parser.add_argument ("--password", "-w", default="foobar")
+    args = parser.parse_args (args)
+
+    shape = Shape (args.root, args.fanout, args.attribute_size,
+            args.groups, args.members, args.seed)
+
+    if args.uri:
+        from ldapy.connection import Connection
+        con = Connection (args.uri)
+        con.bind (args.bind_dn, args.password)
+
+        def report (e):
+            print (e, file = sys.stderr)
+        print ("Added %u entries" % load (con, shape, report), file = sys.stderr)
+    else:
+        writeLdif (shape, sys.stdout)
+
+if __name__ == "__main__":
+    main ()
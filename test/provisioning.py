@@ -1,3 +1,4 @@
+from __future__ import print_function
 import ldap
 import ldap.modlist
 import collections
@@ -84,11 +85,11 @@ class Provisioning:
     def delete(self, dn):
         try:
             results = self.ldap.search_s(str(dn), ldap.SCOPE_BASE)
-            print "DEBUG: Deleting object %s: %s" % (dn, results)
+            print ("DEBUG: Deleting object %s: %s" % (dn, results))
 
             self.ldap.delete_s(str(dn))
         except ldap.NO_SUCH_OBJECT:
-            print "WARNING: %s already deleted" % dn
+            print ("WARNING: %s already deleted" % dn)
 
     def attribute(self, dn, attribute):
         results = self.ldap.search_s(str(dn), ldap.SCOPE_BASE, attrlist = [attribute])
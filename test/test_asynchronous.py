@@ -0,0 +1,180 @@
+import sys
+import unittest2
+import configuration
+from ldapy.connection import ConnectionError, scopeBase, scopeOneLevel
+from ldapy.exceptions import NoSuchObject, AlreadyExists
+
+# The asyncio API needs Python 3.6, and these tests are written without its
+# syntax so that they can be loaded by Python 2 (and skipped)
+asynchronous = sys.version_info >= (3, 6)
+if asynchronous:
+    import asyncio
+    from ldapy.asynchronous import AsyncConnection, AsyncNode, AsyncLdapy
+
+def run (coroutine):
+    return asyncio.get_event_loop ().run_until_complete (coroutine)
+
+def gather (coroutines):
+    return run (asyncio.gather (*coroutines))
+
+def collect (iterator, n):
+    """Returns the first n items of an asynchronous iterator"""
+    return [run (iterator.__anext__ ()) for _ in range (n)]
+
+class AsyncTestCase (unittest2.TestCase):
+    """Binds an AsyncConnection and adds a container below the root, which
+    is deleted afterwards"""
+
+    def setUp (self):
+        self.con = AsyncConnection (configuration.uri)
+        run (self.con.bind (configuration.admin, configuration.admin_password))
+        self.root = run (self.con.roots ())[0]
+        self.container = "ou=Async,%s" % self.root
+        run (self.con.add (self.container, {"objectClass": "organizationalUnit", "ou": "Async"}))
+
+    def tearDown (self):
+        run (AsyncNode (self.con, self.container).delete ())
+        self.con.close ()
+
+    def addLeaves (self, n):
+        dns = ["cn=leaf%u,%s" % (m, self.container) for m in range (n)]
+        gather ([self.con.add (dn, {"objectClass": "organizationalRole",
+            "cn": "leaf%u" % m, "description": "leaf"}) for m, dn in enumerate (dns)])
+        return dns
+
+@unittest2.skipUnless (asynchronous, "Needs Python 3.6")
+class AsyncConnectionTests (AsyncTestCase):
+    def test_bind (self):
+        self.assertTrue (self.con.connected)
+
+    def test_bind_auth_error (self):
+        con = AsyncConnection (configuration.uri)
+        with self.assertRaises (ConnectionError):
+            run (con.bind (configuration.admin, "wrong"))
+        self.assertFalse (con.connected)
+
+    def test_concurrent_operations (self):
+        dns = self.addLeaves (50)
+        results = run (self.con.search (self.container, scopeOneLevel))
+        self.assertEqual (sorted ([dn.lower () for dn in dns]),
+                sorted ([dn.lower () for dn, _ in results]))
+
+        entries = gather ([self.con.search (dn, scopeBase) for dn in dns])
+        self.assertEqual ([["leaf"]] * 50, [e[0][1]["description"] for e in entries])
+        self.assertFalse (self.con._pending)
+
+    def test_search_iter_is_abandoned (self):
+        self.addLeaves (10)
+        iterator = self.con.searchIter (self.container, scopeOneLevel)
+        self.assertEqual (2, len(collect (iterator, 2)))
+        run (iterator.aclose ())
+        self.assertFalse (self.con._pending)
+
+        # The connection is still usable
+        self.assertEqual (10, len(run (self.con.search (self.container, scopeOneLevel))))
+
+    def test_search_limited (self):
+        self.addLeaves (10)
+        results, complete = run (self.con.searchLimited (self.container,
+            scopeOneLevel, "(cn=leaf*)", sizelimit = 5))
+        self.assertEqual (5, len(results))
+        self.assertFalse (complete)
+
+        results, complete = run (self.con.searchLimited (self.container,
+            scopeOneLevel, "(cn=leaf1*)", sizelimit = 5))
+        self.assertEqual (1, len(results))
+        self.assertTrue (complete)
+
+    def test_errors_are_converted (self):
+        with self.assertRaises (NoSuchObject):
+            run (self.con.search ("ou=nonexistent,%s" % self.root, scopeBase))
+
+        with self.assertRaises (AlreadyExists):
+            run (self.con.add (self.container, {"objectClass": "organizationalUnit"}))
+
+    def test_identical_searches_are_coalesced (self):
+        self.addLeaves (3)
+        self.con.statistics.reset ()
+        results = gather ([self.con.search (self.container, scopeOneLevel) for _ in range (5)])
+        self.assertEqual (1, self.con.statistics.roundTrips)
+        self.assertEqual ([3] * 5, [len(r) for r in results])
+        self.assertEqual (5, len(set ([id(r[0][1]) for r in results])))
+
+    def test_statistics (self):
+        self.con.statistics.reset ()
+        self.addLeaves (3)
+        run (self.con.search (self.container, scopeOneLevel))
+        self.assertEqual (3, self.con.statistics.summaries["add"].count)
+        self.assertEqual (3, self.con.statistics.summaries["search"].entries)
+
+@unittest2.skipUnless (asynchronous, "Needs Python 3.6")
+class AsyncNodeTests (AsyncTestCase):
+    def test_creation_is_lazy (self):
+        self.con.statistics.reset ()
+        node = AsyncNode (self.con, self.container)
+        self.assertIsNone (node.attributes)
+        self.assertEqual (0, self.con.statistics.roundTrips)
+
+    def test_children_are_read_once (self):
+        self.addLeaves (5)
+        node = AsyncNode (self.con, self.container)
+        self.con.statistics.reset ()
+        children = gather ([node.getChildren () for _ in range (10)])
+        self.assertEqual (1, self.con.statistics.roundTrips)
+        self.assertEqual (5, len(children[0]))
+        self.assertEqual ("leaf", children[0][0].attributes["description"][0])
+
+    def test_set_attribute (self):
+        dn = self.addLeaves (1)[0]
+        node = AsyncNode (self.con, dn)
+        run (node.setAttribute ("description", oldValue = "leaf", newValue = "changed"))
+        self.assertEqual (["changed"], node.attributes["description"])
+
+        entry = run (self.con.search (dn, scopeBase))[0]
+        self.assertEqual (["changed"], entry[1]["description"])
+
+    def test_delete_subtree (self):
+        self.addLeaves (20)
+        node = AsyncNode (self.con, self.container)
+        run (node.delete ())
+        with self.assertRaises (NoSuchObject):
+            run (self.con.search (self.container, scopeBase))
+
+        # Recreated for tearDown
+        run (self.con.add (self.container, {"objectClass": "organizationalUnit", "ou": "Async"}))
+
+@unittest2.skipUnless (asynchronous, "Needs Python 3.6")
+class AsyncLdapyTests (AsyncTestCase):
+    def setUp (self):
+        AsyncTestCase.setUp (self)
+        self.ldapy = AsyncLdapy (self.con)
+
+    def test_browse (self):
+        self.addLeaves (3)
+        run (self.ldapy.changeDN (self.container))
+        self.assertEqual (self.container, self.ldapy.cwd)
+        self.assertEqual (["cn=leaf0", "cn=leaf1", "cn=leaf2"],
+                sorted (run (self.ldapy.children ())))
+
+        attributes = run (self.ldapy.getAttributes ("cn=leaf1"))
+        self.assertEqual (["leaf"], attributes["description"])
+
+        run (self.ldapy.goUpOneLevel ())
+        self.assertEqual (self.root, self.ldapy.cwd)
+
+    def test_complete_child (self):
+        self.addLeaves (12)
+        run (self.ldapy.changeDN (self.container))
+        self.assertEqual (["cn=leaf1", "cn=leaf10", "cn=leaf11"],
+                sorted (run (self.ldapy.completeChild ("cn=leaf1"))))
+        self.assertEqual (["cn=leaf1", "cn=leaf10", "cn=leaf11"],
+                sorted (run (self.ldapy.completeChild ("CN=Leaf1"))))
+        self.assertEqual (["../ou=Async"], run (self.ldapy.completeChild ("../ou=Asy")))
+
+    def test_add_and_delete (self):
+        run (self.ldapy.changeDN (self.container))
+        run (self.ldapy.add ("cn=new", {"objectClass": "organizationalRole", "cn": "new"}))
+        self.assertEqual (["cn=new"], run (self.ldapy.children ()))
+
+        run (self.ldapy.delete ("cn=new"))
+        self.assertEqual ([], run (self.ldapy.children ()))
@@ -6,7 +6,11 @@ import pexpect
 import os
 import sys
 import syslog
-from ldapy.commandline import Commandline, Command, NoSuchCommand, ExitCommand
+import tempfile
+import shutil
+import pstats
+from ldapy.commandline import Commandline, Command, NoSuchCommand, ExitCommand, splitCommands
+from ldapy.statistics import Statistics, Record
 
 class Parser (unittest2.TestCase):
 
@@ -104,6 +108,124 @@ class Parser (unittest2.TestCase):
         cmd.usage.reset_mock ()
 
 
+    def test_split_commands (self):
+        self.assertListEqual (["a", " b c", " d"], splitCommands ("a; b c; d"))
+        self.assertListEqual (["a", "b"], splitCommands ("a;;b; "))
+        self.assertListEqual (["a 'b;c'", ' "d;e"'], splitCommands ("a 'b;c'; \"d;e\""))
+        self.assertListEqual (["a b\\;c"], splitCommands ("a b\\;c"))
+
+
+class Batch (unittest2.TestCase):
+
+    def test_execute_does_not_touch_readline (self):
+        with mock.patch ("readline.set_completer") as completer_mock:
+            Commandline ([], interactive = False)
+
+        self.assertFalse (completer_mock.called)
+
+    def test_execute_dispatches_every_command (self):
+        cmd = Command ("cmd")
+        cmd.__call__ = mock.create_autospec (cmd.__call__)
+        cli = Commandline ([cmd], interactive = False)
+
+        cli.execute (["cmd a; cmd b\n", "# cmd c\n", "\n", "cmd d"])
+
+        calls = [mock.call(["a"]), mock.call(["b"]), mock.call(["d"])]
+        self.assertListEqual (cmd.__call__.call_args_list, calls)
+
+    def test_execute_stops_on_exit (self):
+        cmd = Command ("cmd")
+        cmd.__call__ = mock.create_autospec (cmd.__call__)
+        cli = Commandline ([cmd], interactive = False)
+
+        cli.execute (["cmd a; exit; cmd b", "cmd c"])
+
+        cmd.__call__.assert_called_once_with (["a"])
+
+    def test_execute_continues_after_errors (self):
+        cmd = Command ("cmd")
+        cmd.__call__ = mock.MagicMock (side_effect=[Exception("Foobar"), None])
+        cli = Commandline ([cmd], interactive = False)
+
+        with mock.patch('sys.stdout.write') as print_mock:
+            cli.execute (["cmd; no_such_command; cmd"])
+
+        expect_calls = [mock.call("Foobar"), mock.call("\n"),
+                mock.call(Commandline._no_such_command % "no_such_command"),
+                mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+        self.assertEqual (cmd.__call__.call_count, 2)
+
+    def test_errors_are_counted (self):
+        cmd = Command ("cmd")
+        cmd.__call__ = mock.MagicMock (side_effect=[Exception("Foobar"), None])
+        failing = Command ("failing")
+        failing.__call__ = lambda args: failing.error ("Failed")
+        cli = Commandline ([cmd, failing], interactive = False)
+
+        with mock.patch('sys.stdout.write'):
+            cli.execute (["cmd; cmd; failing; no_such_command"])
+            self.assertEqual (3, cli.errorCount)
+
+            # Eg by a pipelined operation
+            cli.report (Exception ("Later"))
+        self.assertEqual (4, cli.errorCount)
+
+    def test_no_errors (self):
+        cmd = Command ("cmd")
+        cmd.__call__ = mock.create_autospec (cmd.__call__)
+        cli = Commandline ([cmd], interactive = False)
+        cli.execute (["cmd a; cmd b"])
+        self.assertEqual (0, cli.errorCount)
+
+
+class Measuring (unittest2.TestCase):
+
+    def setUp (self):
+        self.statistics = Statistics ()
+
+        def waitForServer (args):
+            self.statistics.record (Record ("search", "", None, 0, 0, 0.5))
+
+        self.cmd = Command ("cmd")
+        self.cmd.__call__ = mock.MagicMock (side_effect = waitForServer)
+        self.cli = Commandline ([self.cmd], interactive = False, statistics = self.statistics)
+
+    def test_time (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cli.parse_and_dispatch ("time cmd a")
+
+        self.cmd.__call__.assert_called_once_with (["a"])
+        printed = print_mock.call_args_list[0][0][0]
+        self.assertIn ("server 0.500s (1 round trips)", printed)
+
+    def test_time_without_command (self):
+        with self.assertRaises (NoSuchCommand):
+            self.cli.parse_and_dispatch ("time")
+
+    def test_profile (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cli.parse_and_dispatch ("profile cmd a")
+
+        self.cmd.__call__.assert_called_once_with (["a"])
+        printed = "".join ([call[0][0] for call in print_mock.call_args_list])
+        self.assertIn ("function calls", printed)
+        self.assertIn ("server 0.500s", printed)
+
+    def test_profiles_are_dumped_in_batch_mode (self):
+        directory = tempfile.mkdtemp ()
+        try:
+            with mock.patch.dict (os.environ, {Commandline.profileVariable: directory}):
+                self.cli.execute (["cmd a; cmd b"])
+
+            self.assertEqual (self.cmd.__call__.call_count, 2)
+            self.assertListEqual (sorted (os.listdir (directory)),
+                    ["0001-cmd.prof", "0002-cmd.prof"])
+            pstats.Stats (os.path.join (directory, "0001-cmd.prof"))
+        finally:
+            shutil.rmtree (directory)
+
+
 class BasicFunctionality (unittest2.TestCase):
 
     def test_exit (self):
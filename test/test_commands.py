@@ -2,8 +2,12 @@ import configuration
 from ldapy.ldapy import Ldapy, AlreadyAtRoot
 import unittest2
 import mock
-from ldapy.commands import ChangeDN, List, PrintWorkingDN, Cat, Modify, Delete, Add
-from ldapy.exceptions import NoSuchObject, NoSuchObjectInRoot
+from ldapy.commands import ChangeDN, List, PrintWorkingDN, Cat, Modify, Delete, Add, Move, Rename, Copy, Diff, Apply, Stats
+from ldapy.memory_connection import MemoryConnection
+from ldapy.node import Node
+from ldapy.exceptions import NoSuchObject, NoSuchObjectInRoot, AlreadyExists
+from ldapy import subtree
+import tempfile
 
 def getLdapy ():
     con = configuration.getConnection ()
@@ -695,3 +699,356 @@ class AddTests (unittest2.TestCase):
 
         cmd.usage.assert_called_once_with (args)
 
+class StatsTests (unittest2.TestCase):
+    def setUp (self):
+        self.ldapy = Ldapy (MemoryConnection (["dc=nodomain"]))
+        self.cmd = Stats (self.ldapy)
+
+    def test_usage (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd.usage ([])
+
+        msg = Stats._usage % "stats"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_stats (self):
+        self.ldapy.connection.statistics.reset ()
+        self.ldapy.changeDN ("dc=nodomain")
+        self.ldapy.children
+
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd ([])
+
+        printed = "".join ([call[0][0] for call in print_mock.call_args_list])
+        self.assertIn ("Round trips: 1", printed)
+        self.assertIn ("search latency:", printed)
+
+    def test_reset (self):
+        self.cmd (["reset"])
+        self.assertEqual (self.ldapy.connection.statistics.roundTrips, 0)
+
+    def test_log (self):
+        self.cmd (["reset"])
+        self.ldapy.changeDN ("dc=nodomain")
+        self.ldapy.children
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["log"])
+
+        printed = print_mock.call_args_list[0][0][0]
+        self.assertTrue (printed.startswith ("search"))
+        self.assertTrue (printed.endswith ("dc=nodomain"))
+
+    def test_syntax_error_calls_usage (self):
+        self.cmd.usage = mock.create_autospec(self.cmd.usage)
+        with mock.patch('sys.stdout.write'):
+            self.cmd (["foo"])
+        self.assertTrue (self.cmd.usage.called)
+
+    def test_completer (self):
+        self.assertListEqual (self.cmd.complete (["r"]), ["reset"])
+        self.assertListEqual (self.cmd.complete (["reset", ""]), [])
+
+class MoveTests (unittest2.TestCase):
+    def setUp (self):
+        con = MemoryConnection (["dc=nodomain"])
+        con.add ("ou=People,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("ou=Groups,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "Groups"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN ("dc=nodomain")
+        self.cmd = Move (self.ldapy)
+
+    def test_usage (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd.usage ([])
+
+        msg = Move._usage % "mv"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_successful_move_calls_ldapy_move (self):
+        self.ldapy.move = mock.create_autospec (self.ldapy.move)
+        self.cmd (["ou=People", "ou=Groups"])
+        self.ldapy.move.assert_called_once_with ("ou=People", "ou=Groups")
+
+    def test_wrong_number_of_arguments_prints_error_calls_usage (self):
+        self.cmd.usage = mock.create_autospec(self.cmd.usage)
+        args = ["ou=People"]
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (args)
+
+        msg = Move._wrong_number_of_arguments % self.cmd.name
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+        self.cmd.usage.assert_called_once_with (args)
+
+    def test_move (self):
+        self.cmd (["ou=People", "ou=Groups"])
+        self.assertListEqual (self.ldapy.children, ["ou=Groups"])
+
+    def test_move_below_itself (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["ou=People", "ou=People/ou=Staff"])
+
+        msg = Node._cannot_move_below_itself % "ou=People,dc=nodomain"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_completer (self):
+        self.assertListEqual (sorted (self.cmd.complete ([])), ["ou=Groups", "ou=People"])
+        self.assertListEqual (self.cmd.complete (["ou=People", "ou=G"]), ["ou=Groups"])
+        self.assertListEqual (self.cmd.complete (["ou=People", "ou=Groups", ""]), [])
+
+class RenameTests (unittest2.TestCase):
+    def setUp (self):
+        con = MemoryConnection (["dc=nodomain"])
+        con.add ("ou=People,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("ou=Groups,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "Groups"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN ("dc=nodomain")
+        self.cmd = Rename (self.ldapy)
+
+    def test_usage (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd.usage ([])
+
+        msg = Rename._usage % "rename"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_rename (self):
+        self.cmd (["ou=People", "ou=Staff"])
+        self.assertItemsEqual (self.ldapy.children, ["ou=Groups", "ou=Staff"])
+
+    def test_existing_RDN (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["ou=People", "ou=Groups"])
+
+        msg = AlreadyExists._dn_already_exists % "ou=Groups,dc=nodomain"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_non_existent_RDN (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["ou=Foobar", "ou=Staff"])
+
+        msg = NoSuchObject._dn_does_not_exist % "ou=Foobar,dc=nodomain"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_completer (self):
+        self.assertListEqual (self.cmd.complete (["ou=P"]), ["ou=People"])
+        self.assertListEqual (self.cmd.complete (["ou=People", ""]), [])
+
+class CopyTests (unittest2.TestCase):
+    def setUp (self):
+        con = MemoryConnection (["dc=nodomain"])
+        con.add ("ou=People,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "People"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN ("dc=nodomain")
+        self.cmd = Copy (self.ldapy)
+
+    def test_usage (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd.usage ([])
+
+        msg = Copy._usage % "cp"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_successful_copy_calls_ldapy_copy (self):
+        self.ldapy.copy = mock.Mock ()
+        self.cmd (["-r", "ou=People", "ou=Staff"])
+        self.ldapy.copy.assert_called_once_with ("ou=People", "ou=Staff", target = None,
+                recursive = True, errback = mock.ANY)
+
+    def test_copy_to_saved_connection (self):
+        self.ldapy.copy = mock.Mock ()
+        self.ldapy._lazyConnectionDataManager = mock.Mock ()
+        other = MemoryConnection (["dc=other"])
+        with mock.patch ("ldapy.connection.connect", return_value = other) as connect:
+            with mock.patch.object (other, "close") as close:
+                self.cmd (["ou=People", "--to", "backup", "dc=other"])
+
+        self.ldapy.connectionDataManager.getConnection.assert_called_once_with ("backup")
+        connect.assert_called_once_with (self.ldapy.connectionDataManager.getConnection.return_value)
+        self.assertIs (other, self.ldapy.copy.call_args[1]["target"].connection)
+        self.assertFalse (self.ldapy.copy.call_args[1]["recursive"])
+        close.assert_called_once_with ()
+
+    def test_wrong_arguments_prints_error_calls_usage (self):
+        for args in [["ou=People"], ["-x", "ou=People", "ou=Staff"], ["ou=People", "ou=Staff", "--to"]]:
+            self.cmd = Copy (self.ldapy)
+            self.cmd.usage = mock.create_autospec(self.cmd.usage)
+            with mock.patch('sys.stdout.write') as print_mock:
+                self.cmd (args)
+
+            msg = Copy._wrong_arguments % self.cmd.name
+            expect_calls = [mock.call(msg), mock.call("\n")]
+            self.assertListEqual (print_mock.call_args_list, expect_calls)
+            self.cmd.usage.assert_called_once_with (args)
+
+    def test_errors_are_printed (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["ou=People", "."])
+
+        msg = AlreadyExists._dn_already_exists % "ou=People,dc=nodomain"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+        self.assertEqual (1, self.cmd.errors)
+
+    def test_completer (self):
+        self.assertListEqual (self.cmd.complete (["-r"]), ["ou=People"])
+        self.assertListEqual (self.cmd.complete (["-r", "ou=People", "ou=P"]), ["ou=People"])
+        self.assertListEqual (self.cmd.complete (["ou=People", "ou=People", ""]), [])
+
+class DiffTests (unittest2.TestCase):
+    def setUp (self):
+        con = MemoryConnection (["dc=nodomain"])
+        con.add ("ou=People,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("ou=Staff,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "Staff"})
+        con.add ("uid=john,ou=Staff,dc=nodomain", {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN ("dc=nodomain")
+        self.cmd = Diff (self.ldapy)
+
+    def test_usage (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd.usage ([])
+
+        msg = Diff._usage % "diff"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_prints_ldif (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["ou=People", "ou=Staff"])
+
+        msg = "\n".join (["dn: uid=john,ou=People,dc=nodomain", "changetype: add",
+            "objectClass: person", "uid: john"])
+        expect_calls = [mock.call(msg), mock.call("\n"), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_diff_with_saved_connection (self):
+        self.ldapy.diff = mock.Mock (return_value = [])
+        self.ldapy._lazyConnectionDataManager = mock.Mock ()
+        other = MemoryConnection (["dc=other"])
+        with mock.patch ("ldapy.connection.connect", return_value = other):
+            with mock.patch.object (other, "close") as close:
+                self.cmd (["--with", "backup", "ou=People", "dc=other"])
+
+        self.ldapy.connectionDataManager.getConnection.assert_called_once_with ("backup")
+        self.assertIs (other, self.ldapy.diff.call_args[1]["target"].connection)
+        close.assert_called_once_with ()
+
+    def test_saved_connection_is_closed_after_errors (self):
+        self.ldapy._lazyConnectionDataManager = mock.Mock ()
+        other = MemoryConnection (["dc=other"])
+        with mock.patch ("ldapy.connection.connect", return_value = other):
+            with mock.patch.object (other, "close") as close:
+                with mock.patch('sys.stdout.write'):
+                    self.cmd (["--with", "backup", "ou=People", "ou=Nonexistent,dc=other"])
+
+        self.assertEqual (1, self.cmd.errors)
+        close.assert_called_once_with ()
+
+    def test_wrong_arguments_prints_error_calls_usage (self):
+        for args in [["ou=People"], ["-r", "ou=People", "ou=Staff"], ["ou=People", "ou=Staff", "--with"]]:
+            self.cmd = Diff (self.ldapy)
+            self.cmd.usage = mock.create_autospec(self.cmd.usage)
+            with mock.patch('sys.stdout.write') as print_mock:
+                self.cmd (args)
+
+            msg = Diff._wrong_arguments % self.cmd.name
+            expect_calls = [mock.call(msg), mock.call("\n")]
+            self.assertListEqual (print_mock.call_args_list, expect_calls)
+            self.cmd.usage.assert_called_once_with (args)
+
+    def test_errors_are_printed (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["ou=People", "ou=Nothing"])
+
+        msg = str (NoSuchObject ("ou=Nothing,dc=nodomain"))
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_completer (self):
+        self.assertItemsEqual (self.cmd.complete ([]), ["ou=People", "ou=Staff"])
+        self.assertListEqual (self.cmd.complete (["ou=People", "ou=S"]), ["ou=Staff"])
+        self.assertListEqual (self.cmd.complete (["ou=People", "ou=Staff", ""]), [])
+
+class ApplyTests (unittest2.TestCase):
+    def setUp (self):
+        con = MemoryConnection (["dc=nodomain"])
+        con.add ("ou=People,dc=nodomain", {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("uid=john,ou=People,dc=nodomain", {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN ("dc=nodomain")
+        self.cmd = Apply (self.ldapy)
+
+        self.ldif = tempfile.NamedTemporaryFile (mode = "w")
+        self.ldif.write ("dn: ou=People,dc=nodomain\nobjectClass: organizationalUnit\n"
+                "ou: People\n\ndn: uid=jack,ou=People,dc=nodomain\n"
+                "objectClass: person\nuid: jack\n")
+        self.ldif.flush ()
+
+    def tearDown (self):
+        self.ldif.close ()
+
+    def test_usage (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd.usage ([])
+
+        msg = Apply._usage % "apply"
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+
+    def test_apply_prints_summary (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd ([self.ldif.name])
+
+        msg = Apply._summary % (1, 0, 1, 2, 0)
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+        self.assertListEqual (["uid=jack"], self.ldapy._resolveRelativeDN ("ou=People").relativeChildren.keys ())
+
+    def test_failures_are_counted (self):
+        self.ldapy.connection._add = mock.Mock (side_effect = AlreadyExists ("uid=jack,ou=People,dc=nodomain"))
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd ([self.ldif.name])
+
+        msg = Apply._summary % (1, 0, 1, 1, 1)
+        self.assertEqual (mock.call(msg), print_mock.call_args_list[-2])
+
+    def test_dry_run_prints_ldif (self):
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd (["--dry-run", self.ldif.name])
+
+        expect_calls = [mock.call ("dn: uid=john,ou=People,dc=nodomain\nchangetype: delete"),
+                mock.call("\n"), mock.call("\n"),
+                mock.call ("dn: uid=jack,ou=People,dc=nodomain\nchangetype: add\nobjectClass: person\nuid: jack"),
+                mock.call("\n"), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
+        self.assertItemsEqual (["uid=john"], self.ldapy._resolveRelativeDN ("ou=People").relativeChildren.keys ())
+
+    def test_wrong_arguments_prints_error_calls_usage (self):
+        for args in [[], ["-r", self.ldif.name], [self.ldif.name, self.ldif.name]]:
+            self.cmd = Apply (self.ldapy)
+            self.cmd.usage = mock.create_autospec(self.cmd.usage)
+            with mock.patch('sys.stdout.write') as print_mock:
+                self.cmd (args)
+
+            msg = Apply._wrong_arguments % self.cmd.name
+            expect_calls = [mock.call(msg), mock.call("\n")]
+            self.assertListEqual (print_mock.call_args_list, expect_calls)
+            self.cmd.usage.assert_called_once_with (args)
+
+    def test_errors_are_printed (self):
+        self.ldif.write ("changetype: add\n")
+        self.ldif.flush ()
+        with mock.patch('sys.stdout.write') as print_mock:
+            self.cmd ([self.ldif.name])
+
+        msg = subtree._not_an_entry % (8, "changetype: add")
+        expect_calls = [mock.call(msg), mock.call("\n")]
+        self.assertListEqual (print_mock.call_args_list, expect_calls)
@@ -1,4 +1,4 @@
-from ldapy.connection import Connection, ConnectionError, scopeBase
+from ldapy.connection import Connection, ConnectionError, scopeBase, scopeOneLevel, scopeSubtree, _ResultCache
 from ldapy.exceptions import LdapError, NoSuchObject, AlreadyExists, UndefinedType, TypeOrValueExists
 import unittest2
 import mock
@@ -6,6 +6,7 @@ import ldap
 import ldap.ldapobject
 import ldap.modlist
 import configuration
+import time
 
 class BasicConnection(unittest2.TestCase):
 
@@ -21,6 +22,14 @@ class BasicConnection(unittest2.TestCase):
         self.con.bind (configuration.admin, configuration.admin_password)
         self.assertTrue (self.con.connected)
 
+    def test_close (self):
+        self.con.bind (configuration.admin, configuration.admin_password)
+        with mock.patch.object (self.con._ldap, "unbind_s", wraps = self.con._ldap.unbind_s) as unbind:
+            self.con.close ()
+
+        unbind.assert_called_once_with ()
+        self.assertFalse (self.con.connected)
+
 class Utilities (unittest2.TestCase):
     def setUp (self):
         self.con = Connection (configuration.uri)
@@ -55,6 +64,19 @@ class Operations (unittest2.TestCase):
 
         self.assertEqual (str(expect), str(received.exception))
 
+    def test_search_paged (self):
+        with configuration.provision() as p:
+            c = p.container()
+            for n in range (5):
+                p.leaf(c)
+
+            results = list (self.con.searchPaged (c.dn, scopeOneLevel, pageSize = 2))
+            self.assertEqual (len(results), 5)
+
+            results = list (self.con.searchPaged (c.dn, scopeSubtree,
+                "(objectClass=organizationalUnit)", attrlist = ["ou"], pageSize = 2))
+            self.assertListEqual (results, [(c.dn, {"ou": [c.name]})])
+
     def test_modify_delegates (self):
         dn = "cn=Foobar"
         oldAttrs = {"foo": "bar"}
@@ -73,6 +95,42 @@ class Operations (unittest2.TestCase):
 
         self.assertEqual (str(expect), str(received.exception))
 
+    def test_modify_reads_back_the_entry (self):
+        self.assertIn (Connection._postReadControl, self.con.roots and self.con._supportedControls)
+
+        with configuration.provision() as p:
+            l = p.leaf()
+            attributes = self.con.modify (l.dn, {}, {"description": "changed"})
+            self.assertEqual (["changed"], attributes["description"])
+            self.assertEqual ([l.name], attributes["cn"])
+
+    def test_delete_reads_the_entry_before (self):
+        self.assertIn (Connection._preReadControl, self.con.roots and self.con._supportedControls)
+
+        with configuration.provision() as p:
+            l = p.leaf()
+            attributes = self.con.delete (l.dn)
+            self.assertEqual ([l.name], attributes["cn"])
+
+    def test_rename (self):
+        with configuration.provision() as p:
+            c1 = p.container()
+            c2 = p.container()
+            l = p.leaf(c1)
+
+            self.con.rename (c1.dn, "ou=renamed", c2.dn)
+            dn = "cn=%s,ou=renamed,%s" % (l.name, c2.dn)
+            self.assertEqual ([l.name], self.con.search (dn, scopeBase)[0][1]["cn"])
+
+            with self.assertRaises (AlreadyExists):
+                self.con.rename (c2.dn, "ou=renamed", c2.dn)
+
+            with self.assertRaises (NoSuchObject):
+                self.con.rename (c1.dn, "ou=foo")
+
+            p.delete (dn)
+            p.delete ("ou=renamed,%s" % c2.dn)
+
     def test_delete_delegates (self):
         dn = "cn=Foobar"
         with mock.patch ("ldap.ldapobject.LDAPObject.delete_s", autospec=True) as delete_mock:
@@ -104,6 +162,20 @@ class AddTests (unittest2.TestCase):
         ldif = ldap.modlist.addModlist (attrs)
         add_mock.assert_called_once_with (self.con._ldap, dn, ldif)
 
+    def test_add_reads_back_the_entry (self):
+        # The supported controls are learnt along with the roots
+        self.assertIn (Connection._postReadControl, self.con.roots and self.con._supportedControls)
+
+        with configuration.provision() as p:
+            c = p.container()
+            dn = "cn=test_add_reads_back_the_entry,%s" % c.dn
+            try:
+                attributes = self.con.add (dn, {"objectClass": "organizationalRole"})
+                self.assertEqual (["organizationalRole"], attributes["objectClass"])
+                self.assertEqual (["test_add_reads_back_the_entry"], attributes["cn"])
+            finally:
+                p.delete (dn)
+
     def test_add_to_nonexistent_container (self):
         with configuration.provision() as p:
             root = p.root
@@ -168,6 +240,298 @@ class AddTests (unittest2.TestCase):
             self.assertIn (value, str(received.exception))
             self.assertIn (attribute, str(received.exception))
 
+class Pipelining (unittest2.TestCase):
+    def setUp (self):
+        self.con = Connection (configuration.uri)
+        self.con.bind (configuration.admin, configuration.admin_password)
+        self.errors = []
+        self.con.startPipelining (self.errors.append)
+
+    def tearDown (self):
+        self.con.stopPipelining ()
+
+    def test_adds_are_pipelined (self):
+        with configuration.provision() as p:
+            c = p.container()
+            dns = ["cn=test_adds_are_pipelined_%u,%s" % (n, c.dn) for n in range(3)]
+            try:
+                with mock.patch ("ldap.ldapobject.LDAPObject.result", autospec=True,
+                        side_effect=ldap.ldapobject.LDAPObject.result.__func__) as result_mock:
+                    for dn in dns:
+                        self.con.add (dn, {"objectClass": "organizationalRole"})
+                    self.assertFalse (result_mock.called)
+
+                    self.con.flush ()
+                    self.assertEqual (result_mock.call_count, len(dns))
+
+                self.assertListEqual ([], self.errors)
+                for dn in dns:
+                    self.assertTrue (p.exists (dn))
+            finally:
+                for dn in dns:
+                    p.delete (dn)
+
+    def test_search_collects_pending_results (self):
+        with configuration.provision() as p:
+            c = p.container()
+            dn = "cn=test_search_collects_pending_results,%s" % c.dn
+            try:
+                self.con.add (dn, {"objectClass": "organizationalRole"})
+                results = self.con.search (c.dn, scopeOneLevel)
+                self.assertListEqual ([dn], [r[0] for r in results])
+            finally:
+                p.delete (dn)
+
+    def test_dependent_operations_are_ordered (self):
+        with configuration.provision() as p:
+            c = p.container()
+            parent = "ou=test_dependent_operations_are_ordered,%s" % c.dn
+            child = "cn=child,%s" % parent
+            try:
+                self.con.add (parent, {"objectClass": "organizationalUnit"})
+                self.con.add (child, {"objectClass": "organizationalRole"})
+                self.con.delete (child)
+                self.con.delete (parent)
+                self.con.flush ()
+
+                self.assertListEqual ([], self.errors)
+                self.assertFalse (p.exists (parent))
+            finally:
+                p.delete (child)
+                p.delete (parent)
+
+    def test_errors_are_passed_to_errback (self):
+        with configuration.provision() as p:
+            l = p.leaf()
+            self.con.add (l.dn, {"objectClass": "organizationalRole"})
+            self.con.flush ()
+
+            self.assertEqual (len(self.errors), 1)
+            self.assertIsInstance (self.errors[0], AlreadyExists)
+            self.assertEqual (self.errors[0].dn, l.dn)
+
+class Coalescing (unittest2.TestCase):
+    def setUp (self):
+        self.con = Connection (configuration.uri)
+        self.con.bind (configuration.admin, configuration.admin_password)
+
+    def test_identical_searches_are_coalesced (self):
+        with configuration.provision() as p:
+            c = p.container()
+            l = p.leaf(c)
+            with mock.patch ("ldap.ldapobject.LDAPObject.search_s", autospec=True,
+                    side_effect=configuration.slowly (ldap.ldapobject.LDAPObject.search_s.__func__)) as search_mock:
+                results = configuration.inThreads (lambda: self.con.search (c.dn, scopeOneLevel))
+
+            self.assertEqual (1, search_mock.call_count)
+            self.assertEqual ([[l.dn]] * 5, [[dn for dn, _ in r] for r in results])
+
+            # Each caller gets its own copy
+            self.assertEqual (5, len(set ([id(r[0][1]) for r in results])))
+
+    def test_different_searches_are_not_coalesced (self):
+        with configuration.provision() as p:
+            c = p.container()
+            with mock.patch ("ldap.ldapobject.LDAPObject.search_s", autospec=True,
+                    side_effect=configuration.slowly (ldap.ldapobject.LDAPObject.search_s.__func__)) as search_mock:
+                dns = iter ([c.dn, p.root])
+                configuration.inThreads (lambda: self.con.search (next (dns), scopeBase), n = 2)
+
+            self.assertEqual (2, search_mock.call_count)
+
+    def test_errors_are_shared (self):
+        nonexistent = "ou=nonexistent,%s" % self.con.roots[0]
+        errors = []
+        def search ():
+            try:
+                self.con.search (nonexistent, scopeBase)
+            except NoSuchObject as e:
+                errors.append (e)
+
+        with mock.patch ("ldap.ldapobject.LDAPObject.search_s", autospec=True,
+                side_effect=configuration.slowly (ldap.ldapobject.LDAPObject.search_s.__func__)) as search_mock:
+            configuration.inThreads (search)
+
+        self.assertEqual (1, search_mock.call_count)
+        self.assertEqual (5, len(errors))
+
+class ResultCacheTests (unittest2.TestCase):
+    def setUp (self):
+        self.cache = _ResultCache (3, 60)
+
+    def key (self, dn, scope = scopeBase):
+        return (dn, scope, None, None)
+
+    def put (self, dn, scope = scopeBase):
+        self.cache.put (self.key (dn, scope), [dn], self.cache.generation)
+
+    def test_least_recently_used_is_forgotten (self):
+        for dn in ["a=1", "a=2", "a=3"]:
+            self.put (dn)
+        self.cache.get (self.key ("a=1"))
+        self.put ("a=4")
+
+        self.assertIsNone (self.cache.get (self.key ("a=2")))
+        for dn in ["a=1", "a=3", "a=4"]:
+            self.assertEqual ([dn], self.cache.get (self.key (dn)))
+
+    def test_results_expire (self):
+        self.put ("a=1")
+        with mock.patch ("time.time", return_value=time.time () + 61):
+            self.assertIsNone (self.cache.get (self.key ("a=1")))
+
+    def test_invalidate (self):
+        cache = _ResultCache (10, 60)
+        self.cache = cache
+        self.put ("cn=x,ou=a,dc=b")
+        self.put ("ou=a,dc=b", scopeOneLevel)
+        self.put ("dc=b", scopeSubtree)
+        self.put ("dc=b", scopeOneLevel)
+        self.put ("ou=c,dc=b")
+
+        cache.invalidate ("cn=x,ou=a,dc=b")
+        self.assertIsNone (cache.get (self.key ("cn=x,ou=a,dc=b")))
+        self.assertIsNone (cache.get (self.key ("ou=a,dc=b", scopeOneLevel)))
+        self.assertIsNone (cache.get (self.key ("dc=b", scopeSubtree)))
+        self.assertIsNotNone (cache.get (self.key ("dc=b", scopeOneLevel)))
+        self.assertIsNotNone (cache.get (self.key ("ou=c,dc=b")))
+
+    def test_stale_result_is_not_kept (self):
+        generation = self.cache.generation
+        self.cache.invalidate ("a=1")
+        self.cache.put (self.key ("a=1"), ["a=1"], generation)
+        self.assertIsNone (self.cache.get (self.key ("a=1")))
+
+class Caching (unittest2.TestCase):
+    def setUp (self):
+        self.con = Connection (configuration.uri, cacheSize = 100)
+        self.con.bind (configuration.admin, configuration.admin_password)
+
+    def test_searches_are_cached (self):
+        with configuration.provision() as p:
+            l = p.leaf()
+            with mock.patch ("ldap.ldapobject.LDAPObject.search_s", autospec=True,
+                    side_effect=ldap.ldapobject.LDAPObject.search_s.__func__) as search_mock:
+                first = self.con.search (l.dn, scopeBase)
+                first[0][1]["description"] = ["changed"]
+                second = self.con.search (l.dn.upper (), scopeBase)
+
+            self.assertEqual (1, search_mock.call_count)
+            self.assertEqual (1, self.con.statistics.cacheHits)
+            self.assertNotIn ("description", second[0][1])
+
+    def test_writes_invalidate (self):
+        with configuration.provision() as p:
+            c = p.container()
+            dn = "cn=test_writes_invalidate,%s" % c.dn
+            try:
+                self.assertEqual ([], self.con.search (c.dn, scopeOneLevel))
+                self.con.add (dn, {"objectClass": "organizationalRole"})
+                self.assertEqual ([dn], [r[0] for r in self.con.search (c.dn, scopeOneLevel)])
+
+                self.con.modify (dn, {}, {"description": "foo"})
+                self.assertEqual (["foo"], self.con.search (dn, scopeBase)[0][1]["description"])
+
+                self.con.delete (dn)
+                self.assertEqual ([], self.con.search (c.dn, scopeOneLevel))
+            finally:
+                p.delete (dn)
+
+    def test_disabled_by_default (self):
+        self.assertIsNone (Connection (configuration.uri).cache)
+
+class SeveralServers (unittest2.TestCase):
+    bad_uri = "ldap://foobar"
+
+    def test_bind_fails_over (self):
+        con = Connection ([self.bad_uri, configuration.uri])
+        con.bind (configuration.admin, configuration.admin_password)
+        self.assertTrue (con.connected)
+
+    def test_reads_fail_over (self):
+        con = Connection ([self.bad_uri, configuration.uri])
+        con.bind (configuration.admin, configuration.admin_password)
+
+        with configuration.provision() as p:
+            self.assertIn (p.root, con.roots)
+            self.assertEqual (len(con.search (p.root, scopeBase)), 1)
+
+    def test_writes_go_to_the_provider (self):
+        con = Connection ([self.bad_uri, configuration.uri])
+        con.bind (configuration.admin, configuration.admin_password)
+
+        with configuration.provision() as p:
+            dn = "cn=test_writes_go_to_the_provider,%s" % p.root
+            with self.assertRaises (LdapError):
+                con.add (dn, {"objectClass": "organizationalRole"})
+            self.assertFalse (p.exists (dn))
+
+    def test_round_robin (self):
+        con = Connection ([configuration.uri, configuration.uri], strategy="round-robin")
+        con.bind (configuration.admin, configuration.admin_password)
+
+        with configuration.provision() as p:
+            for n in range (4):
+                con.search (p.root, scopeBase)
+
+        for server in con._servers:
+            self.assertIsNotNone (server.latency)
+
+    def test_all_servers_down (self):
+        con = Connection ([self.bad_uri, self.bad_uri])
+        with self.assertRaises(ConnectionError) as received:
+            con.bind ("", "")
+
+        msg = Connection._connection_error_msg % " ".join ([self.bad_uri, self.bad_uri])
+        self.assertEqual (str(received.exception), msg)
+
+    def test_unknown_strategy (self):
+        with self.assertRaises (ValueError):
+            Connection ([configuration.uri], strategy="foobar")
+
+class Reconnect (unittest2.TestCase):
+    def setUp (self):
+        self.con = Connection (configuration.uri)
+        self.con.bind (configuration.admin, configuration.admin_password)
+
+    def test_read_is_replayed (self):
+        dropped = self.con._ldap
+        with configuration.provision() as p:
+            with mock.patch.object (dropped, "search_s",
+                    side_effect = ldap.SERVER_DOWN({})):
+                result = self.con.search (p.root, scopeBase)
+
+            self.assertEqual (result[0][0], p.root)
+            self.assertIsNot (self.con._ldap, dropped)
+
+    @mock.patch ("time.sleep")
+    def test_backoff (self, sleep):
+        with mock.patch ("ldap.ldapobject.LDAPObject.search_s",
+                side_effect = ldap.SERVER_DOWN({})):
+            with self.assertRaises (LdapError):
+                self.con.search ("", scopeBase)
+
+        delays = [call[0][0] for call in sleep.call_args_list]
+        self.assertEqual (len(delays), Connection.reconnectAttempts)
+        self.assertListEqual (delays,
+                [Connection.reconnectDelay * 2**n for n in range (len(delays))])
+
+    def test_write_is_not_replayed (self):
+        dropped = self.con._ldap
+        with configuration.provision() as p:
+            dn = "cn=test_write_is_not_replayed,%s" % p.root
+            attr = {"objectClass": "organizationalRole"}
+
+            with mock.patch.object (dropped, "add_s",
+                    side_effect = ldap.SERVER_DOWN({})):
+                with self.assertRaises (LdapError):
+                    self.con.add (dn, attr)
+            self.assertFalse (p.exists (dn))
+
+            # The next operation is made on a new connection
+            self.con.add (dn, attr)
+            self.assertTrue (p.exists (dn))
+
 class ConnectionErrors (unittest2.TestCase):
 
     def test_bind_connect_error (self):
@@ -1,7 +1,10 @@
 import unittest2
 import mock
 import json
+import os
+import shutil
 import string
+import tempfile
 from ldapy.connection_data import *
 
 class ConnectionDataFormater:
@@ -87,6 +90,19 @@ class ConnectionDataTests (unittest2.TestCase):
         self.assertDictEqual (expected, data.data.save())
 
 
+    def test_ConnectionData_with_several_uris_and_strategy (self):
+        uris = ["ldap://a.com", "ldap://b.com"]
+        data = ConnectionData (uris, "cn=Admin,dc=nodomain", strategy = "round-robin")
+
+        saved = data.save ()
+        self.assertDictEqual ({"uri": uris, "bind_dn": data.bind_dn,
+            "strategy": data.strategy}, saved)
+        self.assertEqual (data, ConnectionData.load (json.loads (json.dumps (saved))))
+
+        self.assertIn ("ldap://a.com ldap://b.com", str(data))
+        self.assertIn ("round-robin", str(data))
+
+
 class ParserTests (unittest2.TestCase):
 
     def test_successful_trivial_parsing (self):
@@ -192,6 +208,14 @@ class UnparserTests (unittest2.TestCase):
 
 
 class ConnectionDataManagerTests (unittest2.TestCase):
+    def setUp (self):
+        self.directory = tempfile.mkdtemp (prefix = "ldapy-test")
+        self.filename = ConnectionDataManager.filename
+        ConnectionDataManager.filename = os.path.join (self.directory, "history")
+
+    def tearDown (self):
+        ConnectionDataManager.filename = self.filename
+        shutil.rmtree (self.directory)
 
     def createConnectionData (self, token):
         return ConnectionData("ldap://%s.com" % str(token), "cn=%s" % str(token))
@@ -210,8 +234,8 @@ class ConnectionDataManagerTests (unittest2.TestCase):
             parserMock.return_value = (recent, saved)
             manager = ConnectionDataManager()
 
-        self.assertListEqual (recent, manager.recent)
-        self.assertDictEqual (saved, manager.saved)
+            self.assertListEqual (recent, manager.recent)
+            self.assertDictEqual (saved, manager.saved)
         return manager, list(recent), dict(saved)
 
 
@@ -222,10 +246,11 @@ class ConnectionDataManagerTests (unittest2.TestCase):
             savedDict = {"bar":"baz"}
             parserMock.return_value = (recentList, savedDict)
             manager = ConnectionDataManager()
+            self.assertFalse (parserMock.called)
 
-            parserMock.assert_called_once_with ()
             self.assertEqual (manager.recent, recentList)
             self.assertEqual (manager.saved, savedDict)
+            parserMock.assert_called_once_with ()
 
     def test_file_does_not_exist (self):
         with mock.patch("__builtin__.open", create=True) as mock_open:
@@ -238,12 +263,14 @@ class ConnectionDataManagerTests (unittest2.TestCase):
             self.assertDictEqual({}, manager.saved)
 
     def test_readAndParseFile_reads_file (self):
-        with mock.patch("__builtin__.open", create=True, auto_spec=True) as mock_open:
+        with mock.patch("__builtin__.open", create=True, auto_spec=True) as mock_open, \
+                mock.patch("ldapy.connection_data.ConnectionDataManager._replayLog"):
             with mock.patch("ldapy.connection_data.ConnectionDataManager._parse", spec=ConnectionDataManager._parse) as parserMock:
                 mock_open.return_value = mock.MagicMock(spec=file)
                 raw = "testing data!"
                 f = mock_open.return_value.__enter__.return_value
                 f.read.return_value = raw
+                parserMock.return_value = [], {}
 
                 ConnectionDataManager._readAndParseFile()
 
@@ -253,23 +280,34 @@ class ConnectionDataManagerTests (unittest2.TestCase):
     def test_unparseAndSaveFile_writes_file (self):
         manager, recent, saved = self.createConnectionManager (numOfRecent = 3, numOfSaved = 4)
 
-        with mock.patch("__builtin__.open", create=True, auto_spec=True) as mock_open:
-            with mock.patch("ldapy.connection_data.ConnectionDataManager._unparse", spec=ConnectionDataManager._unparse) as unparserMock:
-                mock_open.return_value = mock.MagicMock(spec=file)
-                f = mock_open.return_value.__enter__.return_value
+        with mock.patch("ldapy.connection_data.ConnectionDataManager._unparse", spec=ConnectionDataManager._unparse) as unparserMock:
+            raw = "testing data!"
+            unparserMock.return_value = raw
 
-                raw = "testing data!"
-                unparserMock.return_value = raw
+            manager._unparseAndSaveFile ()
 
+            unparserMock.assert_called_once_with (recent, saved)
+            with open (ConnectionDataManager.filename) as f:
+                self.assertEqual (raw, f.read ())
+
+        # The file is replaced, leaving no temporary files behind
+        self.assertListEqual (["history"], os.listdir (self.directory))
+
+    def test_unparseAndSaveFile_keeps_file_when_failing (self):
+        manager, recent, saved = self.createConnectionManager (numOfRecent = 3)
+        manager._unparseAndSaveFile ()
+
+        with mock.patch("ldapy.connection_data.ConnectionDataManager._unparse",
+                side_effect=ValueError):
+            with self.assertRaises (ValueError):
                 manager._unparseAndSaveFile ()
 
-                mock_open.assert_called_once_with (ConnectionDataManager.filename, "w")
-                unparserMock.assert_called_once_with (recent, saved)
-                f.write.assert_called_once_with (raw)
+        self.assertListEqual (["history"], os.listdir (self.directory))
+        self.assertListEqual (recent, ConnectionDataManager._readAndParseFile ()[0])
 
     def test_addRecentConnection (self):
         manager, recent, saved = self.createConnectionManager (numOfRecent = 1)
-        manager._unparseAndSaveFile = mock.create_autospec (manager._unparseAndSaveFile)
+        manager._record = mock.create_autospec (manager._record)
 
         newConnection = self.createConnectionData ("new")
         manager.addRecentConnection (newConnection)
@@ -277,7 +315,26 @@ class ConnectionDataManagerTests (unittest2.TestCase):
         recent.insert(0, newConnection)
         self.assertListEqual(recent, manager.recent)
         self.assertDictEqual(saved, manager.saved)
-        manager._unparseAndSaveFile.assert_called_once_with ()
+        manager._record.assert_called_once_with ({"recent": newConnection.save ()})
+
+    def test_addRecentConnection_removes_duplicates (self):
+        manager, recent, _ = self.createConnectionManager (numOfRecent = 3)
+        manager._record = mock.create_autospec (manager._record)
+
+        manager.addRecentConnection (self.createConnectionData (1))
+
+        self.assertListEqual([recent[1], recent[0], recent[2]], manager.recent)
+
+    def test_recent_connections_are_bounded (self):
+        manager, recent, _ = self.createConnectionManager ()
+
+        with mock.patch.object (ConnectionDataManager, "maxRecent", 5):
+            for n in range (10):
+                manager.addRecentConnection (self.createConnectionData (n))
+
+            expected = [self.createConnectionData (n) for n in range (9, 4, -1)]
+            self.assertListEqual (expected, manager.recent)
+            self.assertListEqual (expected, ConnectionDataManager ().recent)
 
     def test_getRecentConnection_and_getRecentConnections (self):
         N = 10
@@ -309,7 +366,7 @@ class ConnectionDataManagerTests (unittest2.TestCase):
 
     def test_saveConnection (self):
         manager, recent, saved = self.createConnectionManager (numOfSaved = 1)
-        manager._unparseAndSaveFile = mock.create_autospec (manager._unparseAndSaveFile)
+        manager._record = mock.create_autospec (manager._record)
 
         newKey = "new"
         newConnection = self.createConnectionData (newKey)
@@ -319,11 +376,11 @@ class ConnectionDataManagerTests (unittest2.TestCase):
         saved[newKey] = newConnection
         self.assertListEqual(recent, manager.recent)
         self.assertDictEqual(saved, manager.saved)
-        manager._unparseAndSaveFile.assert_called_once_with ()
+        manager._record.assert_called_once_with ({"save": newKey, "data": newConnection.save ()})
 
     def test_removeConnection (self):
         manager, recent, saved = self.createConnectionManager (numOfSaved = 3)
-        manager._unparseAndSaveFile = mock.create_autospec (manager._unparseAndSaveFile)
+        manager._record = mock.create_autospec (manager._record)
 
         delKey = "b"
         manager.removeConnection (delKey)
@@ -331,16 +388,108 @@ class ConnectionDataManagerTests (unittest2.TestCase):
         del saved[delKey]
         self.assertListEqual(recent, manager.recent)
         self.assertDictEqual(saved, manager.saved)
-        manager._unparseAndSaveFile.assert_called_once_with ()
+        manager._record.assert_called_once_with ({"remove": delKey})
 
     def test_remove_nonexistent_connection (self):
         manager, _, _ = self.createConnectionManager ()
-        manager._unparseAndSaveFile = mock.create_autospec (manager._unparseAndSaveFile)
+        manager._record = mock.create_autospec (manager._record)
 
         with self.assertRaises (NoSuchSavedConnection):
             manager.removeConnection ("b")
 
-        self.assertFalse(manager._unparseAndSaveFile.called)
+        self.assertFalse(manager._record.called)
+
+    def test_changes_are_replayed_from_the_log (self):
+        first = ConnectionDataManager ()
+        first.addRecentConnection (self.createConnectionData ("a"))
+        first.saveConnection ("b", self.createConnectionData ("b"))
+        first.saveConnection ("c", self.createConnectionData ("c"))
+
+        # Another process making changes at the same time
+        second = ConnectionDataManager ()
+        second.addRecentConnection (self.createConnectionData ("d"))
+        first.removeConnection ("b")
+
+        self.assertFalse (os.path.exists (ConnectionDataManager.filename))
+        manager = ConnectionDataManager ()
+        self.assertListEqual ([self.createConnectionData ("d"), self.createConnectionData ("a")],
+                manager.recent)
+        self.assertDictEqual ({"c": self.createConnectionData ("c")}, manager.saved)
+
+    def test_malformed_lines_in_the_log_are_skipped (self):
+        manager = ConnectionDataManager ()
+        manager.addRecentConnection (self.createConnectionData ("a"))
+        with open (ConnectionDataManager._logFilename (), "a") as f:
+            f.write ('{"recent": {"uri": "ld')
+        with open (ConnectionDataManager._logFilename (), "a") as f:
+            f.write ('\n{"foo": 1}\n')
+        manager.addRecentConnection (self.createConnectionData ("b"))
+
+        self.assertListEqual ([self.createConnectionData ("b"), self.createConnectionData ("a")],
+                ConnectionDataManager ().recent)
+
+    def test_log_is_compacted (self):
+        manager = ConnectionDataManager ()
+        other = ConnectionDataManager ()
+        other.saveConnection ("other", self.createConnectionData ("other"))
+
+        with mock.patch.object (ConnectionDataManager, "compactSize", 1000):
+            for n in range (20):
+                manager.addRecentConnection (self.createConnectionData (n))
+
+        self.assertTrue (os.path.exists (ConnectionDataManager.filename))
+        self.assertLess (os.path.getsize (ConnectionDataManager._logFilename ()), 1000)
+
+        # The compaction includes the changes made by the other manager
+        self.assertIn ("other", manager.saved)
+
+        reread = ConnectionDataManager ()
+        self.assertListEqual (manager.recent, reread.recent)
+        self.assertDictEqual (manager.saved, reread.saved)
+        self.assertEqual (self.createConnectionData (19), reread.recent[0])
+
+    def test_most_recent_connection_is_read_from_the_log (self):
+        manager = ConnectionDataManager ()
+        for n in range (3):
+            manager.addRecentConnection (self.createConnectionData (n))
+        manager.saveConnection ("a", self.createConnectionData ("a"))
+
+        with mock.patch("ldapy.connection_data.ConnectionDataManager._readAndParseFile") as parserMock:
+            latest = ConnectionDataManager ().getRecentConnection ()
+            self.assertFalse (parserMock.called)
+        self.assertEqual (self.createConnectionData (2), latest)
+
+    def test_most_recent_connection_is_kept_in_the_log_when_compacting (self):
+        manager = ConnectionDataManager ()
+        with mock.patch.object (ConnectionDataManager, "compactSize", 0):
+            manager.addRecentConnection (self.createConnectionData (0))
+            manager.addRecentConnection (self.createConnectionData (1))
+
+        with mock.patch("ldapy.connection_data.ConnectionDataManager._readAndParseFile") as parserMock:
+            latest = ConnectionDataManager ().getRecentConnection ()
+            self.assertFalse (parserMock.called)
+        self.assertEqual (self.createConnectionData (1), latest)
+
+    def test_most_recent_connection_without_log (self):
+        manager, recent, _ = self.createConnectionManager (numOfRecent = 2)
+        manager._unparseAndSaveFile ()
+
+        self.assertEqual (recent[0], ConnectionDataManager ().getRecentConnection ())
+
+        with self.assertRaises (NoSuchRecentConnection):
+            os.remove (ConnectionDataManager.filename)
+            ConnectionDataManager ().getRecentConnection ()
+
+    def test_reversedLines (self):
+        lines = ["line %u %s" % (n, "x" * n) for n in range (20)]
+        with open (ConnectionDataManager.filename, "w") as f:
+            f.write ("\n".join (lines))
+
+        for blockSize in [1, 7, 4096]:
+            with mock.patch.object (ConnectionDataManager, "blockSize", blockSize):
+                with open (ConnectionDataManager.filename, "rb") as f:
+                    self.assertListEqual (list (reversed (lines)),
+                            list (ConnectionDataManager._reversedLines (f)))
 
     def test_getConnection (self):
         manager, _, saved = self.createConnectionManager (numOfSaved = 3)
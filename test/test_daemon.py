@@ -0,0 +1,121 @@
+import unittest2
+import mock
+import os
+import shutil
+import tempfile
+import threading
+from ldapy.daemon import Daemon, Client
+from ldapy.connection_data import ConnectionData
+from ldapy.memory_connection import MemoryConnection
+from ldapy.connection import ConnectionError
+
+root = "dc=nodomain"
+
+class DaemonTests (unittest2.TestCase):
+    def setUp (self):
+        self.directory = tempfile.mkdtemp (prefix = "ldapy-test")
+        self.path = os.path.join (self.directory, "daemon")
+        self.connections = []
+
+        self.daemon = Daemon (self.path, connect = self.connect)
+        self.daemon.idleSeconds = 0.05
+        self.thread = threading.Thread (target = self.daemon.serve)
+        self.thread.start ()
+
+        # Wait for the daemon to listen, without starting another one
+        with mock.patch.object (Client, "_start"):
+            Client (self.path).connect ().close ()
+
+        self.client = Client (self.path)
+        self.connectionData = ConnectionData ("ldap://localhost", "cn=admin,%s" % root, "foobar")
+
+    def tearDown (self):
+        self.daemon.idle = True
+        self.thread.join ()
+        shutil.rmtree (self.directory)
+
+    def connect (self, connectionData):
+        if connectionData.password != "foobar":
+            raise ConnectionError (None, "Invalid credentials")
+
+        con = MemoryConnection ([root])
+        con.add ("ou=People,%s" % root, {"objectClass": "organizationalUnit"})
+        self.connections.append (con)
+        return con
+
+    def test_commands_are_executed (self):
+        response = self.client.request (self.connectionData, ["cd %s; ls" % root])
+        self.assertEqual ("ou=People\n", response["output"])
+
+    def test_connection_is_pooled (self):
+        response = self.client.request (self.connectionData,
+                ["cd %s; add cn=a objectClass:organizationalRole" % root])
+        self.assertEqual ("", response["output"])
+
+        # Each request starts from the super root
+        response = self.client.request (self.connectionData, ["ls"])
+        self.assertEqual ("%s\n" % root, response["output"])
+
+        response = self.client.request (self.connectionData, ["cd %s; ls" % root])
+        self.assertItemsEqual (["cn=a", "ou=People"], response["output"].split ())
+        self.assertEqual (1, len(self.connections))
+
+    def test_connection_error (self):
+        self.connectionData.password = "wrong"
+        response = self.client.request (self.connectionData, ["ls"])
+        self.assertEqual ({"error": "Invalid credentials"}, response)
+
+    def test_nodes_are_refreshed (self):
+        self.client.request (self.connectionData, ["cd %s; ls" % root])
+        self.connections[0].add ("ou=Groups,%s" % root, {"objectClass": "organizationalUnit"})
+
+        response = self.client.request (self.connectionData, ["cd %s; ls" % root])
+        self.assertNotIn ("ou=Groups", response["output"])
+
+        with mock.patch.object (self.daemon, "cacheSeconds", 0):
+            response = self.client.request (self.connectionData, ["cd %s; ls" % root])
+        self.assertIn ("ou=Groups", response["output"])
+
+    def test_forward (self):
+        ldapy = mock.Mock ()
+        ldapy.connectionData = self.connectionData
+        ldapy.newConnection = True
+
+        with mock.patch ("sys.stdout") as stdout:
+            status = self.client.forward (ldapy, ["pwd"])
+
+        self.assertEqual (0, status)
+        stdout.write.assert_called_once_with ("\n")
+        ldapy.connectionDataManager.addRecentConnection.assert_called_once_with (self.connectionData)
+
+    def test_forward_failed_command (self):
+        ldapy = mock.Mock ()
+        ldapy.connectionData = self.connectionData
+        ldapy.newConnection = False
+
+        with mock.patch ("sys.stdout") as stdout:
+            status = self.client.forward (ldapy, ["cd cn=nonexistent", "pwd"])
+
+        self.assertEqual (1, status)
+        self.assertTrue (stdout.write.called)
+
+    def test_status_of_commands (self):
+        response = self.client.request (self.connectionData, ["cd %s; ls" % root])
+        self.assertEqual (0, response["status"])
+
+        response = self.client.request (self.connectionData, ["cd cn=nonexistent"])
+        self.assertEqual (1, response["status"])
+
+    def test_forward_connection_error (self):
+        ldapy = mock.Mock ()
+        ldapy.connectionData = ConnectionData ("ldap://localhost", "", "wrong")
+        ldapy.newConnection = True
+
+        self.assertEqual (1, self.client.forward (ldapy, ["ls"]))
+        self.assertFalse (ldapy.connectionDataManager.addRecentConnection.called)
+
+    def test_daemon_exits_when_idle (self):
+        daemon = Daemon (os.path.join (self.directory, "idle"), connect = self.connect)
+        daemon.idleSeconds = 0.05
+        daemon.serve ()
+        self.assertFalse (os.path.exists (daemon.path))
@@ -0,0 +1,53 @@
+from ldapy.memory_connection import MemoryConnection
+from ldapy.connection import scopeBase, scopeOneLevel, scopeSubtree
+from generator import Shape, load, writeLdif
+import unittest2
+try:
+    from StringIO import StringIO
+except ImportError:
+    # Python 3
+    from io import StringIO
+
+root = "dc=nodomain"
+
+class GeneratorTests (unittest2.TestCase):
+    def test_shape (self):
+        shape = Shape (root, [3, 4, 5], groups = 2, members = 7)
+        self.assertEqual (shape.people, 60)
+        self.assertEqual (shape.size, 3 + 12 + 60 + 3)
+
+        entries = list (shape.entries ())
+        self.assertEqual (len(entries), shape.size)
+        self.assertEqual (len(set ([dn for dn, _ in entries])), shape.size)
+
+        people = [dn for dn, attributes in entries
+                if "inetOrgPerson" in attributes["objectClass"]]
+        self.assertListEqual (people, [shape.personDN (n) for n in range (shape.people)])
+
+    def test_same_seed_gives_same_directory (self):
+        a = Shape (root, [2, 3], groups = 1, members = 3, seed = 1)
+        b = Shape (root, [2, 3], groups = 1, members = 3, seed = 1)
+        self.assertListEqual (list (a.entries ()), list (b.entries ()))
+
+    def test_attribute_size (self):
+        shape = Shape (root, [2], attributeSize = 100)
+        for dn, attributes in shape.entries ():
+            self.assertEqual (len(attributes["description"][0]), 100)
+
+    def test_load (self):
+        shape = Shape (root, [2, 3], groups = 1, members = 4)
+        con = MemoryConnection ([root])
+
+        self.assertEqual (load (con, shape), shape.size)
+        self.assertEqual (len(con.search (root, scopeSubtree)), shape.size + 1)
+
+        group = con.search ("cn=group0,ou=Groups,%s" % root, scopeBase)[0][1]
+        self.assertEqual (len(group["member"]), 4)
+        for member in group["member"]:
+            self.assertEqual (len(con.search (member, scopeBase)), 1)
+
+    def test_ldif (self):
+        shape = Shape (root, [2, 2])
+        output = StringIO ()
+        writeLdif (shape, output)
+        self.assertEqual (output.getvalue ().count ("dn: "), shape.size)
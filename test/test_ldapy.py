@@ -2,10 +2,16 @@ import unittest2
 import mock
 import configuration
 from ldapy.node import NodeError
-from ldapy.ldapy import Ldapy, AlreadyAtRoot, SetAttributeError, DeleteError
-from ldapy.exceptions import NoSuchObject, NoSuchObjectInRoot
+from ldapy.ldapy import Ldapy, AlreadyAtRoot, SetAttributeError, DeleteError, RenameError, CopyError, ApplyError
+from ldapy.exceptions import NoSuchObject, NoSuchObjectInRoot, AlreadyExists, LdapError
 import io
+import os
+import sys
+import subprocess
 import tempfile
+import threading
+import ldapy.ldapy
+from ldapy.memory_connection import MemoryConnection
 from ldapy.connection_data import *
 
 class BasicLdapyTests (unittest2.TestCase):
@@ -52,6 +58,50 @@ class BasicLdapyTests (unittest2.TestCase):
             ldapy.goUpOneLevel ()
             self.assertEqual (ldapy.cwd, c1.dn)
 
+    def test_change_DN_several_levels (self):
+        ldapy = self.getLdapyAtRoot()
+        with configuration.provision() as p:
+            c1 = p.container()
+            c2 = p.container(c1)
+            l = p.leaf(c2)
+
+            ldapy.changeDN ("%s/%s/%s" % (c1.rdn, c2.rdn, l.rdn))
+            self.assertEqual (ldapy.cwd, l.dn)
+
+            ldapy.changeDN ("../..")
+            self.assertEqual (ldapy.cwd, c1.dn)
+
+            ldapy.changeDN ("/%s" % l.dn)
+            self.assertEqual (ldapy.cwd, l.dn)
+
+    def test_change_DN_several_levels_with_one_search (self):
+        ldapy = self.getLdapyAtRoot()
+        with configuration.provision() as p:
+            c1 = p.container()
+            c2 = p.container(c1)
+            l = p.leaf(c2)
+
+            with mock.patch ("ldapy.connection.Connection.search", autospec=True,
+                    side_effect=self.con.search.__func__) as search_mock:
+                ldapy.changeDN ("%s/%s/%s" % (c1.rdn, c2.rdn, l.rdn))
+
+            self.assertEqual (search_mock.call_count, 1)
+            self.assertEqual (ldapy.cwd, l.dn)
+            self.assertIs (ldapy._resolveRelativeDN ("/%s" % l.dn), ldapy._cwd)
+
+    def test_intermediate_nodes_are_kept_when_populating (self):
+        ldapy = self.getLdapyAtRoot()
+        with configuration.provision() as p:
+            c = p.container()
+            l = p.leaf(c)
+
+            ldapy.changeDN ("%s/%s" % (c.rdn, l.rdn))
+            leaf = ldapy._cwd
+
+            ldapy.changeDN ("..")
+            self.assertIn (l.rdn, ldapy.children)
+            self.assertIs (leaf, ldapy._resolveRelativeDN (l.rdn))
+
     def test_getAttributes_self_and_parent (self):
         ldapy = self.getLdapyAtRoot()
         with configuration.provision() as p:
@@ -173,6 +223,221 @@ class ChildCompleter (unittest2.TestCase):
         self.assertListEqual (matches, [])
 
 
+class SynchronizedLdapyTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        self.con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit"})
+        self.con.add ("ou=Groups,%s" % self.root, {"objectClass": "organizationalUnit"})
+
+    def test_each_thread_has_its_own_cwd (self):
+        ldapy = Ldapy (self.con, synchronized = True)
+        ldapy.changeDN (self.root)
+
+        cwds = {}
+        def browse (rdn):
+            cwds[rdn] = ldapy.cwd
+            ldapy.changeDN ("%s/%s" % (self.root, rdn))
+            cwds[rdn] = (cwds[rdn], ldapy.cwd)
+
+        threads = [threading.Thread (target = browse, args = (rdn,))
+                for rdn in ["ou=People", "ou=Groups"]]
+        for thread in threads:
+            thread.start ()
+        for thread in threads:
+            thread.join ()
+
+        self.assertEqual (("", "ou=People,%s" % self.root), cwds["ou=People"])
+        self.assertEqual (("", "ou=Groups,%s" % self.root), cwds["ou=Groups"])
+        self.assertEqual (self.root, ldapy.cwd)
+
+    def test_nodes_are_shared (self):
+        ldapy = Ldapy (self.con, synchronized = True)
+        nodes = []
+        def resolve ():
+            nodes.append (ldapy._resolveRelativeDN ("/%s/ou=People" % self.root))
+
+        thread = threading.Thread (target = resolve)
+        thread.start ()
+        thread.join ()
+        resolve ()
+        self.assertIs (nodes[0], nodes[1])
+
+class MoveLdapyTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        con = MemoryConnection ([self.root])
+        con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("ou=Groups,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "Groups"})
+        con.add ("uid=john,ou=People,%s" % self.root, {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN (self.root)
+
+    def test_move_into_existing (self):
+        self.ldapy.move ("ou=People/uid=john", "ou=Groups")
+        self.ldapy.changeDN ("ou=Groups")
+        self.assertListEqual (["uid=john"], self.ldapy.children)
+        self.ldapy.changeDN ("../ou=People")
+        self.assertListEqual ([], self.ldapy.children)
+
+    def test_move_and_rename (self):
+        self.ldapy.move ("ou=People/uid=john", "ou=Groups/uid=jack")
+        self.assertListEqual (["jack"], self.ldapy.getAttributes ("ou=Groups/uid=jack")["uid"])
+
+    def test_cwd_follows (self):
+        self.ldapy.changeDN ("ou=People/uid=john")
+        self.ldapy.rename ("..", "ou=Staff")
+        self.assertEqual ("uid=john,ou=Staff,%s" % self.root, self.ldapy.cwd)
+
+    def test_move_to_super_root (self):
+        with self.assertRaises (RenameError):
+            self.ldapy.move ("ou=People", "/")
+
+    def test_rename_root (self):
+        with self.assertRaises (RenameError):
+            self.ldapy.rename (".", "dc=foo")
+
+class CopyLdapyTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        con = MemoryConnection ([self.root])
+        con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("uid=john,ou=People,%s" % self.root, {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN (self.root)
+
+    def test_copy (self):
+        self.assertListEqual (["ou=People"], self.ldapy.children)
+        self.assertEqual (2, self.ldapy.copy ("ou=People", "ou=Staff", recursive = True))
+        self.assertItemsEqual (["ou=People", "ou=Staff"], self.ldapy.children)
+        self.assertListEqual (["john"], self.ldapy.getAttributes ("ou=Staff/uid=john")["uid"])
+
+    def test_copy_into_existing (self):
+        self.ldapy.copy ("ou=People/uid=john", "ou=People/uid=jack")
+        self.ldapy.copy ("ou=People/uid=jack", ".")
+        self.assertListEqual (["jack"], self.ldapy.getAttributes ("uid=jack")["uid"])
+
+    def test_copy_to_another_ldapy (self):
+        target = Ldapy (MemoryConnection (["dc=other"]))
+        self.ldapy.copy ("ou=People", "dc=other", target = target, recursive = True)
+        target.changeDN ("dc=other/ou=People")
+        self.assertListEqual (["uid=john"], target.children)
+
+    def test_failed_copy_is_not_listed (self):
+        errback = mock.Mock ()
+        self.ldapy.connection._add = mock.Mock (side_effect = AlreadyExists ("ou=Copy,%s" % self.root))
+        self.assertListEqual (["ou=People"], self.ldapy.children)
+        self.assertEqual (0, self.ldapy.copy ("ou=People", "ou=Copy", recursive = True, errback = errback))
+        self.assertEqual (2, errback.call_count)
+        self.assertListEqual (["ou=People"], self.ldapy.children)
+
+    def test_copy_below_itself (self):
+        with self.assertRaises (CopyError):
+            self.ldapy.copy ("ou=People", "ou=People", recursive = True)
+
+    def test_copy_below_itself_through_another_connection (self):
+        self.ldapy.connection.uris = ["ldap://ldap.example.com"]
+        other = MemoryConnection ([self.root])
+        other.uris = ["LDAP://ldap.example.com/"]
+        with self.assertRaises (CopyError):
+            self.ldapy.copy ("ou=People", "/dc=nodomain/ou=People", target = Ldapy (other), recursive = True)
+
+class DiffLdapyTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        con = MemoryConnection ([self.root])
+        con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("uid=john,ou=People,%s" % self.root, {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN (self.root)
+        self.ldapy.copy ("ou=People", "ou=Staff", recursive = True)
+
+    def test_diff (self):
+        self.assertListEqual ([], list (self.ldapy.diff ("ou=People", "ou=Staff")))
+        self.ldapy.delete ("ou=Staff/uid=john")
+        self.assertListEqual ([("delete", "uid=john,ou=People,%s" % self.root, None)],
+                list (self.ldapy.diff ("ou=People", "ou=Staff")))
+
+    def test_diff_with_another_ldapy (self):
+        target = Ldapy (MemoryConnection (["dc=other"]))
+        self.ldapy.copy ("ou=People", "dc=other", target = target, recursive = True)
+        self.assertListEqual ([], list (self.ldapy.diff ("ou=People", "dc=other/ou=People", target = target)))
+
+class ApplyLdapyTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        con = MemoryConnection ([self.root])
+        con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "People"})
+        con.add ("uid=john,ou=People,%s" % self.root, {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (con)
+        self.ldapy.changeDN (self.root)
+        self.ldif = [
+            "dn: ou=People,%s" % self.root,
+            "objectClass: organizationalUnit",
+            "ou: People",
+            "description: Everyone",
+            "",
+            "dn: uid=jack,ou=People,%s" % self.root,
+            "objectClass: person",
+            "uid: jack",
+            ]
+
+    def test_apply (self):
+        self.assertItemsEqual (["uid=john"], self.ldapy._resolveRelativeDN ("ou=People").relativeChildren.keys ())
+        records = self.ldapy.apply (self.ldif)
+        self.assertListEqual (["delete", "modify", "add"], [changetype for changetype, _, _ in records])
+
+        # What was read is read again
+        self.ldapy.changeDN ("ou=People")
+        self.assertListEqual (["uid=jack"], self.ldapy.children)
+        self.assertListEqual (["Everyone"], self.ldapy.attributes["description"])
+
+    def test_dry_run (self):
+        self.assertEqual (3, len(self.ldapy.apply (self.ldif, dryRun = True)))
+        self.assertListEqual (["john"], self.ldapy.getAttributes ("ou=People/uid=john")["uid"])
+
+    def test_errors (self):
+        with self.assertRaises (ApplyError):
+            self.ldapy.apply (self.ldif + ["changetype: add"])
+        with self.assertRaises (ApplyError):
+            self.ldapy.apply (["dn: not a dn"])
+
+class PipeliningLdapyTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        self.con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "People"})
+        self.con.add ("uid=john,ou=People,%s" % self.root, {"objectClass": "person", "uid": "john"})
+        self.ldapy = Ldapy (self.con)
+        self.ldapy.changeDN (self.root)
+        self.errback = mock.Mock ()
+        self.ldapy.startPipelining (self.errback)
+
+    def tearDown (self):
+        self.ldapy.stopPipelining ()
+
+    def test_failed_add_is_forgotten (self):
+        self.ldapy.changeDN ("ou=People")
+        self.assertListEqual (["uid=john"], self.ldapy.children)
+        self.con._add = mock.Mock (side_effect = AlreadyExists ("uid=jack,ou=People,%s" % self.root))
+        self.ldapy.add ("uid=jack", {"objectClass": "person", "uid": "jack"})
+
+        self.assertEqual (1, self.errback.call_count)
+        self.ldapy.changeDN ("/%s/ou=People" % self.root)
+        self.assertListEqual (["uid=john"], self.ldapy.children)
+
+    def test_failed_delete_is_read_again (self):
+        self.assertListEqual (["ou=People"], self.ldapy.children)
+
+        # An error which doesn't tell the DN
+        self.con._delete = mock.Mock (side_effect = LdapError (Exception ("Unwilling to perform")))
+        self.ldapy.delete ("ou=People")
+
+        self.assertEqual (2, self.errback.call_count)
+        self.ldapy.changeDN ("/%s" % self.root)
+        self.assertListEqual (["ou=People"], self.ldapy.children)
+        self.assertListEqual (["john"], self.ldapy.getAttributes ("ou=People/uid=john")["uid"])
+
 class ErrorLdapyTests (unittest2.TestCase):
     def setUp (self):
         self.con = configuration.getConnection ()
@@ -212,6 +477,22 @@ class ErrorLdapyTests (unittest2.TestCase):
             expected = NoSuchObject (nonexistent)
             self.assertEqual (str(received.exception), str(expected))
 
+    def test_change_DN_to_nonexistent_descendant (self):
+        with configuration.provision() as p:
+            c = p.container()
+
+            ldapy = Ldapy (self.con)
+            ldapy.changeDN (p.root)
+
+            nonexistentRDN = "ou=Foobar"
+            nonexistent = "%s,%s" % (nonexistentRDN, c.dn)
+            with self.assertRaises(NoSuchObject) as received:
+                ldapy.changeDN ("%s/%s" % (c.rdn, nonexistentRDN))
+
+            expected = NoSuchObject (nonexistent)
+            self.assertEqual (str(received.exception), str(expected))
+            self.assertEqual (ldapy.cwd, p.root)
+
     def test_up_one_level_too_far (self):
         ldapy = Ldapy (self.con)
 
@@ -332,6 +613,16 @@ class ArgumentParserTests (unittest2.TestCase):
         self.assertEqual (connectionData.bind_dn, bind_dn)
         self.assertEqual (connectionData.password, password)
 
+    def test_successful_parse_with_several_uris (self):
+        ldapy = Ldapy (self.con)
+
+        uris = ["ldap://a:7", "ldap://b"]
+        args = uris + ["--strategy", "least-latency"]
+
+        connectionData, _ = ldapy.parseArguments (args)
+        self.assertListEqual (connectionData.uri, uris)
+        self.assertEqual (connectionData.strategy, "least-latency")
+
     def test_neither_host_nor_uri_is_specified_and_no_recent_connection (self):
         ldapy = Ldapy (self.con)
 
@@ -379,6 +670,23 @@ class ArgumentParserTests (unittest2.TestCase):
         self.assertIn(ldapy._port_is_not_a_valid_number, output.getvalue())
         assertSystemExitStatus(self, e.exception, 2)
 
+    def test_port_invalid_number_in_one_of_several_uris (self):
+        ldapy = Ldapy (self.con)
+
+        with mock.patch('sys.stderr', new_callable=io.BytesIO) as output:
+            with self.assertRaises(SystemExit) as e:
+                ldapy.parseArguments (["ldap://a", "ldap://b:%u" % (0xffff + 1)])
+
+        self.assertIn(ldapy._port_is_not_a_valid_number, output.getvalue())
+        assertSystemExitStatus(self, e.exception, 2)
+
+    def test_ports_of_several_uris_are_checked_independently (self):
+        ldapy = Ldapy (self.con)
+
+        uris = ["ldap://a:%u" % 0xffff, "ldap://b"]
+        connectionData, _ = ldapy.parseArguments (uris + ["-p", "-1"])
+        self.assertListEqual (connectionData.uri, uris)
+
 
     def test_previous_connection (self):
         ldapy = Ldapy (self.con)
@@ -571,6 +879,63 @@ class ArgumentParserTests (unittest2.TestCase):
         assertSystemExitStatus(self, e.exception, 3)
 
 
+    def test_batch_commands (self):
+        ldapy = Ldapy (self.con)
+        self.assertIsNone (ldapy.batchInput ())
+
+        commands = "cd foo; ls"
+        ldapy.parseArguments (["-H", "foo", "-c", commands])
+        self.assertListEqual ([commands], ldapy.batchInput ())
+
+    def test_batch_file (self):
+        ldapy = Ldapy (self.con)
+        with tempfile.NamedTemporaryFile() as script:
+            script.write ("ls\npwd\n")
+            script.flush ()
+
+            ldapy.parseArguments (["-H", "foo", "-f", script.name])
+            self.assertListEqual (["ls\n", "pwd\n"], list(ldapy.batchInput ()))
+
+    def test_daemon_without_commands (self):
+        ldapy = Ldapy (self.con)
+
+        with mock.patch('sys.stdin') as stdin:
+            stdin.isatty.return_value = True
+            with mock.patch('sys.stderr', new_callable=io.BytesIO) as output:
+                with self.assertRaises(SystemExit) as e:
+                    ldapy.parseArguments (["-H", "foo", "--daemon"])
+
+        self.assertIn(ldapy._daemon_without_commands, output.getvalue())
+        assertSystemExitStatus(self, e.exception, 2)
+
+    def test_daemon_does_not_connect (self):
+        with mock.patch("sys.argv", ["ldapy", "-H", "foo", "-c", "ls", "--daemon"]):
+            ldapy = Ldapy ()
+
+        self.assertIsNone (ldapy.connection)
+        self.assertEqual ("ldap://foo:389", ldapy.connectionData.uri)
+        self.assertTrue (ldapy.newConnection)
+
+    def test_stored_connections_do_not_need_python_ldap (self):
+        script = "\n".join ([
+            "import sys",
+            "from ldapy.ldapy import Ldapy",
+            "try:",
+            "    Ldapy ()",
+            "except SystemExit:",
+            "    pass",
+            "print [m for m in ['ldap', 'ldapurl', 'readline'] if m in sys.modules]"])
+
+        package = os.path.dirname (os.path.dirname (ldapy.ldapy.__file__))
+        env = dict (os.environ)
+        env["PYTHONPATH"] = os.pathsep.join ([package, env.get ("PYTHONPATH", "")])
+
+        with tempfile.NamedTemporaryFile() as history:
+            env[ConnectionDataManager.variable] = history.name
+            for args in [["--previous"], ["--saved"], ["--help"]]:
+                output = subprocess.check_output ([sys.executable, "-c", script] + args, env = env)
+                self.assertTrue (output.endswith ("[]\n"), output)
+
     def test_no_uri_or_host_defaults_to_last_connection (self):
         ldapy = Ldapy (self.con)
         getter = mock.create_autospec (ldapy.connectionDataManager.getRecentConnection)
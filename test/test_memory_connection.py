@@ -0,0 +1,234 @@
+from ldapy.memory_connection import MemoryConnection, FilterError, parseFilter
+from ldapy.connection import scopeBase, scopeOneLevel, scopeSubtree
+from ldapy.exceptions import LdapError, NoSuchObject, AlreadyExists, TypeOrValueExists
+from ldapy.node import Node
+from ldapy.ldapy import Ldapy
+import unittest2
+import mock
+
+root = "dc=nodomain"
+
+def populated (latency = 0.0):
+    con = MemoryConnection ([root], latency = latency)
+    con.add ("ou=People,%s" % root, {"objectClass": "organizationalUnit", "ou": "People"})
+    for n in range (5):
+        con.add ("uid=user%u,ou=People,%s" % (n, root),
+                {"objectClass": ["top", "person"], "uid": "user%u" % n,
+                 "description": "number %u" % n})
+    return con
+
+class FilterTests (unittest2.TestCase):
+    attributes = {"cn": ["John Doe", "Johnny"], "uidNumber": ["1000"],
+            "objectClass": ["top", "person"]}
+
+    def assertMatches (self, filterstr, expected = True):
+        self.assertEqual (parseFilter (filterstr) (self.attributes), expected)
+
+    def test_equality (self):
+        self.assertMatches ("(cn=john doe)")
+        self.assertMatches ("(CN=Johnny)")
+        self.assertMatches ("(cn=John)", False)
+        self.assertMatches ("(sn=John Doe)", False)
+
+    def test_presence (self):
+        self.assertMatches ("(uidNumber=*)")
+        self.assertMatches ("(sn=*)", False)
+
+    def test_substrings (self):
+        self.assertMatches ("(cn=John*)")
+        self.assertMatches ("(cn=*Doe)")
+        self.assertMatches ("(cn=J*n*D*e)")
+        self.assertMatches ("(cn=Jo*hn*x)", False)
+        self.assertMatches ("(cn=Johnn*nny)", False)
+
+    def test_ordering (self):
+        self.assertMatches ("(uidNumber>=0999)")
+        self.assertMatches ("(uidNumber<=0999)", False)
+        self.assertMatches ("(cn~=johnny)")
+
+    def test_boolean (self):
+        self.assertMatches ("(&(objectClass=person)(cn=Johnny))")
+        self.assertMatches ("(&(objectClass=person)(cn=Foo))", False)
+        self.assertMatches ("(|(cn=Foo)(cn=Johnny))")
+        self.assertMatches ("(!(cn=Foo))")
+        self.assertMatches ("(!(|(cn=Foo)(objectClass=top)))", False)
+
+    def test_escaped_value (self):
+        attributes = {"description": ["a*(b)"]}
+        self.assertTrue (parseFilter ("(description=a\\2a\\28b\\29)") (attributes))
+        self.assertFalse (parseFilter ("(description=a\\2a)") (attributes))
+
+    def test_bad_filters (self):
+        for filterstr in ["cn=foo", "(cn=foo", "(&)", "(!(cn=a)(cn=b))",
+                "(=foo)", "(cn)", "(cn=foo)(cn=bar)", "(cn=\\zz)"]:
+            with self.assertRaises (FilterError):
+                parseFilter (filterstr)
+
+class SearchTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = populated ()
+        self.people = "ou=People,%s" % root
+
+    def test_roots (self):
+        self.assertListEqual (self.con.roots, [root])
+        dn, attributes = self.con.search (root, scopeBase)[0]
+        self.assertEqual (dn, root)
+        self.assertListEqual (attributes["dc"], ["nodomain"])
+
+    def test_scopes (self):
+        self.assertEqual (len(self.con.search (self.people, scopeBase)), 1)
+        self.assertEqual (len(self.con.search (self.people, scopeOneLevel)), 5)
+
+        dns = [dn for dn, _ in self.con.search (root, scopeSubtree)]
+        self.assertEqual (len(dns), 7)
+        self.assertLess (dns.index (self.people), dns.index ("uid=user0,%s" % self.people))
+
+    def test_dn_is_case_insensitive (self):
+        self.assertEqual (len(self.con.search ("OU=people,DC=nodomain", scopeOneLevel)), 5)
+
+    def test_no_such_object (self):
+        with self.assertRaises (NoSuchObject):
+            self.con.search ("ou=Foobar,%s" % root, scopeBase)
+
+    def test_attrlist (self):
+        _, attributes = self.con.search ("uid=user0,%s" % self.people,
+                scopeBase, attrlist = ["UID"])[0]
+        self.assertDictEqual (attributes, {"uid": ["user0"]})
+
+        _, attributes = self.con.search (self.people, scopeBase, attrlist = ["1.1"])[0]
+        self.assertDictEqual (attributes, {})
+
+    def test_results_are_copies (self):
+        _, attributes = self.con.search (self.people, scopeBase)[0]
+        attributes["ou"].append ("Foobar")
+        _, attributes = self.con.search (self.people, scopeBase)[0]
+        self.assertListEqual (attributes["ou"], ["People"])
+
+    def test_search_limited (self):
+        results, complete = self.con.searchLimited (self.people, scopeOneLevel,
+                "(uid=user*)", sizelimit = 3)
+        self.assertEqual (len(results), 3)
+        self.assertFalse (complete)
+
+        results, complete = self.con.searchLimited (self.people, scopeOneLevel,
+                "(description=number 4)", sizelimit = 3)
+        self.assertEqual (len(results), 1)
+        self.assertTrue (complete)
+
+    def test_search_paged (self):
+        with mock.patch ("time.sleep") as sleep:
+            self.con.latency = 0.01
+            results = list (self.con.searchPaged (root, scopeSubtree, pageSize = 3))
+
+        self.assertEqual (len(results), 7)
+        self.assertEqual (sleep.call_count, 3)
+
+    def test_latency (self):
+        con = populated (latency = 0.01)
+        with mock.patch ("time.sleep") as sleep:
+            con.search (root, scopeBase)
+            sleep.assert_called_once_with (0.01)
+
+class ModificationTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = populated ()
+        self.dn = "uid=user0,ou=People,%s" % root
+
+    def attributes (self, dn = None):
+        return self.con.search (dn if dn else self.dn, scopeBase)[0][1]
+
+    def test_add (self):
+        dn = "cn=test_add,%s" % root
+        self.con.add (dn, {"objectClass": "organizationalRole"})
+        self.assertListEqual (self.attributes (dn)["objectClass"], ["organizationalRole"])
+
+        with self.assertRaises (AlreadyExists):
+            self.con.add (dn, {"objectClass": "organizationalRole"})
+
+        with self.assertRaises (NoSuchObject):
+            self.con.add ("cn=foo,ou=Foobar,%s" % root, {"objectClass": "organizationalRole"})
+
+    def test_modify (self):
+        # Add a value
+        self.con.modify (self.dn, {}, {"description": "another"})
+        self.assertListEqual (self.attributes ()["description"], ["number 0", "another"])
+
+        with self.assertRaises (TypeOrValueExists):
+            self.con.modify (self.dn, {}, {"description": "another"})
+
+        # Replace the values
+        self.con.modify (self.dn, {"description": ["number 0", "another"]},
+                {"description": ["foo"]})
+        self.assertListEqual (self.attributes ()["description"], ["foo"])
+
+        # Remove the attribute
+        self.con.modify (self.dn, {"description": ["foo"]}, {"description": []})
+        self.assertNotIn ("description", self.attributes ())
+
+    def test_delete (self):
+        self.con.delete (self.dn)
+        with self.assertRaises (NoSuchObject):
+            self.con.search (self.dn, scopeBase)
+
+        with self.assertRaises (NoSuchObject):
+            self.con.delete (self.dn)
+
+        with self.assertRaises (LdapError):
+            self.con.delete ("ou=People,%s" % root)
+
+    def test_delete_root (self):
+        con = MemoryConnection ([root])
+        con.delete (root)
+        with self.assertRaises (NoSuchObject):
+            con.search (root, scopeBase)
+
+    def test_rename (self):
+        self.con.rename (self.dn, "uid=renamed")
+        dn = "uid=renamed,ou=People,%s" % root
+        self.assertListEqual (self.attributes (dn)["uid"], ["renamed"])
+        with self.assertRaises (NoSuchObject):
+            self.con.search (self.dn, scopeBase)
+
+        with self.assertRaises (AlreadyExists):
+            self.con.rename (dn, "uid=user1")
+
+    def test_move_subtree (self):
+        self.con.add ("ou=Groups,%s" % root, {"objectClass": "organizationalUnit"})
+        self.con.rename ("ou=People,%s" % root, "ou=Staff", "ou=Groups,%s" % root)
+
+        results = self.con.search ("ou=Staff,ou=Groups,%s" % root, scopeSubtree)
+        self.assertEqual (len(results), 6)
+        self.assertEqual (results[1][0], "uid=user0,ou=Staff,ou=Groups,%s" % root)
+        self.assertListEqual (results[0][1]["ou"], ["Staff"])
+        self.assertListEqual (self.con.search (root, scopeOneLevel), [("ou=Groups,%s" % root,
+            {"objectClass": ["organizationalUnit"]})])
+
+        with self.assertRaises (LdapError):
+            self.con.rename ("ou=Groups,%s" % root, "ou=Groups", "ou=Staff,ou=Groups,%s" % root)
+
+    def test_pipelining (self):
+        errback = mock.Mock ()
+        self.con.startPipelining (errback)
+        self.con.delete ("cn=foobar,%s" % root)
+        self.con.stopPipelining ()
+
+        self.assertEqual (errback.call_count, 1)
+        self.assertIsInstance (errback.call_args[0][0], NoSuchObject)
+
+class Layers (unittest2.TestCase):
+    def test_node (self):
+        con = populated ()
+        node = Node (con, "ou=People,%s" % root)
+        self.assertEqual (len(node.children), 5)
+        self.assertListEqual (node.completeChild ("uid=user1"), ["uid=user1"])
+
+    def test_ldapy (self):
+        ldapy = Ldapy (populated ())
+        ldapy.changeDN ("%s/ou=People" % root)
+        self.assertEqual (ldapy.cwd, "ou=People,%s" % root)
+
+        ldapy.setAttribute ("uid=user2", "description", newValue = "foo")
+        self.assertIn ("foo", ldapy.getAttributes ("uid=user2")["description"])
+
+        ldapy.delete ("uid=user2")
+        self.assertNotIn ("uid=user2", ldapy.children)
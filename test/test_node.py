@@ -4,6 +4,7 @@ import unittest2
 import mock
 import configuration
 import provisioning
+from ldapy.memory_connection import MemoryConnection
 
 class BasicNodeTests (unittest2.TestCase):
     def setUp (self):
@@ -400,6 +401,290 @@ class AddTests (unittest2.TestCase):
                 # Cleanup
                 p.delete (dn)
 
+class AddWithoutReadingTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        self.node = Node (self.con, self.root)
+        self.con.statistics.reset ()
+
+    def assertNotRead (self, rdn):
+        child = self.node.descendant ([rdn])
+        self.assertEqual (["organizationalRole"], child.attributes["objectClass"])
+        self.assertEqual (["foo", "bar"], child.attributes["description"])
+        self.assertEqual (1, self.con.statistics.roundTrips)
+
+    def test_added_child_is_not_read (self):
+        self.node.add ("cn=new", {"objectClass": "organizationalRole",
+            "description": ["foo", "bar"]})
+        self.assertNotRead ("cn=new")
+
+    def test_added_child_is_not_read_with_populated_children (self):
+        self.node.children
+        self.con.statistics.reset ()
+        self.node.add ("cn=new", {"objectClass": "organizationalRole",
+            "description": ["foo", "bar"]})
+        self.assertNotRead ("cn=new")
+
+    def test_attributes_read_back_are_used (self):
+        readBack = {"objectClass": ["organizationalRole"], "description": ["foo", "bar"]}
+        with mock.patch.object (self.con, "add", return_value = readBack):
+            self.node.add ("cn=new", {"objectClass": "organizationalRole"})
+
+        self.assertIs (readBack, self.node.descendant (["cn=new"]).attributes)
+
+class ModifyWithoutReadingTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        self.con.add ("cn=a,%s" % self.root, {"objectClass": "organizationalRole",
+            "description": "foo"})
+        self.node = Node (self.con, "cn=a,%s" % self.root)
+        self.node.attributes
+
+    def test_attributes_read_back_are_used (self):
+        # Eg someone else added a value since we read the entry
+        readBack = {"objectClass": ["organizationalRole"], "description": ["bar", "baz"]}
+        with mock.patch.object (self.con, "modify", return_value = readBack):
+            self.node.setAttribute ("description", oldValue = "foo", newValue = "bar")
+
+        self.assertIs (readBack, self.node.attributes)
+
+    def test_modification_is_applied_otherwise (self):
+        self.node.setAttribute ("description", oldValue = "foo", newValue = "bar")
+        self.assertEqual (["bar"], self.node.attributes["description"])
+
+class RenameTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        self.con.add ("ou=People,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "People"})
+        self.con.add ("ou=Groups,%s" % self.root, {"objectClass": "organizationalUnit", "ou": "Groups"})
+        self.con.add ("uid=john,ou=People,%s" % self.root, {"objectClass": "person", "uid": "john"})
+        self.node = Node (self.con, self.root)
+
+    def test_subtree_is_not_read_again (self):
+        people = self.node.descendant (["ou=People"])
+        john = people.descendant (["uid=john"])
+        self.node.children
+        self.con.statistics.reset ()
+
+        people.rename ("ou=Staff", self.node.descendant (["ou=Groups"]))
+        self.assertEqual (1, self.con.statistics.roundTrips)
+
+        self.assertEqual ("uid=john,ou=Staff,ou=Groups,%s" % self.root, john.dn)
+        self.assertEqual (["person"], john.attributes["objectClass"])
+        self.assertListEqual (["ou=Groups"], list (self.node.relativeChildren.keys ()))
+        self.assertIs (john, self.node.descendant (["ou=Groups", "ou=Staff", "uid=john"]))
+        self.assertEqual (1, self.con.statistics.roundTrips)
+
+        # The values of the RDN have changed
+        self.assertEqual (["Staff"], people.attributes["ou"])
+
+    def test_move_to_super_root (self):
+        people = self.node.descendant (["ou=People"])
+        superRoot = Node (self.con, "")
+        self.con.statistics.reset ()
+        with self.assertRaises (NodeError):
+            people.rename ("ou=People", superRoot)
+        self.assertEqual (0, self.con.statistics.roundTrips)
+        self.assertEqual ("ou=People,%s" % self.root, people.dn)
+
+    def test_rename_in_place (self):
+        john = self.node.descendant (["ou=People", "uid=john"])
+        john.rename ("uid=jack")
+        self.assertEqual ("uid=jack,ou=People,%s" % self.root, john.dn)
+        self.assertEqual (["jack"], john.attributes["uid"])
+        self.assertEqual (["uid=jack"], list (john.parent.relativeChildren.keys ()))
+
+    def test_cannot_move_below_itself (self):
+        people = self.node.descendant (["ou=People"])
+        with self.assertRaises (NodeError):
+            people.rename ("ou=People", people.descendant (["uid=john"]))
+
+    def test_cannot_rename_root (self):
+        with self.assertRaises (NodeError):
+            self.node.rename ("dc=foo")
+
+class CaseInsensitiveCompletionTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        for uid in ["John", "jack", "mary"]:
+            self.con.add ("uid=%s,%s" % (uid, self.root), {"objectClass": "person", "uid": uid})
+
+    def test_searched_completions (self):
+        node = Node (self.con, self.root)
+        self.assertListEqual (["uid=John"], node.completeChild ("uid=jo"))
+        self.assertListEqual (["uid=jack"], node.completeChild ("UID=JA"))
+        self.assertIsNone (node._children)
+
+    def test_without_attribute_name (self):
+        node = Node (self.con, self.root)
+        with mock.patch.object (self.con, "searchLimited",
+                wraps = self.con.searchLimited) as searchMock:
+            self.assertItemsEqual (["uid=John", "uid=jack", "uid=mary"], node.completeChild ("U"))
+            self.assertListEqual (["uid=mary"], node.completeChild ("uid=m"))
+
+        self.assertEqual (1, searchMock.call_count)
+        self.assertIsNone (node._children)
+
+    def test_without_attribute_name_limited (self):
+        node = Node (self.con, self.root)
+        node.completionSizeLimit = 2
+        self.assertEqual (2, len(node.completeChild ("u")))
+        self.assertListEqual (["uid=mary"], node.completeChild ("uid=m"))
+        self.assertIsNone (node._children)
+
+    def test_populated_children (self):
+        node = Node (self.con, self.root)
+        node.children
+        self.assertListEqual (["uid=jack", "uid=John"], sorted (node.completeChild ("uid=j"),
+            key = lambda rdn: rdn.lower ()))
+        self.assertListEqual (["uid=John"], node.completeChild ("uid=jO"))
+
+class CompletionTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = configuration.getConnection ()
+
+    def test_complete_populated_children (self):
+        with configuration.provision() as p:
+            c = p.container()
+            l1 = p.leaf(c)
+            l2 = p.leaf(c)
+
+            node = Node (self.con, c.dn)
+            node.children
+
+            with mock.patch ("ldapy.connection.Connection.searchLimited", autospec=True) as search_mock:
+                matches = node.completeChild ("%s=" % l1.dnComponent)
+
+            self.assertFalse (search_mock.called)
+            self.assertListEqual (sorted([l1.rdn, l2.rdn]), sorted(matches))
+
+    def test_complete_without_populating_children (self):
+        with configuration.provision() as p:
+            c = p.container()
+            l1 = p.leaf(c)
+            l2 = p.leaf(c)
+
+            node = Node (self.con, c.dn)
+
+            matches = node.completeChild (l1.rdn[:-1])
+            self.assertListEqual ([l1.rdn], matches)
+            self.assertIsNone (node._children)
+
+    def test_refines_cached_completions_locally (self):
+        with configuration.provision() as p:
+            c = p.container()
+            l1 = p.leaf(c)
+            l2 = p.leaf(c)
+
+            node = Node (self.con, c.dn)
+            matches = node.completeChild ("%s=" % l1.dnComponent)
+            self.assertListEqual (sorted([l1.rdn, l2.rdn]), sorted(matches))
+
+            with mock.patch ("ldapy.connection.Connection.searchLimited", autospec=True) as search_mock:
+                matches = node.completeChild (l2.rdn[:-1])
+
+            self.assertFalse (search_mock.called)
+            self.assertListEqual ([l2.rdn], matches)
+
+    def test_incomplete_completions_are_not_refined_locally (self):
+        with configuration.provision() as p:
+            c = p.container()
+            l1 = p.leaf(c)
+            l2 = p.leaf(c)
+
+            node = Node (self.con, c.dn)
+            node.completionSizeLimit = 1
+            matches = node.completeChild ("%s=" % l1.dnComponent)
+            self.assertEqual (len(matches), 1)
+
+            matches = node.completeChild (l1.rdn[:-1])
+            self.assertListEqual ([l1.rdn], matches)
+            matches = node.completeChild (l2.rdn[:-1])
+            self.assertListEqual ([l2.rdn], matches)
+
+    def test_completions_are_forgotten_after_add (self):
+        with configuration.provision() as p:
+            c = p.container()
+            l = p.leaf(c)
+
+            node = Node (self.con, c.dn)
+            self.assertListEqual ([l.rdn], node.completeChild ("%s=" % l.dnComponent))
+
+            rdn = "%s=test_completions_are_forgotten_after_add" % l.dnComponent
+            dn = "%s,%s" % (rdn, c.dn)
+            try:
+                node.add (rdn, {"objectClass": l.objectClass})
+                matches = node.completeChild ("%s=" % l.dnComponent)
+                self.assertListEqual (sorted([l.rdn, rdn]), sorted(matches))
+            finally:
+                p.delete (dn)
+
+class SynchronizedTests (unittest2.TestCase):
+    def setUp (self):
+        self.root = "dc=nodomain"
+        self.con = MemoryConnection ([self.root])
+        for n in range (10):
+            self.con.add ("cn=leaf%u,%s" % (n, self.root), {"objectClass": "organizationalRole"})
+
+    def test_children_are_populated_once (self):
+        node = Node (self.con, self.root, synchronized = True)
+        with mock.patch.object (self.con, "search",
+                side_effect = configuration.slowly (self.con.search, 0.01)) as searchMock:
+            results = configuration.inThreads (lambda: len(node.children), n = 10)
+
+        self.assertEqual (1, searchMock.call_count)
+        self.assertEqual ([10] * 10, results)
+
+    def test_children_are_synchronized (self):
+        node = Node (self.con, self.root, synchronized = True)
+        self.assertTrue (all ([child.synchronized for child in node.children]))
+        self.assertFalse (Node (self.con, self.root).synchronized)
+
+    def test_children_seen_do_not_change (self):
+        node = Node (self.con, self.root, synchronized = True)
+        children = node.relativeChildren
+        node.add ("cn=new", {"objectClass": "organizationalRole"})
+        node.relativeChildren["cn=leaf0"].delete ()
+
+        self.assertIn ("cn=leaf0", children)
+        self.assertNotIn ("cn=new", children)
+        self.assertIn ("cn=new", node.relativeChildren)
+        self.assertNotIn ("cn=leaf0", node.relativeChildren)
+
+    def test_racing_splices_share_the_nodes (self):
+        self.con.add ("cn=deep,cn=leaf0,%s" % self.root, {"objectClass": "organizationalRole"})
+        node = Node (self.con, self.root, synchronized = True)
+        child = Node._child
+        others = []
+        def racing (parent, dn, *args, **kwargs):
+            # Another thread splices the same path meanwhile
+            if not others:
+                others.append (None)
+                others[0] = node.descendant (["cn=leaf0", "cn=deep"])
+            return child (parent, dn, *args, **kwargs)
+
+        with mock.patch.object (Node, "_child", racing):
+            mine = node.descendant (["cn=leaf0", "cn=deep"])
+
+        self.assertIs (others[0], mine)
+        self.assertIs (node.descendant (["cn=leaf0"]), mine.parent)
+        self.assertIs (mine, node.descendant (["cn=leaf0", "cn=deep"]))
+
+    def test_concurrent_adds (self):
+        node = Node (self.con, self.root, synchronized = True)
+        node.children
+        counter = iter (range (100))
+        def add ():
+            for _ in range (10):
+                node.add ("cn=new%u" % next (counter), {"objectClass": "organizationalRole"})
+
+        configuration.inThreads (add, n = 10)
+        self.assertEqual (110, len(node.children))
+
 class NodeErrors (unittest2.TestCase):
     def setUp (self):
         self.con = configuration.getConnection ()
@@ -0,0 +1,76 @@
+from ldapy.statistics import Statistics, Record, size
+from ldapy.memory_connection import MemoryConnection
+from ldapy.connection import scopeBase, scopeOneLevel
+from ldapy.exceptions import NoSuchObject
+import unittest2
+import mock
+import configuration
+
+class StatisticsTests (unittest2.TestCase):
+    def test_size (self):
+        self.assertEqual (size ("cn=a", {"cn": ["a"], "description": "bc"}), 4 + 3 + 13)
+
+    def test_record (self):
+        statistics = Statistics ()
+        statistics.record (Record ("search", "dc=a", scopeBase, 1, 10, 0.0005))
+        statistics.record (Record ("search", "dc=a", scopeOneLevel, 3, 30, 0.015))
+        statistics.record (Record ("add", "cn=b,dc=a", None, 0, 5, 10.0))
+
+        self.assertEqual (statistics.roundTrips, 3)
+        search = statistics.summaries["search"]
+        self.assertEqual (search.count, 2)
+        self.assertEqual (search.entries, 4)
+        self.assertEqual (search.bytes, 40)
+        self.assertEqual (search.histogram[0], 1)
+        self.assertEqual (search.histogram[Statistics.buckets.index (20)], 1)
+        self.assertEqual (statistics.summaries["add"].histogram[-1], 1)
+        self.assertEqual (len(statistics.log), 3)
+
+        statistics.reset ()
+        self.assertEqual (statistics.roundTrips, 0)
+        self.assertEqual (len(statistics.log), 0)
+
+    def test_log_is_bounded (self):
+        statistics = Statistics ()
+        for n in range (Statistics.logSize + 1):
+            statistics.record (Record ("search", str(n), scopeBase, 0, 0, 0.0))
+        self.assertEqual (len(statistics.log), Statistics.logSize)
+        self.assertEqual (statistics.log[0].dn, "1")
+
+    def test_record_in_threads (self):
+        statistics = Statistics ()
+        def record ():
+            for n in range (1000):
+                statistics.record (Record ("search%u" % (n % 10), "dc=a", scopeBase, 0, 0, 1.0))
+                statistics.cacheHit ()
+
+        configuration.inThreads (record, n = 10)
+        self.assertEqual (10000, statistics.roundTrips)
+        self.assertEqual (10000, statistics.totalRoundTrips)
+        self.assertEqual (10000.0, statistics.totalSeconds)
+        self.assertEqual (10000, statistics.cacheHits)
+
+    @mock.patch ("time.time", side_effect = [1.0, 1.25])
+    def test_measure (self, time):
+        statistics = Statistics ()
+        with statistics.measure ("search", "dc=a", scopeBase) as m:
+            m.returned ([("dc=a", {"dc": ["a"]})])
+
+        record = statistics.log[0]
+        self.assertEqual (record, Record ("search", "dc=a", scopeBase, 1, 7, 0.25))
+
+    def test_failed_operations_are_recorded (self):
+        con = MemoryConnection (["dc=nodomain"])
+        with self.assertRaises (NoSuchObject):
+            con.search ("cn=foo,dc=nodomain", scopeBase)
+        self.assertEqual (con.statistics.summaries["search"].count, 1)
+
+    def test_connection_records (self):
+        con = MemoryConnection (["dc=nodomain"])
+        con.add ("cn=foo,dc=nodomain", {"objectClass": "organizationalRole"})
+        con.search ("dc=nodomain", scopeOneLevel)
+        con.delete ("cn=foo,dc=nodomain")
+
+        self.assertListEqual ([r.operation for r in con.statistics.log],
+                ["add", "search", "delete"])
+        self.assertEqual (con.statistics.log[1].entries, 1)
@@ -0,0 +1,276 @@
+import unittest2
+import mock
+from ldapy.memory_connection import MemoryConnection
+from ldapy.connection import scopeBase, scopeOneLevel, scopeSubtree
+from ldapy.exceptions import AlreadyExists
+from ldapy import subtree
+
+root = "dc=nodomain"
+
+# A value which isn't UTF-8, as the connection decodes it
+binary = b"\xff\xd8\xff\xe0"
+if not isinstance (binary, str):
+    binary = binary.decode ("utf-8", "surrogateescape")
+
+def populated ():
+    con = MemoryConnection ([root])
+    con.add ("ou=Template,%s" % root, {"objectClass": "organizationalUnit", "ou": "Template"})
+    con.add ("ou=People,ou=Template,%s" % root, {"objectClass": "organizationalUnit", "ou": "People"})
+    for n in range (3):
+        con.add ("uid=user%u,ou=People,ou=Template,%s" % (n, root),
+                {"objectClass": "person", "uid": "user%u" % n})
+    return con
+
+class CopyTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = populated ()
+
+    def dns (self, con, dn):
+        return [entry[0] for entry in con.search (dn, scopeSubtree)]
+
+    def test_copy_subtree (self):
+        copied = subtree.copy (self.con, "ou=Template,%s" % root,
+                self.con, "ou=Tenant,%s" % root)
+        self.assertEqual ((5, True), copied)
+
+        copied = self.dns (self.con, "ou=Tenant,%s" % root)
+        self.assertListEqual ([dn.replace ("ou=Template", "ou=Tenant")
+            for dn in self.dns (self.con, "ou=Template,%s" % root)], copied)
+
+        # The values of the RDN of the copied entry follow its new RDN
+        attributes = self.con.search ("ou=Tenant,%s" % root, scopeBase)[0][1]
+        self.assertListEqual (["Tenant"], attributes["ou"])
+
+    def test_copy_entry (self):
+        subtree.copy (self.con, "ou=Template,%s" % root, self.con,
+                "ou=Tenant,%s" % root, recursive = False)
+        self.assertListEqual (["ou=Tenant,%s" % root], self.dns (self.con, "ou=Tenant,%s" % root))
+
+    def test_copy_to_another_connection (self):
+        target = MemoryConnection ([root])
+        target.statistics.reset ()
+        subtree.copy (self.con, "ou=People,ou=Template,%s" % root, target, "ou=People,%s" % root)
+        self.assertEqual (4, len(self.dns (target, "ou=People,%s" % root)))
+        self.assertEqual (4, target.statistics.summaries["add"].count)
+
+    def test_one_streamed_search (self):
+        self.con.statistics.reset ()
+        subtree.copy (self.con, "ou=Template,%s" % root, self.con, "ou=Tenant,%s" % root)
+        self.assertListEqual (["add", "search (page)"], sorted (self.con.statistics.summaries.keys ()))
+        self.assertEqual (1, self.con.statistics.summaries["search (page)"].count)
+
+    def test_children_before_parents_are_deferred (self):
+        entries = self.con.search ("ou=Template,%s" % root, scopeSubtree)
+        source = mock.Mock ()
+        source.searchPaged.return_value = iter (reversed (entries))
+
+        target = MemoryConnection ([root])
+        subtree.copy (source, "ou=Template,%s" % root, target, "ou=Tenant,%s" % root)
+        self.assertEqual (5, len(self.dns (target, "ou=Tenant,%s" % root)))
+
+    def test_errors_are_passed_on (self):
+        errback = mock.Mock ()
+        self.assertEqual ((0, False), subtree.copy (self.con, "ou=People,ou=Template,%s" % root,
+                self.con, "ou=People,ou=Template,%s" % root, errback = errback))
+        self.assertEqual (4, errback.call_count)
+        self.assertIsInstance (errback.call_args[0][0], AlreadyExists)
+        self.assertFalse (self.con.pipelining)
+
+    def test_pipelining_is_kept (self):
+        errback = mock.Mock ()
+        self.con.startPipelining (errback)
+        self.assertEqual ((0, False), subtree.copy (self.con, "ou=Template,%s" % root,
+                self.con, "ou=Template,%s" % root))
+        self.assertIs (errback, self.con.pipelineErrback)
+        self.assertEqual (5, errback.call_count)
+
+class SortedByDNTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = populated ()
+        self.base = "ou=Template,%s" % root
+        self.entries = self.con.search (self.base, scopeSubtree)
+
+    def test_parents_before_children (self):
+        keys = [key for key, _, _ in subtree.sortedByDN (reversed (self.entries), self.base)]
+        self.assertListEqual ([(), ("ou=people",), ("ou=people", "uid=user0"),
+            ("ou=people", "uid=user1"), ("ou=people", "uid=user2")], keys)
+
+    def test_spilled_runs_are_merged (self):
+        with mock.patch ("ldapy.subtree.chunkSize", 2):
+            spilled = list (subtree.sortedByDN (reversed (self.entries), self.base))
+        self.assertListEqual (list (subtree.sortedByDN (self.entries, self.base)), spilled)
+
+class DiffTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = populated ()
+        self.old = "ou=Template,%s" % root
+        subtree.copy (self.con, self.old, self.con, "ou=Tenant,%s" % root)
+        self.new = "ou=Tenant,%s" % root
+
+    def changes (self):
+        return list (subtree.changes (self.con, self.old, self.con, self.new))
+
+    def test_same_subtrees_differ_only_by_the_base_rdn (self):
+        self.assertListEqual ([], self.changes ())
+
+    def test_added_and_modified (self):
+        self.con.add ("uid=user3,ou=People,%s" % self.new, {"objectClass": "person", "uid": "user3"})
+        self.con.modify ("uid=user0,ou=People,%s" % self.new, {}, {"cn": "Zero"})
+        self.assertListEqual ([
+            ("modify", "uid=user0,ou=People,%s" % self.old, ({}, {"cn": ["Zero"]})),
+            ("add", "uid=user3,ou=People,%s" % self.old, {"objectClass": ["person"], "uid": ["user3"]}),
+            ], self.changes ())
+
+    def test_children_are_deleted_before_parents (self):
+        for dn, _ in reversed (self.con.search ("ou=People,%s" % self.new, scopeSubtree)):
+            self.con.delete (dn)
+        records = self.changes ()
+        self.assertListEqual (["delete"] * 4, [changetype for changetype, _, _ in records])
+        self.assertEqual ("ou=People,%s" % self.old, records[-1][1])
+
+    def test_spilled (self):
+        self.con.delete ("uid=user0,ou=People,%s" % self.new)
+        self.con.add ("uid=user3,ou=People,%s" % self.new, {"objectClass": "person", "uid": "user3"})
+        expected = self.changes ()
+        with mock.patch ("ldapy.subtree.chunkSize", 2):
+            self.assertListEqual (expected, self.changes ())
+
+    def test_modifications (self):
+        self.assertListEqual ([("delete", "cn", []), ("add", "mail", ["a"]),
+            ("delete", "OU", ["b"]), ("add", "OU", ["c"]), ("replace", "sn", ["y"])],
+            subtree._modifications ({"cn": ["x"], "ou": ["a", "b"], "sn": ["x"]},
+                {"mail": ["a"], "OU": ["a", "c"], "sn": ["y"]}))
+
+    def test_ldif (self):
+        self.assertListEqual (["dn: cn=x,%s" % root, "changetype: modify",
+            "replace: description", "description:: IGxlYWRpbmcgc3BhY2U=", "-"],
+            subtree.ldif (("modify", "cn=x,%s" % root,
+                ({"description": ["old"]}, {"description": [" leading space"]}))))
+        self.assertListEqual (["dn: cn=x,%s" % root, "changetype: delete"],
+            subtree.ldif (("delete", "cn=x,%s" % root, None)))
+
+    def test_binary_values (self):
+        self.con.modify ("uid=user0,ou=People,%s" % self.new, {}, {"jpegPhoto": binary})
+        records = self.changes ()
+        self.assertListEqual ([("modify", "uid=user0,ou=People,%s" % self.old,
+            ({}, {"jpegPhoto": [binary]}))], records)
+        self.assertIn ("jpegPhoto:: /9j/4A==", subtree.ldif (records[0]))
+
+class ApplyTests (unittest2.TestCase):
+    def setUp (self):
+        self.con = populated ()
+        self.base = "ou=Template,%s" % root
+        self.ldif = [
+            "version: 1",
+            "# The template",
+            "dn: %s" % self.base,
+            "objectClass: organizationalUnit",
+            "ou: Template",
+            "",
+            "dn: ou=People,%s" % self.base,
+            "objectClass: organizationalUnit",
+            "ou: People",
+            "",
+            "dn: uid=user0,ou=People,%s" % self.base,
+            "objectClass: person",
+            "uid: user0",
+            "cn:: WmVybw==",
+            "",
+            "dn: ou=Groups,%s" % self.base,
+            "objectClass: organizationalUnit",
+            "ou: Gro",
+            " ups",
+            "",
+            "dn: cn=admins,ou=Groups,%s" % self.base,
+            "objectClass: groupOfNames",
+            "cn: admins",
+            "member: uid=user0,ou=People,%s" % self.base,
+            ]
+
+    def plan (self):
+        return subtree.plan (self.con, subtree.parseLdif (self.ldif))
+
+    def test_parse (self):
+        entries = list (subtree.parseLdif (self.ldif))
+        self.assertEqual (5, len(entries))
+        self.assertEqual ((self.base, {"objectClass": ["organizationalUnit"], "ou": ["Template"]}), entries[0])
+        self.assertListEqual (["Zero"], entries[2][1]["cn"])
+        self.assertListEqual (["Groups"], entries[3][1]["ou"])
+
+    def test_parse_errors (self):
+        for ldif in [["dn: %s" % self.base, "changetype: delete"], ["objectClass: top"],
+                ["dn: %s" % self.base, "jpegPhoto:< file:///tmp/photo.jpg"],
+                ["dn: %s" % self.base, "no separator"]]:
+            with self.assertRaises (ValueError):
+                list (subtree.parseLdif (ldif))
+
+    def test_plan_is_scheduled (self):
+        dn, records = self.plan ()
+        self.assertEqual (self.base, dn)
+        self.assertListEqual ([
+            ("delete", "uid=user2,ou=People,%s" % self.base),
+            ("delete", "uid=user1,ou=People,%s" % self.base),
+            ("modify", "uid=user0,ou=People,%s" % self.base),
+            ("add", "ou=Groups,%s" % self.base),
+            ("add", "cn=admins,ou=Groups,%s" % self.base),
+            ], sorted ([(changetype, dn) for changetype, dn, _ in records[:2]], reverse = True) +
+            [(changetype, dn) for changetype, dn, _ in records[2:]])
+
+    def test_execute_converges (self):
+        dn, records = self.plan ()
+        errback = mock.Mock ()
+        self.con.statistics.reset ()
+        self.assertEqual (5, subtree.execute (records, self.con, errback))
+        self.assertFalse (errback.called)
+        self.assertFalse (self.con.pipelining)
+        self.assertEqual (5, self.con.statistics.roundTrips)
+
+        self.assertListEqual ([], self.plan ()[1])
+        self.assertListEqual (["Zero"], self.con.search ("uid=user0,ou=People,%s" % self.base, scopeBase)[0][1]["cn"])
+
+    def test_new_subtree (self):
+        self.ldif = [line.replace ("ou=Template", "ou=Tenant") for line in self.ldif]
+        dn, records = self.plan ()
+        self.assertListEqual (["add"] * 5, [changetype for changetype, _, _ in records])
+        subtree.execute (records, self.con)
+        self.assertListEqual ([], self.plan ()[1])
+
+    def test_entries_outside_the_base (self):
+        for dn in [root, "ou=Other,%s" % root, self.base]:
+            self.ldif.extend (["", "dn: %s" % dn, "objectClass: organizationalUnit"])
+            with self.assertRaises (ValueError):
+                self.plan ()
+            del self.ldif[-3:]
+
+    def test_parents_have_to_be_given (self):
+        # Deleting ou=People while keeping its child
+        self.ldif = self.ldif[:6] + self.ldif[11:16]
+        with self.assertRaises (ValueError):
+            self.plan ()
+
+        # Adding below an entry which isn't there
+        self.ldif = self.ldif[:5] + ["", "dn: cn=admins,ou=Groups,%s" % self.base,
+                "objectClass: groupOfNames", "cn: admins"]
+        with self.assertRaises (ValueError):
+            self.plan ()
+
+    def test_binary_values (self):
+        self.con.modify ("uid=user0,ou=People,%s" % self.base, {}, {"jpegPhoto": binary})
+        self.ldif = []
+        for dn, attributes in self.con.search (self.base, scopeSubtree):
+            self.ldif.extend ([line for line in subtree.ldif (("add", dn, attributes))
+                if line != "changetype: add"] + [""])
+
+        entries = dict (subtree.parseLdif (self.ldif))
+        self.assertListEqual ([binary], entries["uid=user0,ou=People,%s" % self.base]["jpegPhoto"])
+        self.assertListEqual ([], self.plan ()[1])
+
+    def test_given_twice_in_spilled_runs (self):
+        self.ldif.extend (["", "dn: uid=user0,ou=People,%s" % self.base,
+            "objectClass: person", "uid: user0"])
+        with mock.patch ("ldapy.subtree.chunkSize", 2):
+            with self.assertRaises (ValueError):
+                self.plan ()
+
+    def test_nothing_to_apply (self):
+        self.assertEqual ((None, []), subtree.plan (self.con, []))
@@ -0,0 +1,88 @@
+from ldapy.tracing import Tracer, MemoryExporter, JsonFileExporter, tracer
+from ldapy.memory_connection import MemoryConnection
+from ldapy.exceptions import NoSuchObject
+from ldapy.ldapy import Ldapy
+import unittest2
+import tempfile
+import json
+import os
+
+class TracerTests (unittest2.TestCase):
+    def setUp (self):
+        self.tracer = Tracer ()
+        self.exporter = MemoryExporter ()
+
+    def test_no_spans_without_exporters (self):
+        with self.tracer.span ("foo") as span:
+            self.assertIsNone (self.tracer.current)
+        span.setAttribute ("bar", 1)
+
+    def test_nested_spans (self):
+        self.tracer.addExporter (self.exporter)
+        with self.tracer.span ("outer", a = 1) as outer:
+            with self.tracer.span ("inner") as inner:
+                self.assertIs (self.tracer.current, inner)
+        self.assertIsNone (self.tracer.current)
+
+        self.assertListEqual (self.exporter.spans, [inner, outer])
+        self.assertEqual (inner.parentId, outer.spanId)
+        self.assertEqual (inner.traceId, outer.traceId)
+        self.assertIsNone (outer.parentId)
+        self.assertDictEqual (outer.attributes, {"a": 1})
+        self.assertLessEqual (outer.start, inner.start)
+        self.assertGreaterEqual (outer.end, inner.end)
+
+    def test_error_is_recorded (self):
+        self.tracer.addExporter (self.exporter)
+        with self.assertRaises (ValueError):
+            with self.tracer.span ("foo"):
+                raise ValueError ("bar")
+
+        self.assertEqual (self.exporter.spans[0].error, "ValueError: bar")
+
+    def test_json_file_exporter (self):
+        f, filename = tempfile.mkstemp ()
+        os.close (f)
+        try:
+            self.tracer.addExporter (JsonFileExporter (filename))
+            with self.tracer.span ("outer"):
+                with self.tracer.span ("inner", dn = "dc=nodomain"):
+                    pass
+
+            with open (filename) as f:
+                spans = [json.loads (line) for line in f]
+        finally:
+            os.remove (filename)
+
+        self.assertListEqual ([s["name"] for s in spans], ["inner", "outer"])
+        self.assertEqual (spans[0]["parent_id"], spans[1]["span_id"])
+        self.assertEqual (spans[0]["attributes"]["dn"], "dc=nodomain")
+
+class LayerTests (unittest2.TestCase):
+    def setUp (self):
+        self.exporter = MemoryExporter ()
+        tracer.addExporter (self.exporter)
+        self.ldapy = Ldapy (MemoryConnection (["dc=nodomain"]))
+        del self.exporter.spans[:]
+
+    def tearDown (self):
+        tracer.removeExporter (self.exporter)
+
+    def test_round_trips_are_attributed (self):
+        self.ldapy.changeDN ("dc=nodomain")
+        self.ldapy.children
+
+        byId = dict ([(s.spanId, s) for s in self.exporter.spans])
+        search = [s for s in self.exporter.spans if s.name == "ldap.search"][0]
+        populate = byId[search.parentId]
+        self.assertEqual (populate.name, "Node.populateChildren")
+        self.assertEqual (byId[populate.parentId].name, "Ldapy.children")
+        self.assertEqual (search.attributes["dn"], "dc=nodomain")
+        self.assertEqual (search.attributes["entries"], 0)
+
+    def test_failed_operations (self):
+        with self.assertRaises (NoSuchObject):
+            self.ldapy.changeDN ("dc=nodomain/ou=foo")
+
+        errors = [s.name for s in self.exporter.spans if s.error]
+        self.assertListEqual (errors, ["ldap.search", "Node.populateAttributes", "Ldapy.changeDN"])